@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Agent mode for the chat: the model may call tools before it answers.
+
+Every step is one model call with the tool definitions. When the model asks for
+tools, all calls of the step run in parallel in a thread pool, each with its own
+timeout, and their results go back to the model for the next step. The client gets
+a 'tool' event whenever a tool starts and ends, so it can show what the agent does.
+
+The loop is capped at AGENT_MAX_STEPS tool rounds and AGENT_MAX_SECONDS: after the
+last round the model is told to answer with what it has. Models need the 'Tool
+Calling' switch in the model form; for other models the chat streams as usual.
+
+Tools:
+- web_search:       Google search with the text of the top pages via ai_search.py
+- search_files:     passages of the files attached to the chat
+- search_documents: records of the DMS collections the user may list
+"""
+import os
+import re
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from core.db_document import File, History, Prompt, Example
+from core.db_helper import searchDocuments
+from core.helper import prepare_context_from_files
+from ai.ai_llm_helper import (llm_call, llm_complete_tools, tool_result_messages, scheduled_complete, sse_stream,
+                              delta_event, usage_event, error_event, BUSY_MESSAGE)
+from ai.ai_scheduler import SchedulerError, PRIORITY_INTERACTIVE
+from ai.ai_coalesce import coalesced_stream
+from ai.ai_context import fit_messages
+from ai.ai_models import model_catalog
+from ai.ai_search import search_context
+from ai.ai_streams import streams
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+max_steps = int(os.getenv('AGENT_MAX_STEPS', '4'))
+max_seconds = float(os.getenv('AGENT_MAX_SECONDS', '60'))
+tool_timeout = float(os.getenv('AGENT_TOOL_TIMEOUT', '15'))
+tool_workers = int(os.getenv('AGENT_TOOL_WORKERS', '16'))
+
+# Tool results are cut to this size before they go back to the model
+MAX_RESULT_CHARS = 8000
+
+# Collections search_documents may read, the access filters of the documents apply.
+# Tools run in worker threads without app context, so no getDefaults (it needs url_for).
+DOCUMENT_COLLECTIONS = {'prompts': Prompt, 'files': File, 'history': History, 'examples': Example}
+
+FINAL_NOTE = ("Das Limit für Werkzeugaufrufe ist erreicht. Beantworte die Frage jetzt "
+              "mit den vorliegenden Informationen, ohne weitere Werkzeuge.")
+
+_executor = ThreadPoolExecutor(max_workers=tool_workers, thread_name_prefix='agent-tool')
+
+
+def tool_event(call_id, name, status, **data):
+    """Progress of a tool call: status is running, done, error or timeout."""
+    return ('tool', dict({'id': call_id, 'name': name, 'status': status}, **data))
+
+
+def web_search(arguments, context):
+    """Numbered result blocks with the text of the top pages, see search_context."""
+    return search_context(arguments['query'])['text']
+
+
+def query_terms(query):
+    return {term for term in re.findall(r'\w+', query.lower()) if len(term) > 2}
+
+
+def search_files(arguments, context):
+    """Ranks the paragraphs of the chat's files by the query terms they contain."""
+    if not context['file_ids']:
+        return {'message': 'Es sind keine Dateien an diesen Chat angehängt.'}
+    files = [json.loads(file.to_json()) for file in File.objects(id__in=context['file_ids'])
+             if file.can_access(context['user'])]
+    terms = query_terms(arguments['query'])
+    passages = []
+    for file in files:
+        text = prepare_context_from_files([file])
+        if text['status'] != 'ok':
+            continue
+        for paragraph in re.split(r'\n\s*\n', text['data']):
+            paragraph = paragraph.strip()
+            score = len(terms & query_terms(paragraph))
+            if score:
+                passages.append((score, file['name'], paragraph[:1500]))
+    passages.sort(key=lambda passage: passage[0], reverse=True)
+    return [{'file': name, 'text': paragraph} for score, name, paragraph in passages[:5]]
+
+
+def search_documents(arguments, context):
+    name = arguments.get('collection')
+    if name not in DOCUMENT_COLLECTIONS:
+        return {'error': f"Unbekannte Sammlung {name}, erlaubt sind {list(DOCUMENT_COLLECTIONS)}"}
+    document_class = DOCUMENT_COLLECTIONS[name]
+    document = document_class()
+    if not document.can_list(context['user']):
+        return {'error': 'Zugriff verweigert'}
+    result = searchDocuments(document_class, document.searchFields(), 0, 5, arguments.get('query', ''),
+                             filter=document_class.get_list_filter(context['user']), count=False)
+    if result['status'] != 'ok':
+        return {'error': result['message']}
+    return json.loads(result['data'])
+
+
+TOOLS = {
+    'web_search': {
+        'function': web_search,
+        'timeout': tool_timeout,
+        'definition': {
+            'name': 'web_search',
+            'description': ('Sucht aktuelle Informationen im Web (Google, deutsche Ergebnisse der letzten Tage) '
+                            'und liefert nummerierte Quellen mit dem Text der ersten Seiten.'),
+            'parameters': {'type': 'object', 'properties': {'query': {'type': 'string', 'description': 'Suchanfrage'}},
+                           'required': ['query']},
+        },
+    },
+    'search_files': {
+        'function': search_files,
+        'timeout': tool_timeout,
+        'definition': {
+            'name': 'search_files',
+            'description': 'Durchsucht die an den Chat angehängten Dateien und liefert passende Abschnitte.',
+            'parameters': {'type': 'object', 'properties': {'query': {'type': 'string', 'description': 'Suchbegriffe'}},
+                           'required': ['query']},
+        },
+    },
+    'search_documents': {
+        'function': search_documents,
+        'timeout': tool_timeout,
+        'definition': {
+            'name': 'search_documents',
+            'description': 'Sucht Datensätze im Dokumentenmanagement (Prompts, Dateien, Chatverläufe, Beispiele).',
+            'parameters': {'type': 'object', 'properties': {
+                'collection': {'type': 'string', 'enum': list(DOCUMENT_COLLECTIONS)},
+                'query': {'type': 'string', 'description': 'Suchbegriff'}},
+                'required': ['collection', 'query']},
+        },
+    },
+}
+
+
+def tools_enabled(model):
+    return model.get('tool_calling') == 'On' and not model['model'].startswith('o1-')
+
+
+def run_tool(call, context):
+    tool = TOOLS.get(call['name'])
+    if tool is None:
+        raise ValueError(f"Unknown tool {call['name']}")
+    return tool['function'](call['arguments'], context)
+
+
+def result_content(value):
+    content = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return content[:MAX_RESULT_CHARS]
+
+
+def run_tools(calls, context, deadline, cancel=None):
+    """
+    Runs the tool calls of one step in parallel and yields their progress events.
+    Returns the results [{'id', 'content'}] in the order of the calls.
+    """
+    started = time.time()
+    futures = {}
+    for call in calls:
+        future = _executor.submit(run_tool, call, context)
+        timeout = TOOLS.get(call['name'], {}).get('timeout', tool_timeout)
+        futures[future] = (call, min(started + timeout, deadline))
+    for call in calls:
+        yield tool_event(call['id'], call['name'], 'running', arguments=call['arguments'])
+
+    contents = {}
+    pending = set(futures)
+    while pending:
+        if cancel and cancel.cancelled:
+            return []
+        # Short waits, so a cancelled stream does not wait for slow tools
+        next_deadline = min(futures[future][1] for future in pending)
+        done, pending = wait(pending, timeout=max(0, min(next_deadline - time.time(), 0.5)),
+                             return_when=FIRST_COMPLETED)
+        for future in done:
+            call = futures[future][0]
+            seconds = round(time.time() - started, 2)
+            try:
+                contents[call['id']] = result_content(future.result())
+                yield tool_event(call['id'], call['name'], 'done', seconds=seconds)
+            except Exception as e:
+                logger.warning("Tool %s failed: %s", call['name'], e)
+                contents[call['id']] = f"Fehler: {e}"
+                yield tool_event(call['id'], call['name'], 'error', seconds=seconds)
+        for future in [future for future in pending if time.time() >= futures[future][1]]:
+            # The thread finishes in the background, its result is not awaited
+            pending.discard(future)
+            call = futures[future][0]
+            logger.warning("Tool %s timed out", call['name'])
+            contents[call['id']] = "Fehler: Zeitüberschreitung"
+            yield tool_event(call['id'], call['name'], 'timeout', seconds=round(time.time() - started, 2))
+    return [{'id': call['id'], 'content': contents[call['id']]} for call in calls]
+
+
+def add_usage(total, usage):
+    for key, value in (usage or {}).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[key] = total.get(key, 0) + value
+
+
+def agent_stream(messages, model, user, user_id=None, cancel=None, priority=PRIORITY_INTERACTIVE):
+    """Events of the agent loop, see module docstring. The usage event sums all steps."""
+    context = {
+        'user': user,
+        'file_ids': [attachment['id'] for message in messages for attachment in message.get('attachments') or []],
+    }
+    definitions = [tool['definition'] for tool in TOOLS.values()]
+    messages = [{key: value for key, value in message.items() if key != 'attachments'} for message in messages]
+    deadline = time.time() + max_seconds
+    usage = {}
+    final = False
+
+    for step in range(max_steps + 1):
+        if cancel and cancel.cancelled:
+            return
+        try:
+            # The tool results of earlier steps count against the context budget too
+            result = scheduled_complete(fit_messages(messages, model), model, priority, user_id,
+                                        complete=lambda messages, model: llm_complete_tools(
+                                            messages, model, definitions, allow_calls=not final))
+        except SchedulerError as e:
+            logger.warning("Agent step rejected by scheduler: %s", e)
+            yield error_event(BUSY_MESSAGE)
+            return
+        add_usage(usage, result['usage'])
+
+        if final or not result['tool_calls']:
+            yield delta_event(result['text'])
+            yield usage_event(usage)
+            return
+
+        logger.debug("Agent step %s calls %s", step + 1, [call['name'] for call in result['tool_calls']])
+        messages.append(result['assistant_message'])
+        results = yield from run_tools(result['tool_calls'], context, deadline, cancel)
+        final = step + 1 >= max_steps or time.time() >= deadline
+        messages.extend(tool_result_messages(model, results, FINAL_NOTE if final else None))
+
+
+def agent_call(messages, model, user, user_id=None, prompt_id=None):
+    """
+    Streams the agent loop as SSE events, like llm_call. user is the user object the
+    tools check access for. Models without tool calling get a plain llm_call.
+    """
+    model = model_catalog.resolve(model)
+    if not tools_enabled(model):
+        return llm_call(messages, model, prompt_id=prompt_id, user_id=user_id, user=user)
+    messages = fit_messages(messages, model)
+    token = streams.register(user_id)
+    return sse_stream(coalesced_stream(agent_stream(messages, model, user, user_id, token)), token)
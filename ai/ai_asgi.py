@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ASGI gateway for /chat/stream.
+
+A chat stream keeps the connection open for as long as the model needs to answer.
+Under WSGI that blocks a whole worker thread; here every stream is a coroutine on
+one event loop, so a single process can hold hundreds of them. All other routes are
+still served by the Flask app - the reverse proxy only sends /chat/stream and
+/chat/cancel/ here (streams can only be cancelled by the process serving them).
+
+Streams that need the semantic cache, hedging or the agent loop use the same sync
+pipeline as the Flask route; their events are pulled in worker threads (at most
+ASGI_SYNC_STREAMS at a time), so they behave exactly like under WSGI.
+"""
+import os
+import sys
+import json
+
+import anyio
+
+# Add parent directory to Python path to find core module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_login import current_user
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
+
+from ai.ai_llm_helper import (scheduled_stream_async, stream_events, sse_event, start_event, error_event,
+                              ERROR_MESSAGE)
+from ai.ai_agent import agent_stream, tools_enabled
+from ai.ai_hedge import hedge_enabled
+from ai.ai_semantic_cache import prompt_settings, with_system_message
+from ai.ai_coalesce import coalesce_async
+from ai.ai_context import fit_messages
+from ai.ai_clients import aclose_clients
+from ai.ai_streams import streams
+from ai.ai_write_behind import write_behind
+from ai.ai_models import model_catalog
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+STREAM_PATH = '/chat/stream'
+CANCEL_PATH = '/chat/cancel/'
+
+# Worker threads for the streams of the sync pipeline, each holds one while waiting for its next event
+sync_streams = anyio.CapacityLimiter(int(os.getenv('ASGI_SYNC_STREAMS', '100')))
+
+_flask_app = None
+
+
+def get_flask_app():
+    # Imported lazily, the Flask app is only needed to decode sessions and CSRF tokens
+    global _flask_app
+    if _flask_app is None:
+        from app import app
+        _flask_app = app
+    return _flask_app
+
+
+def authorize(path, headers, csrf_token):
+    """
+    Checks the Flask session cookie and the CSRF token of a stream request, exactly
+    like the Flask app would. Runs in a worker thread because the user loader hits MongoDB.
+    Returns the logged in user, or None if the request is not authorized.
+    """
+    app = get_flask_app()
+    with app.test_request_context(path, method='POST', headers=headers):
+        try:
+            validate_csrf(csrf_token)
+        except ValidationError as e:
+            logger.warning("CSRF validation failed for stream: %s", e)
+            return None
+        if current_user and current_user.is_authenticated:
+            # The user object outlives the request context, the agent tools check access with it
+            return current_user._get_current_object()
+        return None
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def send_response(send, status, body, content_type=b'text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type)]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def request_headers(scope):
+    headers = [(key.decode('latin-1'), value.decode('latin-1')) for key, value in scope['headers']]
+    csrf_token = next((value for key, value in headers if key.lower() == 'x-csrftoken'), None)
+    return headers, csrf_token
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_clients()
+            # Token usage of the last streams is still buffered
+            await anyio.to_thread.run_sync(write_behind.flush)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def in_threads(events):
+    """Async generator over a sync event generator, every event is pulled in a worker thread."""
+    try:
+        while True:
+            item = await anyio.to_thread.run_sync(next, events, None, limiter=sync_streams)
+            if item is None:
+                return
+            yield item
+    finally:
+        # Releases the scheduler slot and closes the provider response of the sync stream
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(events.close)
+
+
+def chat_events(data, messages, model, user, settings, token):
+    """
+    The event stream of a request, dispatched like the Flask route: agent loop,
+    semantic cache and hedging run in the sync pipeline, everything else natively async.
+    """
+    user_id = str(user.id)
+    if data.get('agent') and tools_enabled(model):
+        return in_threads(agent_stream(messages, model, user, user_id, token))
+    if settings or hedge_enabled(model):
+        return in_threads(stream_events(messages, model, settings, user_id=user_id, cancel=token))
+    return scheduled_stream_async(messages, model, user_id=user_id, cancel=token)
+
+
+async def stream(scope, receive, send):
+    headers, csrf_token = request_headers(scope)
+    body = await read_body(receive)
+    user = await anyio.to_thread.run_sync(authorize, scope['path'], headers, csrf_token)
+    if not user:
+        await send_response(send, 403, b'Forbidden')
+        return
+    user_id = str(user.id)
+
+    try:
+        data = json.loads(body)
+        model = model_catalog.resolve(data['model'])
+        messages = data['messages']
+    except (ValueError, KeyError) as e:
+        await send_response(send, 400, f"Invalid request: {e}".encode('utf-8'))
+        return
+
+    # Loads the prompt and its files from MongoDB
+    settings = await anyio.to_thread.run_sync(prompt_settings, data.get('prompt_id'), user)
+    if settings:
+        messages = with_system_message(messages, settings['system_message'])
+    messages = fit_messages(messages, model)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]
+    })
+
+    async def emit(event, data):
+        await send({'type': 'http.response.body', 'body': sse_event(event, data), 'more_body': True})
+
+    token = streams.register(user_id)
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                streams.disconnected(token)
+                return
+
+    try:
+        async with anyio.create_task_group() as tasks:
+            # A disconnect or /chat/cancel cancels the stream, which closes the provider response
+            token.on_cancel(tasks.cancel_scope.cancel)
+            tasks.start_soon(watch_disconnect)
+            await emit(*start_event(token.stream_id))
+            await coalesce_async(chat_events(data, messages, model, user, settings, token), emit)
+            tasks.cancel_scope.cancel()
+    except Exception as e:
+        logger.error("Error while streaming: %s", e)
+        await emit(*error_event(ERROR_MESSAGE))
+    finally:
+        streams.finish(token)
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def cancel(scope, receive, send):
+    """Stop button: cancels a running stream of the logged in user."""
+    headers, csrf_token = request_headers(scope)
+    await read_body(receive)
+    user = await anyio.to_thread.run_sync(authorize, scope['path'], headers, csrf_token)
+    if not user:
+        await send_response(send, 403, b'Forbidden')
+        return
+    # Runs on the event loop, so the cancel callbacks of the stream do as well
+    if streams.cancel(scope['path'][len(CANCEL_PATH):], str(user.id)):
+        await send_response(send, 200, b'{"status": "ok"}', b'application/json')
+    else:
+        await send_response(send, 404, b'{"status": "error", "message": "Stream not found"}', b'application/json')
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if scope['path'] == STREAM_PATH and scope['method'] == 'POST':
+        await stream(scope, receive, send)
+    elif scope['path'].startswith(CANCEL_PATH) and scope['method'] == 'POST':
+        await cancel(scope, receive, send)
+    else:
+        await send_response(send, 404, b'Not Found')
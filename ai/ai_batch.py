@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline batch runner: runs one Prompt template over a JSONL input file.
+
+    python ai/ai_batch.py run --prompt <prompt_id> --model <model> --input in.jsonl --output out.jsonl
+    python ai/ai_batch.py resume <job_id>
+    python ai/ai_batch.py status [<job_id>]
+
+Every input line is a JSON object with the text in "input" and an optional "id"
+(default: the line number). The text replaces {input} in the prompt text, or is
+appended to it; {context} in the system message is filled from the prompt's files
+like in the chat.
+
+Results are appended to the output file as they arrive, one line per item with id,
+output, usage and error. The output file is the checkpoint: a resumed job skips
+every id that already has a successful result and retries the failed ones.
+
+Requests go through llm_call with PRIORITY_BATCH, so the scheduler keeps the run
+within the provider's concurrency and TPM limits. The scheduler is per process: the
+batch run is not prioritised against the chat, which runs in other processes and
+shares the provider's real limits. So the run uses at most BATCH_MAX_WORKERS parallel
+requests (default 4) unless --workers is given, leaving room for the chat.
+
+Only transient errors are retried with backoff: timeouts, connection errors, 429,
+5xx and a full scheduler queue. Other errors (e.g. 400 for an oversized item) fail
+the item at once.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Add parent directory to Python path to find core module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.db_document import BatchJob, Prompt, File
+from core.helper import prepare_context_from_files
+from ai.ai_llm_helper import llm_call
+from ai.ai_models import model_catalog
+import httpx
+import openai
+import anthropic
+
+from ai.ai_scheduler import PRIORITY_BATCH, SchedulerError, provider_limits, model_limits
+
+max_retries = int(os.getenv('BATCH_MAX_RETRIES', '5'))
+max_backoff = float(os.getenv('BATCH_MAX_BACKOFF', '60'))
+max_workers = int(os.getenv('BATCH_MAX_WORKERS', '4'))
+
+# Errors without HTTP status that are worth retrying
+TRANSIENT_ERRORS = (openai.APIConnectionError, anthropic.APIConnectionError, httpx.TransportError,
+                    TimeoutError, ConnectionError, SchedulerError)
+
+# Seconds between progress updates of the BatchJob document
+PROGRESS_INTERVAL = 10
+# Items submitted ahead per worker, keeps the pool busy without reading the whole input
+QUEUE_AHEAD = 2
+
+
+def read_items(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if not isinstance(item, dict):
+                item = {'input': item}
+            item.setdefault('id', line_number)
+            yield item
+
+
+def add_usage(totals, usage):
+    for key, value in (usage or {}).items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            totals[key] = totals.get(key, 0) + value
+
+
+def read_checkpoint(path):
+    """Returns the ids with a successful result in the output file and their summed usage."""
+    done, usage = set(), {}
+    if not os.path.exists(path):
+        return done, usage
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                # The last line may be cut off by a crash
+                continue
+            if not result.get('error'):
+                done.add(str(result['id']))
+                add_usage(usage, result.get('usage'))
+    return done, usage
+
+
+def open_output(path):
+    """Opens the output file for appending, after a line cut off by a crash if there is one."""
+    cut_off = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            cut_off = f.read(1) != b'\n'
+    output = open(path, 'a', encoding='utf-8')
+    if cut_off:
+        output.write('\n')
+    return output
+
+
+def load_prompt(prompt_id):
+    prompt = Prompt.objects(id=prompt_id).first()
+    if not prompt:
+        raise ValueError(f"Prompt {prompt_id} not found")
+
+    system_message = prompt.system_message
+    if '{context}' in system_message:
+        files = json.loads(File.objects(document_id=str(prompt.id)).to_json())
+        context = prepare_context_from_files(files)
+        if context['status'] == 'ok':
+            system_message = system_message.replace('{context}', context['data'])
+    return system_message, prompt.prompt
+
+
+def load_model(name):
+    model = model_catalog.get(name)
+    if not model:
+        raise ValueError(f"Model {name} not found")
+    return model
+
+
+def build_messages(system_message, template, item):
+    text = item.get('input', '')
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False)
+    if '{input}' in template:
+        content = template.replace('{input}', text)
+    else:
+        content = f"{template}\n\n{text}"
+    return [
+        {'role': 'system', 'content': system_message},
+        {'role': 'user', 'content': content}
+    ]
+
+
+def default_workers(model):
+    """The scheduler's concurrency limit, capped at max_workers so the chat keeps its share."""
+    provider_concurrency, _ = provider_limits(model['provider'])
+    model_concurrency, _ = model_limits(model)
+    workers = min(provider_concurrency, model_concurrency) if model_concurrency else provider_concurrency
+    return max(1, min(workers, max_workers))
+
+
+def retriable(error):
+    """Timeouts, connection errors, rate limits (429) and server errors (5xx)."""
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def run_item(item, messages, model):
+    """Runs one item, retrying transient errors with exponential backoff."""
+    started = time.time()
+    error = None
+    for attempt in range(max_retries + 1):
+        try:
+            result = llm_call(messages, model, stream=False, priority=PRIORITY_BATCH, with_usage=True)
+            return {'id': item['id'], 'output': result['text'], 'usage': result['usage'], 'error': None,
+                    'attempts': attempt + 1, 'duration': round(time.time() - started, 3)}
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if not retriable(e):
+                break
+            if attempt < max_retries:
+                time.sleep(min(max_backoff, 2 ** attempt))
+    return {'id': item['id'], 'output': None, 'usage': {}, 'error': error,
+            'attempts': attempt + 1, 'duration': round(time.time() - started, 3)}
+
+
+def run_job(job):
+    system_message, template = load_prompt(job.prompt_id)
+    model = load_model(job.model)
+    workers = job.workers or default_workers(model)
+
+    done, usage = read_checkpoint(job.output_file)
+    counters = {'total': 0, 'completed': len(done), 'failed': 0}
+    if done:
+        print(f"Resuming job {job.id}: {len(done)} items already done")
+
+    job.update(set__status='running', set__workers=workers, set__started_date=datetime.now(),
+               set__completed=counters['completed'], set__failed=0, set__usage=usage, set__error='')
+    last_progress = time.time()
+
+    def record(result, output):
+        nonlocal last_progress
+        output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        output.flush()
+        if result['error']:
+            counters['failed'] += 1
+            print(f"Item {result['id']} failed: {result['error']}")
+        else:
+            counters['completed'] += 1
+            add_usage(usage, result['usage'])
+
+        if time.time() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.time()
+            job.update(set__completed=counters['completed'], set__failed=counters['failed'], set__usage=usage)
+            print(f"{counters['completed']} completed, {counters['failed']} failed")
+
+    print(f"Running job {job.id} with {workers} workers on {model['provider']}/{model['model']}")
+    try:
+        with open_output(job.output_file) as output, ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = set()
+            for item in read_items(job.input_file):
+                counters['total'] += 1
+                if str(item['id']) in done:
+                    continue
+                if len(pending) >= workers * QUEUE_AHEAD:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record(future.result(), output)
+                pending.add(pool.submit(run_item, item, build_messages(system_message, template, item), model))
+
+            for future in wait(pending).done:
+                record(future.result(), output)
+    except BaseException as e:
+        job.update(set__status='failed', set__error=f"{type(e).__name__}: {e}", set__total=counters['total'],
+                   set__completed=counters['completed'], set__failed=counters['failed'], set__usage=usage)
+        raise
+
+    job.update(set__status='completed', set__finished_date=datetime.now(), set__total=counters['total'],
+               set__completed=counters['completed'], set__failed=counters['failed'], set__usage=usage)
+    print(f"Job {job.id} finished: {counters['completed']}/{counters['total']} completed, "
+          f"{counters['failed']} failed, usage {usage}")
+    if counters['failed']:
+        print(f"Run 'python ai/ai_batch.py resume {job.id}' to retry the failed items")
+
+
+def print_status(job):
+    print(f"{job.id}  {job.status:<10} {job.completed}/{job.total} completed, {job.failed} failed  "
+          f"{job.model}  {job.input_file} -> {job.output_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a prompt over a JSONL input file.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='start a new batch job')
+    run.add_argument('--prompt', required=True, help='id of the Prompt document')
+    run.add_argument('--model', required=True, help='model name as in the Model collection')
+    run.add_argument('--input', required=True, help='JSONL file with one {"id", "input"} object per line')
+    run.add_argument('--output', required=True, help='JSONL file the results are appended to')
+    run.add_argument('--workers', type=int, default=0,
+                     help='parallel requests (default: the scheduler limit, at most BATCH_MAX_WORKERS)')
+
+    resume = commands.add_parser('resume', help='continue an interrupted job')
+    resume.add_argument('job_id')
+
+    status = commands.add_parser('status', help='show the progress of jobs')
+    status.add_argument('job_id', nargs='?')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        job = BatchJob(prompt_id=args.prompt, model=args.model, input_file=os.path.abspath(args.input),
+                       output_file=os.path.abspath(args.output), workers=args.workers)
+        job.save()
+        run_job(job)
+    elif args.command == 'resume':
+        job = BatchJob.objects(id=args.job_id).first()
+        if not job:
+            sys.exit(f"Batch job {args.job_id} not found")
+        run_job(job)
+    else:
+        jobs = BatchJob.objects(id=args.job_id) if args.job_id else BatchJob.objects().order_by('-created_date').limit(20)
+        for job in jobs:
+            print_status(job)
+
+
+if __name__ == '__main__':
+    main()
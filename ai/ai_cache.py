@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Exact-match response cache for non-streaming LLM calls.
+
+Responses are stored under a sha256 of the canonical (model, messages) JSON.
+The in-memory LRU tier is always on; the disk tier is used when LLM_CACHE_DIR is set.
+Caching is opt-in per model via the 'response_cache' switch on the Model document.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+memory_max_entries = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1000'))
+cache_ttl = int(os.getenv('LLM_CACHE_TTL', '86400'))
+disk_dir = os.getenv('LLM_CACHE_DIR', '')
+disk_max_bytes = int(float(os.getenv('LLM_CACHE_DISK_MAX_MB', '100')) * 1024 * 1024)
+
+# Fields of a model dict that don't change the answer and must not change the key
+IGNORED_MODEL_FIELDS = ['_id', 'id', 'created_date', 'created_by', 'modified_date', 'modified_by']
+
+
+def cache_enabled(model):
+    return model.get('response_cache') == 'On'
+
+
+def cache_key(model, messages):
+    canonical_model = {k: v for k, v in model.items() if k not in IGNORED_MODEL_FIELDS}
+    canonical = json.dumps({'model': canonical_model, 'messages': messages},
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=memory_max_entries, ttl=cache_ttl, directory=disk_dir, max_bytes=disk_max_bytes):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remember(self, key, value, created):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _disk_get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            self._disk_remove(path)
+            return None
+        return entry
+
+    def _disk_remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+        except OSError:
+            pass
+
+    def _disk_put(self, key, value, created):
+        path = self._path(key)
+        data = json.dumps({'created': created, 'value': value}, ensure_ascii=False)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self._disk_bytes is not None:
+            self._disk_bytes += len(data.encode('utf-8'))
+        self._disk_evict()
+
+    def _disk_evict(self):
+        """Removes expired entries, then the oldest ones until the directory fits max_bytes."""
+        if self._disk_bytes is not None and self._disk_bytes <= self.max_bytes:
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and now - mtime <= self.ttl:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.counters['evictions'] += 1
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return value
+                del self._memory[key]
+
+            if self.directory:
+                entry = self._disk_get(key)
+                if entry is not None:
+                    self._remember(key, entry['value'], entry['created'])
+                    self.counters['disk_hits'] += 1
+                    return entry['value']
+
+            self.counters['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        created = time.time()
+        with self._lock:
+            self._remember(key, value, created)
+            self.counters['stores'] += 1
+            if self.directory:
+                try:
+                    self._disk_put(key, value, created)
+                except OSError as e:
+                    logger.warning("Could not write cache entry %s: %s", key, e)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.directory:
+                for name in os.listdir(self.directory):
+                    if name.endswith('.json'):
+                        self._disk_remove(os.path.join(self.directory, name))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+            hits = lookups - self.counters['misses']
+            return dict(self.counters, entries=len(self._memory),
+                        hit_rate=round(hits / lookups, 3) if lookups else 0.0)
+
+
+response_cache = ResponseCache()
@@ -15,11 +15,28 @@ from flask_login import login_required, current_user
 sys.path.append('db')
 
 from core.helper import handleDocument, prepare_context_from_files, upload_file
-from core.db_document import File, History, Model, Prompt
+from core.db_crud import on_delete
+from core.db_document import File, History, Prompt
 
 from core.db_connect import *
 
 from ai.ai_llm_helper import llm_call
+from ai.ai_metrics import metrics
+from ai.ai_scheduler import scheduler
+from ai.ai_cache import response_cache
+from ai.ai_hedge import hedge_stats
+from ai.ai_semantic_cache import semantic_cache
+from ai.ai_streams import streams
+from ai.ai_write_behind import write_behind
+from ai.ai_usage import usage_report
+from ai.ai_models import model_catalog
+from ai.ai_agent import agent_call
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# A buffered save of a deleted chat would recreate it on the next flush
+on_delete(History, lambda history: write_behind.discard_history(history.user_id, history.chat_started))
 
 # Import the getConfig function from db_chat.py
 #from db.db_chat import getConfig
@@ -51,14 +68,12 @@ Konzentriere dich auf qualitativ hochwertige, relevante Informationen statt auf
 
     welcome_message = "Hallo wie kann ich helfen?"
     messages = []
-    models = json.loads(Model.objects().to_json())
-    print (models)
-
     return {
         "system_message": system_message,
         "welcome_message": welcome_message,
         'messages': messages,
-        'models': models,
+        'models': model_catalog.models(),
+        'models_json': model_catalog.serialized(),
         'use_prompt_template': 'False'
     }
 
@@ -84,6 +99,7 @@ def chat(prompt_id=None, history_id=None):
     config['using_context'] = False
     config['context_files'] = []
     config['file_ids'] = []
+    config['prompt_id'] = prompt_id or ''
 
     if prompt_id:
         prompt = json.loads(
@@ -145,77 +161,84 @@ def chat(prompt_id=None, history_id=None):
 @dms_chat.route('/stream', methods=['POST'])
 def stream():
     data = request.get_json()
-    response_stream = llm_call(data['messages'], data['model'])
-    return Response(response_stream, mimetype='text/event-stream')
+    user_id = str(current_user.id) if current_user.is_authenticated else None
+    if data.get('agent') and current_user.is_authenticated:
+        # The tools run in worker threads, they get the user object instead of the request bound proxy
+        response_stream = agent_call(data['messages'], data['model'], current_user._get_current_object(), user_id,
+                                     prompt_id=data.get('prompt_id'))
+    else:
+        user = current_user._get_current_object() if current_user.is_authenticated else None
+        response_stream = llm_call(data['messages'], data['model'], prompt_id=data.get('prompt_id'), user_id=user_id,
+                                   user=user)
+    return Response(response_stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@dms_chat.route('/cancel/<stream_id>', methods=['POST'])
+@login_required
+def cancel_stream(stream_id):
+    """Stop button: cancels a running stream of the current user, the provider stops generating."""
+    if not streams.cancel(stream_id, str(current_user.id)):
+        return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+    return jsonify({'status': 'ok'})
+
+
+@dms_chat.route('/metrics', methods=['GET'])
+@login_required
+def llm_metrics():
+    """Latency histograms and cache/scheduler counters of this process, admins only."""
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+    return jsonify({
+        'status': 'ok',
+        'latency': metrics.snapshot(),
+        'scheduler': scheduler.stats(),
+        'response_cache': response_cache.stats(),
+        'semantic_cache': dict(semantic_cache.counters),
+        'hedging': hedge_stats.stats(),
+        'streams': streams.stats(),
+        'write_behind': write_behind.stats(),
+    })
+
+
+@dms_chat.route('/usage', methods=['GET'])
+@login_required
+def llm_usage():
+    """
+    Token usage and spend from the usage ledger, admins only.
+    ?period=day|hour&days=30&group_by=model|provider|user_id&user_id=...
+    """
+    if not current_user.is_admin:
+        return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+    try:
+        report = usage_report(period=request.args.get('period', 'day'),
+                              days=int(request.args.get('days', 30)),
+                              group_by=request.args.get('group_by', 'model'),
+                              user_id=request.args.get('user_id'))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    return jsonify(dict(report, status='ok'))
 
 
 @dms_chat.route('/save_chat', methods=['POST'])
 @login_required
 def save_chat():
+    """
+    Buffers the conversation in the write-behind buffer and answers at once; repeated
+    saves of the same chat within the flush interval are written only once.
+    """
     chat_started = request.form.get('chat_started')
     messages = request.form.get('messages')
-    
-    print(f"[DEBUG] Saving chat for user {current_user.id} started at {chat_started}")
-    print(f"[DEBUG] Messages to save: {messages}")
 
-    chat_history = History.objects(user_id=str(current_user.id),
-                                 chat_started=chat_started)
-    print(f"[DEBUG] Found {len(chat_history)} existing chat(s)")
-    
-    if len(chat_history) == 1:
-        print("[DEBUG] Updating existing chat")
-        chat_history = chat_history[0]
-        chat_history.messages = messages
-        
-        # Parse messages once
-        parsed_messages = json.loads(messages)
-        
-        # Update first message if we find a user message and current first message is default
-        if chat_history.first_message == "Neuer Chat":
-            for msg in parsed_messages:
-                if msg.get('role') == 'user' and isinstance(msg.get('content'), str):
-                    chat_history.first_message = msg['content']
-                    print(f"[DEBUG] Updated first message to: {msg['content']}")
-                    break
-        
-        # Collect file IDs
-        file_ids = []
-        for msg in parsed_messages:
-            if 'attachments' in msg:
-                for attachment in msg['attachments']:
-                    file_ids.append(attachment['id'])
-        chat_history.file_ids = file_ids
-        chat_history.save()
-        return 'Chat aktualisiert!'
-    else:
-        print("[DEBUG] Creating new chat")
-        chat_history = History()
-        chat_history.user_id = str(current_user.id)
-        chat_history.chat_started = chat_started
-        chat_history.messages = messages
-        chat_history.first_message = "Neuer Chat"  # Set default title
-        
-        # Parse messages once
-        parsed_messages = json.loads(messages)
-        
-        # Set first message to first user message if one exists
-        for msg in parsed_messages:
-            if msg.get('role') == 'user' and isinstance(msg.get('content'), str):
-                chat_history.first_message = msg['content']
-                print(f"[DEBUG] Set first message to: {msg['content']}")
-                break
-        
-        # Collect file IDs
-        file_ids = []
-        for msg in parsed_messages:
-            if 'attachments' in msg:
-                for attachment in msg['attachments']:
-                    file_ids.append(attachment['id'])
-        chat_history.file_ids = file_ids
-        
-        chat_history.save()
-        print(f"[DEBUG] New chat created with first message: {chat_history.first_message}")
-        return 'Neuer Chat erstellt!'
+    logger.debug("Saving chat for user %s started at %s", current_user.id, chat_started)
+    logger.debug("Messages to save: %s characters", len(messages or ''))
+
+    try:
+        write_behind.save_history(str(current_user.id), int(chat_started), messages)
+    except (TypeError, ValueError) as e:
+        logger.warning("Invalid chat save request: %s", e)
+        return 'Ungültige Chat-Daten', 400
+    return 'Chat gespeichert!'
 
 
 # @dms_chat.route('/chat/list_chat_history', methods=['GET'])
@@ -235,17 +258,17 @@ def load_ui(template):
 def upload_chat_file():
     try:
         if 'file' not in request.files:
-            print("[DEBUG] No file part in request")
+            logger.debug("No file part in request")
             return jsonify({'status': 'error', 'message': 'No file part'}), 400
         
         file = request.files['file']
         if not file or not file.filename:
-            print("[DEBUG] No file selected")
+            logger.debug("No file selected")
             return jsonify({'status': 'error', 'message': 'No file selected'}), 400
             
-        print(f"[DEBUG] Processing upload for file: {file.filename}")
+        logger.debug("Processing upload for file: %s", file.filename)
         result = upload_file(file)
-        print(f"[DEBUG] Upload result: {result}")
+        logger.debug("Upload result: %s", result)
         
         if result.get('status') == 'ok':
             # Add file metadata to the response
@@ -256,15 +279,15 @@ def upload_chat_file():
                 'file_type': result['file_type'],  # Use file_type from response
                 'timestamp': int(time.time())
             }
-            print(f"[DEBUG] Returning successful response: {result}")
+            logger.debug("Returning successful response: %s", result)
             return jsonify(result)
         else:
-            print(f"[DEBUG] Upload failed: {result.get('message', 'Unknown error')}")
+            logger.warning("Upload failed: %s", result.get('message', 'Unknown error'))
             return jsonify(result), 400
             
     except Exception as e:
         error_msg = f"Upload error: {str(e)}"
-        print(f"[DEBUG] {error_msg}")
+        logger.error("%s", error_msg)
         return jsonify({'status': 'error', 'message': error_msg}), 500
 
 @dms_chat.route('/nav_items', methods=['GET'])
@@ -285,7 +308,7 @@ def delete_all_history():
     try:
         # Get base path for constructing absolute paths
         base_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        print(f"[DEBUG] Base path for deletion: {base_path}")
+        logger.debug("Base path for deletion: %s", base_path)
         
         # Get all prompts' file IDs to preserve them
         all_prompts = Prompt.objects()
@@ -295,26 +318,29 @@ def delete_all_history():
             prompt_files = File.objects(document_id=str(prompt.id))
             for file in prompt_files:
                 preserved_file_ids.add(str(file.id))
-        print(f"[DEBUG] Found {len(preserved_file_ids)} files to preserve from prompts")
+        logger.debug("Found %s files to preserve from prompts", len(preserved_file_ids))
         
+        # Write buffered saves first, they would bring deleted chats back otherwise
+        write_behind.flush()
+
         # Delete all history documents for the current user
         histories = History.objects(user_id=str(current_user.id))
-        print(f"[DEBUG] Found {histories.count()} history documents for user {current_user.id}")
+        logger.debug("Found %s history documents for user %s", histories.count(), current_user.id)
         deleted_count = 0
         failed_count = 0
         preserved_count = 0
         
         for history in histories:
             try:
-                print(f"[DEBUG] Processing history document: {history.id}")
-                print(f"[DEBUG] File IDs to process: {history.file_ids}")
+                logger.debug("Processing history document: %s", history.id)
+                logger.debug("File IDs to process: %s", history.file_ids)
                 
                 # Process associated files first
                 for file_id in history.file_ids:
                     try:
                         # Skip if file is used by a prompt
                         if file_id in preserved_file_ids:
-                            print(f"[DEBUG] Preserving file {file_id} as it's used by a prompt")
+                            logger.debug("Preserving file %s as it's used by a prompt", file_id)
                             preserved_count += 1
                             continue
                             
@@ -322,32 +348,32 @@ def delete_all_history():
                         if file_doc:
                             # Check if user has permission to delete this file
                             if not file_doc.can_access(current_user):
-                                print(f"[DEBUG] Access denied for file deletion: {file_id}")
+                                logger.warning("Access denied for file deletion: %s", file_id)
                                 continue
                                 
                             # Construct absolute path using the relative path stored in DB
                             file_path = os.path.join(base_path, file_doc.path, f"{str(file_id)}.{file_doc.file_type}")
-                            print(f"[DEBUG] Attempting to delete file: {file_path}")
+                            logger.debug("Attempting to delete file: %s", file_path)
                             
                             # Delete file from disk if it exists
                             if os.path.exists(file_path):
                                 os.remove(file_path)
-                                print(f"[DEBUG] Successfully deleted file from disk: {file_path}")
+                                logger.debug("Successfully deleted file from disk: %s", file_path)
                             
                             # Delete file document from database
                             file_doc.delete()
-                            print(f"[DEBUG] Successfully deleted file document from database: {file_id}")
+                            logger.debug("Successfully deleted file document from database: %s", file_id)
                     except Exception as e:
-                        print(f"[DEBUG] Error deleting file {file_id}: {str(e)}")
+                        logger.error("Error deleting file %s: %s", file_id, e)
                         failed_count += 1
                 
                 # Delete the history document
                 history.delete()
                 deleted_count += 1
-                print(f"[DEBUG] Successfully deleted history: {history.id}")
+                logger.debug("Successfully deleted history: %s", history.id)
                 
             except Exception as e:
-                print(f"[DEBUG] Error processing history {history.id}: {str(e)}")
+                logger.error("Error processing history %s: %s", history.id, e)
                 failed_count += 1
                 continue
         
@@ -360,7 +386,7 @@ def delete_all_history():
         })
         
     except Exception as e:
-        print(f"[DEBUG] Error in delete_all_history: {str(e)}")
+        logger.error("Error in delete_all_history: %s", e)
         return jsonify({
             'status': 'error',
             'message': f'Error deleting history: {str(e)}'
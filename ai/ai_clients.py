@@ -0,0 +1,159 @@
+import os
+import threading
+
+import httpx
+from openai import OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAI
+import anthropic
+
+from core.logger import get_logger
+
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = get_logger(__name__)
+
+openai_api_key=os.getenv("OPENAI_API_KEY")
+together_api_key=os.getenv("TOGETHER_API_KEY")
+anthropic_api_key=os.getenv("ANTHROPIC_API_KEY")
+deepseek_api_key=os.getenv("DEEPSEEK_API_KEY")
+perplexity_api_key=os.getenv("PERPLEXITY_API_KEY")
+
+azure_api_version = os.getenv('AZURE_API_VERSION_SE_02')
+azure_api_key = os.getenv('AZURE_API_KEY_MN_SE_02')
+azure_endpoint = os.getenv('AZURE_API_BASE_MN_SE_02')
+azure_deployment = os.getenv('AZURE_API_MODEL_MN_SE_02')
+
+# Local stub server for load tests, see ai/ai_fake_server.py
+fake_base_url = os.getenv('FAKE_LLM_BASE_URL', 'http://127.0.0.1:8099')
+
+# Connection pool settings shared by all provider clients
+pool_max_connections = int(os.getenv('LLM_POOL_MAX_CONNECTIONS', '100'))
+pool_max_keepalive = int(os.getenv('LLM_POOL_MAX_KEEPALIVE', '20'))
+pool_keepalive_expiry = float(os.getenv('LLM_POOL_KEEPALIVE_EXPIRY', '60'))
+connect_timeout = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+read_timeout = float(os.getenv('LLM_READ_TIMEOUT', '600'))
+
+# OpenAI compatible endpoints, keyed by provider name
+OPENAI_COMPATIBLE = {
+    'together': {'api_key': together_api_key, 'base_url': 'https://api.together.xyz/v1'},
+    'deepseek': {'api_key': deepseek_api_key, 'base_url': 'https://api.deepseek.com'},
+    'perplexity': {'api_key': perplexity_api_key, 'base_url': 'https://api.perplexity.ai'},
+    'openai': {'api_key': openai_api_key, 'base_url': None},
+    'fake': {'api_key': 'fake', 'base_url': f'{fake_base_url}/v1'},
+}
+
+# Providers that speak the Anthropic messages API
+ANTHROPIC_PROVIDERS = ['anthropic', 'fake_anthropic']
+
+_clients = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+def _limits():
+    return httpx.Limits(max_connections=pool_max_connections,
+                        max_keepalive_connections=pool_max_keepalive,
+                        keepalive_expiry=pool_keepalive_expiry)
+
+
+def _timeout():
+    return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+
+def _endpoint(provider):
+    """Returns the endpoint a provider client talks to, used as part of the registry key."""
+    if provider == 'azure':
+        return azure_endpoint
+    if provider == 'anthropic':
+        return 'https://api.anthropic.com'
+    if provider == 'fake_anthropic':
+        return fake_base_url
+    if provider in OPENAI_COMPATIBLE:
+        return OPENAI_COMPATIBLE[provider]['base_url'] or 'https://api.openai.com/v1'
+    raise ValueError(f"Unknown provider: {provider}")
+
+
+def _create_client(provider):
+    http_client = httpx.Client(limits=_limits(), timeout=_timeout())
+    if provider == 'anthropic':
+        return anthropic.Anthropic(api_key=anthropic_api_key, http_client=http_client)
+    if provider == 'fake_anthropic':
+        return anthropic.Anthropic(api_key='fake', base_url=fake_base_url, http_client=http_client)
+    if provider == 'azure':
+        return AzureOpenAI(azure_endpoint=azure_endpoint, api_key=azure_api_key,
+                           api_version=azure_api_version, http_client=http_client)
+    config = OPENAI_COMPATIBLE[provider]
+    return OpenAI(api_key=config['api_key'], base_url=config['base_url'], http_client=http_client)
+
+
+def _create_async_client(provider):
+    http_client = httpx.AsyncClient(limits=_limits(), timeout=_timeout())
+    if provider == 'anthropic':
+        return anthropic.AsyncAnthropic(api_key=anthropic_api_key, http_client=http_client)
+    if provider == 'fake_anthropic':
+        return anthropic.AsyncAnthropic(api_key='fake', base_url=fake_base_url, http_client=http_client)
+    if provider == 'azure':
+        return AsyncAzureOpenAI(azure_endpoint=azure_endpoint, api_key=azure_api_key,
+                                api_version=azure_api_version, http_client=http_client)
+    config = OPENAI_COMPATIBLE[provider]
+    return AsyncOpenAI(api_key=config['api_key'], base_url=config['base_url'], http_client=http_client)
+
+
+def reset_clients():
+    """
+    Forgets all pooled clients. Called in the child after a fork, because sockets
+    and locks inherited from the parent must not be shared between processes.
+    """
+    global _clients, _lock, _pid
+    _clients = {}
+    _lock = threading.Lock()
+    _pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_clients)
+
+
+def get_client(provider, use_async=False):
+    """
+    Returns the process wide client for a provider. Clients are created on first use
+    and keep their HTTP connection pool alive between calls. Async clients are used
+    by the ASGI streaming gateway and must only be used from its event loop.
+    """
+    if os.getpid() != _pid:
+        reset_clients()
+
+    key = (provider, _endpoint(provider), use_async)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _create_async_client(provider) if use_async else _create_client(provider)
+            _clients[key] = client
+    return client
+
+
+def get_async_client(provider):
+    return get_client(provider, use_async=True)
+
+
+def close_clients():
+    """Closes all pooled sync connections, e.g. on shutdown."""
+    with _lock:
+        for key in [key for key in _clients if not key[2]]:
+            try:
+                _clients.pop(key).close()
+            except Exception as e:
+                logger.error("Error closing client: %s", e)
+
+
+async def aclose_clients():
+    """Closes all pooled async connections, called when the ASGI server shuts down."""
+    for key in [key for key in _clients if key[2]]:
+        try:
+            await _clients.pop(key).close()
+        except Exception as e:
+            logger.error("Error closing async client: %s", e)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Output stage between the event stream of llm_call and the HTTP response.
+
+Providers send deltas of a few characters each. Written one by one, every delta is
+a separate write and often a separate TCP packet through the server and the proxy.
+This stage joins deltas into one frame until the frame has max_chars characters or
+the flush interval (a few milliseconds) has passed. The first delta is sent at once,
+so the time to first token does not change. Other events flush the frame and are
+passed on unchanged.
+
+The stage adapts to slow clients: when a write takes longer than the flush interval
+(the server blocks because the client doesn't read), the interval grows, so the next
+frame carries everything that arrived meanwhile in one write. It shrinks back once
+writes are fast again. A heartbeat event is sent when nothing was sent for a while.
+"""
+import os
+import math
+import time
+import queue
+import threading
+
+import anyio
+
+flush_interval = float(os.getenv('STREAM_COALESCE_MS', '20')) / 1000
+max_flush_interval = float(os.getenv('STREAM_COALESCE_MAX_MS', '250')) / 1000
+max_chars = int(os.getenv('STREAM_COALESCE_MAX_CHARS', '512'))
+heartbeat_seconds = float(os.getenv('STREAM_HEARTBEAT_SECONDS', '15'))
+
+HEARTBEAT_EVENT = ('heartbeat', {})
+
+# Marks the end of the upstream events in the queue
+DONE = object()
+
+
+class FrameBuffer:
+    """Collects delta text until the frame is full or its flush interval has passed."""
+    def __init__(self):
+        self.parts = []
+        self.chars = 0
+        self.opened = None
+        self.interval = flush_interval
+        self.sent_first = False
+
+    def add(self, text):
+        if not self.parts:
+            self.opened = time.time()
+        self.parts.append(text)
+        self.chars += len(text)
+
+    def pending(self):
+        return bool(self.parts)
+
+    def due(self):
+        if not self.parts:
+            return False
+        return (not self.sent_first or self.chars >= max_chars
+                or time.time() - self.opened >= self.interval)
+
+    def remaining(self):
+        """Seconds until the open frame must be sent."""
+        return max(0.0, self.opened + self.interval - time.time())
+
+    def take(self):
+        event = ('delta', {'text': ''.join(self.parts)})
+        self.parts = []
+        self.chars = 0
+        self.opened = None
+        self.sent_first = True
+        return event
+
+    def adapt(self, write_seconds):
+        """Grows the interval while writes block on a slow client, shrinks it when they are fast."""
+        if write_seconds > self.interval:
+            self.interval = min(max_flush_interval, max(self.interval * 2, write_seconds))
+        else:
+            self.interval = max(flush_interval, self.interval * 0.75)
+
+
+def _produce(events, items, stop):
+    """Pulls the upstream events in a background thread, so frames can be flushed on time."""
+    try:
+        for item in events:
+            items.put(item)
+            if stop.is_set():
+                break
+    except Exception as e:
+        items.put(e)
+    finally:
+        events.close()
+        items.put(DONE)
+
+
+def _flush(frame):
+    """Sends the open frame, adapts the interval to how long the write blocked."""
+    started = time.time()
+    yield frame.take()
+    finished = time.time()
+    frame.adapt(finished - started)
+    return finished
+
+
+def coalesced_stream(events):
+    """Coalesces the delta events of a sync event generator, see module docstring."""
+    if flush_interval <= 0:
+        yield from events
+        return
+
+    items = queue.Queue()
+    stop = threading.Event()
+    threading.Thread(target=_produce, args=(events, items, stop), daemon=True).start()
+
+    frame = FrameBuffer()
+    last_write = time.time()
+    try:
+        while True:
+            if frame.pending():
+                timeout = frame.remaining()
+            else:
+                timeout = max(0.0, last_write + heartbeat_seconds - time.time())
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is None:
+                if frame.pending():
+                    last_write = yield from _flush(frame)
+                else:
+                    yield HEARTBEAT_EVENT
+                    last_write = time.time()
+                continue
+
+            if isinstance(item, tuple) and item[0] == 'delta':
+                frame.add(item[1]['text'])
+                if frame.due():
+                    last_write = yield from _flush(frame)
+                continue
+
+            if frame.pending():
+                last_write = yield from _flush(frame)
+            if item is DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+            last_write = time.time()
+    finally:
+        stop.set()
+
+
+async def coalesce_async(events, emit):
+    """
+    Async output stage for the ASGI gateway: sends the events of an async generator
+    through emit(event, data), with deltas coalesced. Upstream errors are raised.
+    """
+    if flush_interval <= 0:
+        async for event, data in events:
+            await emit(event, data)
+        return
+
+    send_items, receive_items = anyio.create_memory_object_stream(math.inf)
+
+    async def produce():
+        async with send_items:
+            try:
+                async for item in events:
+                    await send_items.send(item)
+            except Exception as e:
+                await send_items.send(e)
+            finally:
+                # Runs the upstream cleanup (scheduler slot, provider stream) even when cancelled
+                with anyio.CancelScope(shield=True):
+                    await events.aclose()
+
+    async def write(event):
+        nonlocal last_write
+        started = time.time()
+        await emit(*event)
+        last_write = time.time()
+        return last_write - started
+
+    frame = FrameBuffer()
+    last_write = time.time()
+    async with anyio.create_task_group() as tasks:
+        tasks.start_soon(produce)
+        try:
+            while True:
+                if frame.pending():
+                    timeout = frame.remaining()
+                else:
+                    timeout = max(0.0, last_write + heartbeat_seconds - time.time())
+
+                item = None
+                with anyio.move_on_after(timeout):
+                    try:
+                        item = await receive_items.receive()
+                    except anyio.EndOfStream:
+                        item = DONE
+
+                if item is None:
+                    if frame.pending():
+                        frame.adapt(await write(frame.take()))
+                    else:
+                        await write(HEARTBEAT_EVENT)
+                    continue
+
+                if isinstance(item, tuple) and item[0] == 'delta':
+                    frame.add(item[1]['text'])
+                    if frame.due():
+                        frame.adapt(await write(frame.take()))
+                    continue
+
+                if frame.pending():
+                    frame.adapt(await write(frame.take()))
+                if item is DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                await write(item)
+        finally:
+            tasks.cancel_scope.cancel()
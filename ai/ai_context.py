@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Context window manager for llm_call.
+
+The chat client sends the whole conversation on every turn and prompt templates
+paste complete files into the system message. fit_messages() estimates the tokens
+of a request and trims it to the model's budget before it is sent:
+
+1. an oversized system message (usually file context) is cut to its share of the budget
+2. the oldest turns are dropped until the rest fits
+3. tool results of the agent loop (after the latest question) are cut
+4. as a last resort the latest message is cut
+
+The system message and the latest user message are always kept, together with the
+tool calls and results that follow it: a tool result without its call is rejected
+by the providers.
+"""
+import os
+import json
+
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+default_context_window = int(os.getenv('LLM_DEFAULT_CONTEXT_WINDOW', '32000'))
+budget_ratio = float(os.getenv('LLM_CONTEXT_BUDGET_RATIO', '0.9'))
+reserved_output_tokens = int(os.getenv('LLM_RESERVED_OUTPUT_TOKENS', '4000'))
+system_share = float(os.getenv('LLM_CONTEXT_SYSTEM_SHARE', '0.6'))
+
+# Context windows of the model families we use, Model.context_window_int overrides these
+CONTEXT_WINDOWS = {
+    'gpt4o': 128000,
+    'o1': 128000,
+    'sonar': 127000,
+    'deepseek': 128000,
+    'claude': 200000,
+}
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+TRUNCATION_NOTE = "\n\n[... gekürzt ...]"
+
+
+def estimate_tokens(content):
+    """Cheap token estimate, good enough to stay below the context window."""
+    if isinstance(content, str):
+        return len(content) // CHARS_PER_TOKEN + 1
+    if isinstance(content, list):
+        tokens = 0
+        for part in content:
+            if isinstance(part, dict) and part.get('type') == 'text':
+                tokens += estimate_tokens(part.get('text', ''))
+            elif isinstance(part, dict) and part.get('type') == 'tool_result':
+                tokens += estimate_tokens(part.get('content', ''))
+            elif isinstance(part, dict) and part.get('type') == 'tool_use':
+                tokens += estimate_tokens(json.dumps(part.get('input'), ensure_ascii=False))
+            else:
+                # Images and other parts, providers charge roughly this for a small image
+                tokens += 85
+        return tokens
+    return estimate_tokens(str(content))
+
+
+def message_tokens(message):
+    tokens = estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD_TOKENS
+    for call in message.get('tool_calls') or []:
+        tokens += estimate_tokens(call['function']['arguments'] or '')
+    return tokens
+
+
+def is_tool_message(message):
+    """Tool calls of the model and tool results (OpenAI tool_calls and role 'tool', Anthropic blocks)."""
+    if message.get('role') == 'tool' or message.get('tool_calls'):
+        return True
+    content = message.get('content')
+    return isinstance(content, list) and any(
+        isinstance(part, dict) and part.get('type') in ('tool_use', 'tool_result') for part in content)
+
+
+def latest_question(messages, first):
+    """Index of the latest user message that starts a turn, not a tool result or a note after one."""
+    for index in range(len(messages) - 1, first, -1):
+        message = messages[index]
+        if message.get('role') == 'user' and not is_tool_message(message) and not is_tool_message(messages[index - 1]):
+            return index
+    return first if len(messages) > first else len(messages) - 1
+
+
+def tool_results(messages):
+    """(container, key) of every text tool result, the containers are copies that may be changed."""
+    results = []
+    for message in messages:
+        if message.get('role') == 'tool' and isinstance(message.get('content'), str):
+            results.append((message, 'content'))
+        elif is_tool_message(message) and isinstance(message.get('content'), list):
+            message['content'] = [dict(part) if isinstance(part, dict) else part for part in message['content']]
+            results += [(part, 'content') for part in message['content']
+                        if isinstance(part, dict) and part.get('type') == 'tool_result'
+                        and isinstance(part.get('content'), str)]
+    return results
+
+
+def context_window(model):
+    if model.get('context_window_int'):
+        return int(model['context_window_int'])
+    family = model.get('model_family', '')
+    if family in CONTEXT_WINDOWS:
+        return CONTEXT_WINDOWS[family]
+    if model.get('provider') == 'anthropic':
+        return CONTEXT_WINDOWS['claude']
+    return default_context_window
+
+
+def context_budget(model):
+    """Tokens available for the request itself, after leaving room for the answer."""
+    if model.get('context_budget_int'):
+        return int(model['context_budget_int'])
+    return max(1000, int(context_window(model) * budget_ratio) - reserved_output_tokens)
+
+
+def truncate_text(text, max_tokens):
+    # estimate_tokens rounds up, so the cut text counts as at most max_tokens
+    max_chars = max(0, (max_tokens - 1) * CHARS_PER_TOKEN - len(TRUNCATION_NOTE))
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars] + TRUNCATION_NOTE
+
+
+def fit_messages(messages, model):
+    """Returns a copy of messages that fits the model's context budget."""
+    budget = context_budget(model)
+    fitted = [dict(message) for message in messages]
+    total = sum(message_tokens(m) for m in fitted)
+    if total <= budget:
+        return fitted
+
+    logger.debug("Request for %s has ~%s tokens, budget is %s, trimming", model.get('model'), total, budget)
+
+    # 1. Cut oversized file context in the system message
+    if fitted and fitted[0].get('role') == 'system' and isinstance(fitted[0].get('content'), str):
+        max_system = int(budget * system_share)
+        if message_tokens(fitted[0]) > max_system:
+            fitted[0]['content'] = truncate_text(fitted[0]['content'], max_system - MESSAGE_OVERHEAD_TOKENS)
+            total = sum(message_tokens(m) for m in fitted)
+
+    # 2. Drop the oldest turns, keeping the system message and the latest question with its tool calls
+    first = 1 if fitted and fitted[0].get('role') == 'system' else 0
+    keep = latest_question(fitted, first)
+    while total > budget and keep > first:
+        total -= message_tokens(fitted.pop(first))
+        keep -= 1
+    # Conversations must continue with a user message (not a tool result) after the system message
+    while keep > first and (fitted[first].get('role') != 'user' or is_tool_message(fitted[first])):
+        total -= message_tokens(fitted.pop(first))
+        keep -= 1
+
+    # 3. Cut the tool results of the agent loop, each by the same share
+    if total > budget:
+        results = tool_results(fitted[keep:])
+        result_tokens = sum(estimate_tokens(container[key]) for container, key in results)
+        if result_tokens:
+            share = max(0.0, 1 - (total - budget) / result_tokens)
+            for container, key in results:
+                container[key] = truncate_text(container[key], max(100, int(estimate_tokens(container[key]) * share)))
+            total = sum(message_tokens(m) for m in fitted)
+
+    # 4. Cut the latest message itself
+    if total > budget and isinstance(fitted[-1].get('content'), str):
+        available = budget - (total - message_tokens(fitted[-1])) - MESSAGE_OVERHEAD_TOKENS
+        fitted[-1]['content'] = truncate_text(fitted[-1]['content'], max(available, 100))
+
+    return fitted
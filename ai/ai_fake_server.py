@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stub of the OpenAI and Anthropic APIs (and of the web search) for load tests without real tokens.
+
+    python ai/ai_fake_server.py                  # listens on 127.0.0.1:8099
+    uvicorn ai.ai_fake_server:application --port 8099
+
+Serves POST /v1/chat/completions (OpenAI) and POST /v1/messages (Anthropic), streaming
+and non-streaming, with generated answers. The providers 'fake' and 'fake_anthropic'
+talk to it (FAKE_LLM_BASE_URL).
+
+Behaviour comes from the environment and can be overridden per request in the model
+name, e.g. model 'fake:ttft=0.2,tps=80,tokens=300,fail=0.05':
+
+- ttft:   seconds until the first token (FAKE_LLM_TTFT, default 0.3)
+- tps:    tokens per second after that (FAKE_LLM_TPS, default 50)
+- tokens: answer length in tokens (FAKE_LLM_TOKENS, default 200)
+- fail:   share of requests answered with an HTTP error (FAKE_LLM_FAILURE_RATE, default 0)
+- status: HTTP status of those errors (FAKE_LLM_FAILURE_STATUS, default 500)
+- cut:    share of streams that break off halfway (FAKE_LLM_CUT_RATE, default 0)
+
+For ai_search.py it serves GET /customsearch/v1 (SEARCH_API_URL=http://127.0.0.1:8099/customsearch/v1)
+with results that link to GET /pages/<n>, HTML pages about the query. Query parameters
+of the search set the page behaviour: delay (seconds until a page answers) and
+fail (share of pages answered with 500). The pages are local, set
+SEARCH_ALLOW_PRIVATE_ADDRESSES=1 so ai_search.py fetches them.
+"""
+import os
+import sys
+import json
+import time
+import random
+import itertools
+from html import escape
+from urllib.parse import parse_qs, urlencode
+
+import anyio
+
+DEFAULTS = {
+    'ttft': float(os.getenv('FAKE_LLM_TTFT', '0.3')),
+    'tps': float(os.getenv('FAKE_LLM_TPS', '50')),
+    'tokens': int(os.getenv('FAKE_LLM_TOKENS', '200')),
+    'fail': float(os.getenv('FAKE_LLM_FAILURE_RATE', '0')),
+    'status': int(os.getenv('FAKE_LLM_FAILURE_STATUS', '500')),
+    'cut': float(os.getenv('FAKE_LLM_CUT_RATE', '0')),
+}
+
+WORDS = ("Lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua Ut enim ad minim veniam quis nostrud").split()
+
+_ids = itertools.count(1)
+
+
+def model_options(model_name):
+    """Merges the defaults with 'key=value' options after the ':' of the model name."""
+    options = dict(DEFAULTS)
+    if ':' in model_name:
+        for part in model_name.split(':', 1)[1].split(','):
+            key, _, value = part.partition('=')
+            if key in options and value:
+                options[key] = type(DEFAULTS[key])(value)
+    return options
+
+
+def count_tokens(messages, system=None):
+    chars = len(json.dumps(system or '')) + sum(len(json.dumps(m.get('content', ''))) for m in messages)
+    return chars // 4 + 1
+
+
+async def tokens(options):
+    """Yields the answer token by token at the configured pace."""
+    await anyio.sleep(options['ttft'])
+    delay = 1.0 / options['tps'] if options['tps'] > 0 else 0
+    for i in range(options['tokens']):
+        if i:
+            await anyio.sleep(delay)
+        yield (' ' if i else '') + WORDS[i % len(WORDS)]
+
+
+def answer_text(options):
+    return ' '.join(WORDS[i % len(WORDS)] for i in range(options['tokens']))
+
+
+async def read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body or b'{}')
+
+
+async def send_json(send, status, data):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(data).encode('utf-8')})
+
+
+async def start_stream(send):
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+
+
+async def send_event(send, data, event=None):
+    prefix = f"event: {event}\n" if event else ''
+    await send({'type': 'http.response.body', 'body': f"{prefix}data: {data}\n\n".encode('utf-8'),
+                'more_body': True})
+
+
+async def end_stream(send):
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def openai_completions(request, send):
+    options = model_options(request.get('model', ''))
+    if random.random() < options['fail']:
+        await send_json(send, options['status'],
+                        {'error': {'message': 'Injected failure', 'type': 'server_error', 'code': None}})
+        return
+
+    completion_id = f"chatcmpl-fake-{next(_ids)}"
+    created = int(time.time())
+    prompt_tokens = count_tokens(request.get('messages', []))
+    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': options['tokens'],
+             'total_tokens': prompt_tokens + options['tokens'],
+             'prompt_tokens_details': {'cached_tokens': 0}}
+
+    if not request.get('stream'):
+        await anyio.sleep(options['ttft'] + (options['tokens'] / options['tps'] if options['tps'] > 0 else 0))
+        await send_json(send, 200, {
+            'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': request['model'],
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer_text(options)},
+                         'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+        return
+
+    def chunk(delta, finish_reason=None):
+        return json.dumps({'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                           'model': request['model'],
+                           'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]})
+
+    cut_at = options['tokens'] // 2 if random.random() < options['cut'] else None
+    await start_stream(send)
+    index = 0
+    async for token in tokens(options):
+        if index == cut_at:
+            await end_stream(send)
+            return
+        await send_event(send, chunk({'role': 'assistant', 'content': token} if index == 0 else {'content': token}))
+        index += 1
+    await send_event(send, chunk({}, 'stop'))
+    if (request.get('stream_options') or {}).get('include_usage'):
+        await send_event(send, json.dumps({'id': completion_id, 'object': 'chat.completion.chunk',
+                                           'created': created, 'model': request['model'],
+                                           'choices': [], 'usage': usage}))
+    await send_event(send, '[DONE]')
+    await end_stream(send)
+
+
+async def anthropic_messages(request, send):
+    options = model_options(request.get('model', ''))
+    if random.random() < options['fail']:
+        await send_json(send, options['status'],
+                        {'type': 'error', 'error': {'type': 'api_error', 'message': 'Injected failure'}})
+        return
+
+    message_id = f"msg_fake_{next(_ids)}"
+    input_tokens = count_tokens(request.get('messages', []), request.get('system'))
+
+    if not request.get('stream'):
+        await anyio.sleep(options['ttft'] + (options['tokens'] / options['tps'] if options['tps'] > 0 else 0))
+        await send_json(send, 200, {
+            'id': message_id, 'type': 'message', 'role': 'assistant', 'model': request['model'],
+            'content': [{'type': 'text', 'text': answer_text(options)}],
+            'stop_reason': 'end_turn', 'stop_sequence': None,
+            'usage': {'input_tokens': input_tokens, 'output_tokens': options['tokens']},
+        })
+        return
+
+    async def event(name, data):
+        await send_event(send, json.dumps(dict(data, type=name)), event=name)
+
+    cut_at = options['tokens'] // 2 if random.random() < options['cut'] else None
+    await start_stream(send)
+    await event('message_start', {'message': {
+        'id': message_id, 'type': 'message', 'role': 'assistant', 'model': request['model'], 'content': [],
+        'stop_reason': None, 'stop_sequence': None,
+        'usage': {'input_tokens': input_tokens, 'output_tokens': 1}}})
+    await event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+    index = 0
+    async for token in tokens(options):
+        if index == cut_at:
+            await end_stream(send)
+            return
+        await event('content_block_delta', {'index': 0, 'delta': {'type': 'text_delta', 'text': token}})
+        index += 1
+    await event('content_block_stop', {'index': 0})
+    await event('message_delta', {'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                  'usage': {'output_tokens': options['tokens']}})
+    await event('message_stop', {})
+    await end_stream(send)
+
+
+def query_params(scope):
+    return {key: values[0] for key, values in parse_qs(scope.get('query_string', b'').decode('latin-1')).items()}
+
+
+def base_url(scope):
+    headers = dict(scope.get('headers') or [])
+    host = headers.get(b'host', b'127.0.0.1:8099').decode('latin-1')
+    return f"{scope.get('scheme', 'http')}://{host}"
+
+
+async def custom_search(scope, send):
+    """Google Custom Search response with num results linking to /pages/<n>."""
+    params = query_params(scope)
+    query = params.get('q', '')
+    start = int(params.get('start', '0') or 0)
+    page_options = urlencode({'q': query, 'delay': params.get('delay', '0'), 'fail': params.get('fail', '0')})
+    items = []
+    for n in range(start + 1, start + int(params.get('num', '10')) + 1):
+        items.append({'link': f"{base_url(scope)}/pages/{n}?{page_options}", 'title': f"{query} - Seite {n}",
+                      'snippet': f"Kurzfassung {n} zu {query}", 'displayLink': '127.0.0.1'})
+    await send_json(send, 200, {'items': items})
+
+
+async def fake_page(scope, send):
+    params = query_params(scope)
+    await anyio.sleep(float(params.get('delay', '0') or 0))
+    if random.random() < float(params.get('fail', '0') or 0):
+        await send_json(send, 500, {'error': {'message': 'Injected failure'}})
+        return
+    n = scope['path'].rsplit('/', 1)[-1]
+    query = escape(params.get('q', ''))
+    html = (f"<html><head><title>{query} {n}</title><script>var x = 1;</script></head><body>"
+            f"<nav>Menü</nav><h1>{query}</h1><p>Seite {n}: {' '.join(WORDS)}</p>"
+            f"<footer>Impressum</footer></body></html>")
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/html; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': html.encode('utf-8')})
+
+
+GET_ROUTES = {
+    '/customsearch/v1': custom_search,
+}
+
+ROUTES = {
+    '/v1/chat/completions': openai_completions,
+    '/chat/completions': openai_completions,
+    '/v1/messages': anthropic_messages,
+}
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    if scope['method'] == 'GET':
+        if scope['path'].startswith('/pages/'):
+            await fake_page(scope, send)
+        elif scope['path'] in GET_ROUTES:
+            await GET_ROUTES[scope['path']](scope, send)
+        else:
+            await send_json(send, 404, {'error': {'message': f"Unknown route {scope['path']}"}})
+        return
+
+    handler = ROUTES.get(scope['path'])
+    if handler is None or scope['method'] != 'POST':
+        await send_json(send, 404, {'error': {'message': f"Unknown route {scope['path']}"}})
+        return
+    try:
+        request = await read_json(receive)
+    except ValueError:
+        await send_json(send, 400, {'error': {'message': 'Invalid JSON'}})
+        return
+    await handler(request, send)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else int(os.getenv('FAKE_LLM_PORT', '8099'))
+    uvicorn.run(application, host='127.0.0.1', port=port, log_level='warning')
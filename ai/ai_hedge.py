@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Hedged requests across equivalent model deployments.
+
+A model with a 'hedge_model' sends a duplicate request to that deployment if its own
+first token does not arrive within the hedge_percentile_int percentile of its recent
+time-to-first-token. The first stream to produce a chunk wins and the provider
+response of the other one is closed at once through its own CancelToken.
+
+The hedge request takes a scheduler slot of the hedge deployment like any other
+request. A late primary is only hedged if a slot is free right away; a failed
+primary waits for one.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+from ai.ai_scheduler import scheduler, SchedulerError
+from ai.ai_streams import CancelToken
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+default_deadline = float(os.getenv('LLM_HEDGE_DEFAULT_DEADLINE', '3'))
+default_percentile = int(os.getenv('LLM_HEDGE_PERCENTILE', '95'))
+min_samples = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+
+SAMPLE_WINDOW = 500
+
+# Marks the end of an attempt in the queue
+DONE = object()
+
+
+def hedge_enabled(model):
+    return bool(model.get('hedge_model')) and model.get('hedge_model') != model.get('model')
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+class HedgeStats:
+    """
+    Keeps per-model TTFT samples of the primary deployment (what users would see
+    without hedging) and of the effective TTFT with hedging, plus counters.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._primary = {}
+        self._effective = {}
+        self._counters = {}
+
+    def _samples(self, store, key):
+        return store.setdefault(key, deque(maxlen=SAMPLE_WINDOW))
+
+    def record_primary(self, key, ttft):
+        with self._lock:
+            self._samples(self._primary, key).append(ttft)
+
+    def record_effective(self, key, ttft, hedged, hedge_won):
+        with self._lock:
+            self._samples(self._effective, key).append(ttft)
+            counters = self._counters.setdefault(key, {'requests': 0, 'hedged': 0, 'hedge_wins': 0})
+            counters['requests'] += 1
+            if hedged:
+                counters['hedged'] += 1
+            if hedge_won:
+                counters['hedge_wins'] += 1
+
+    def deadline(self, key, pct):
+        with self._lock:
+            samples = list(self._primary.get(key, []))
+        if len(samples) < min_samples:
+            return default_deadline
+        return percentile(samples, pct)
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for key, counters in self._counters.items():
+                primary_p99 = percentile(list(self._primary.get(key, [])), 99)
+                effective_p99 = percentile(list(self._effective.get(key, [])), 99)
+                saved = None
+                if primary_p99 is not None and effective_p99 is not None:
+                    saved = round(primary_p99 - effective_p99, 3)
+                result[key] = dict(counters, primary_p99_ttft=primary_p99,
+                                   effective_p99_ttft=effective_p99, p99_ttft_saved=saved)
+            return result
+
+
+hedge_stats = HedgeStats()
+
+
+def _run_attempt(attempt, stream_fn, messages, model, results, token, started, ticket=None):
+    """
+    Pulls one provider stream in a background thread and forwards its chunks. ticket is
+    the scheduler slot of a hedge request, it is waited for here and released at the end.
+    """
+    first = True
+    completion_chars = 0
+    generator = None
+    try:
+        if ticket is not None and ticket.started is None:
+            for position in scheduler.wait(ticket, token):
+                pass
+        generator = stream_fn(messages, model, token)
+        for chunk in generator:
+            if first:
+                first = False
+                if attempt == 0:
+                    hedge_stats.record_primary(model['model'], time.time() - started)
+            if token.cancelled:
+                break
+            if chunk[0] == 'delta':
+                completion_chars += len(chunk[1]['text'])
+            results.put((attempt, chunk))
+    except Exception as e:
+        results.put((attempt, e))
+    finally:
+        if generator is not None:
+            generator.close()
+        if ticket is not None:
+            scheduler.cancel(ticket)
+            scheduler.release(ticket, completion_chars)
+        results.put((attempt, DONE))
+
+
+def hedged_stream(messages, model, hedge_model, stream_fn, cancel=None):
+    """
+    Streams from model, and additionally from hedge_model if the first chunk is late.
+    stream_fn(messages, model, cancel) is the provider stream function, e.g. llm_call_stream;
+    cancel is the CancelToken of the whole stream, it cancels both attempts.
+    """
+    key = model['model']
+    pct = int(model.get('hedge_percentile_int') or default_percentile)
+    deadline = hedge_stats.deadline(key, pct)
+
+    started = time.time()
+    results = queue.Queue()
+    stream_id = cancel.stream_id if cancel else 'hedge'
+    tokens = [CancelToken(f"{stream_id}-primary"), CancelToken(f"{stream_id}-hedge")]
+    if cancel:
+        cancel.on_cancel(lambda: [token.cancel(cancel.reason) for token in tokens])
+    running = set()
+
+    def launch(attempt, attempt_model, ticket=None):
+        running.add(attempt)
+        threading.Thread(target=_run_attempt, daemon=True,
+                         args=(attempt, stream_fn, messages, attempt_model, results, tokens[attempt], started,
+                               ticket)).start()
+
+    def launch_hedge(wait):
+        """Starts the hedge request if it gets a scheduler slot, right away unless wait is set."""
+        try:
+            ticket = scheduler.enqueue(hedge_model, messages)
+        except SchedulerError as e:
+            logger.debug("Not hedging %s, no scheduler slot for %s: %s", key, hedge_model['model'], e)
+            return False
+        if not wait and scheduler.try_start(ticket) != 0:
+            scheduler.cancel(ticket)
+            logger.debug("Not hedging %s, %s is at its limits", key, hedge_model['model'])
+            return False
+        launch(1, hedge_model, ticket)
+        return True
+
+    launch(0, model)
+    winner = None
+    hedged = False
+    hedge_skipped = False
+    errors = []
+    try:
+        while True:
+            timeout = None
+            if winner is None and not hedged and not hedge_skipped:
+                timeout = max(0, started + deadline - time.time())
+            try:
+                attempt, item = results.get(timeout=timeout)
+            except queue.Empty:
+                logger.debug("Hedging %s with %s after %.2fs without first token", key, hedge_model['model'], deadline)
+                hedged = launch_hedge(wait=False)
+                hedge_skipped = not hedged
+                continue
+
+            if winner is None:
+                if item is DONE or isinstance(item, Exception):
+                    running.discard(attempt)
+                    if isinstance(item, Exception):
+                        errors.append(item)
+                        if not hedged:
+                            # Fail over to the equivalent deployment right away
+                            logger.warning("%s failed before first token, hedging with %s: %s", key, hedge_model['model'], item)
+                            hedged = launch_hedge(wait=True)
+                            if hedged:
+                                continue
+                    if running:
+                        continue
+                    if errors:
+                        raise errors[0]
+                    return
+                winner = attempt
+                tokens[1 - attempt].cancel('hedge_lost')
+                hedge_stats.record_effective(key, time.time() - started, hedged, attempt == 1)
+                if attempt == 1 and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Hedge request won for %s, stats: %s", key, hedge_stats.stats().get(key))
+
+            if attempt != winner:
+                continue
+            if item is DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        for token in tokens:
+            token.cancel('hedge_done')
@@ -7,7 +7,7 @@ import datetime
 # Add parent directory to Python path to find core module
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from core.db_document import Model
+from core.db_document import Model, bump_catalog_version
 from core.db_connect import *
 
 models = [
@@ -27,6 +27,8 @@ models = [
 
 # Delete existing models
 Model.objects.delete()
+# A queryset delete bypasses Model.delete(), invalidate the cached model catalogs here
+bump_catalog_version('model')
 
 # Current timestamp for creation date
 now = datetime.datetime.now()
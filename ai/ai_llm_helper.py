@@ -1,61 +1,220 @@
-import os,json,sys
-from openai import OpenAI
-from openai import AzureOpenAI
-import anthropic
-
-from dotenv import load_dotenv
-load_dotenv()
-openai_api_key=os.getenv("OPENAI_API_KEY")
-together_api_key=os.getenv("TOGETHER_API_KEY")
-anthropic_api_key=os.getenv("ANTHROPIC_API_KEY")
-deepseek_api_key=os.getenv("DEEPSEEK_API_KEY")
-perplexity_api_key=os.getenv("PERPLEXITY_API_KEY")
-
-azure_api_version = os.getenv('AZURE_API_VERSION_SE_02')
-azure_api_key = os.getenv('AZURE_API_KEY_MN_SE_02')
-azure_endpoint = os.getenv('AZURE_API_BASE_MN_SE_02')
-azure_deployment = os.getenv('AZURE_API_MODEL_MN_SE_02')
+import json
+
+from ai.ai_clients import get_client, get_async_client, ANTHROPIC_PROVIDERS
+from ai.ai_scheduler import scheduler, SchedulerError, QueueCancelled, PRIORITY_INTERACTIVE
+from ai.ai_cache import response_cache, cache_enabled, cache_key
+from ai.ai_context import fit_messages, estimate_tokens
+from ai.ai_hedge import hedged_stream, hedge_enabled
+from ai.ai_semantic_cache import (semantic_cache, prompt_settings, with_system_message, is_single_turn, cache_text,
+                                  last_user_message, embed, cache_scope)
+from ai.ai_metrics import CallMetrics
+from ai.ai_coalesce import coalesced_stream
+from ai.ai_streams import streams
+from ai.ai_write_behind import write_behind
+from ai.ai_usage import call_cost
+from ai.ai_models import model_catalog
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Events of the /chat/stream protocol, sent as text/event-stream:
+#   start      {"stream_id": "..."}      first event, the id for /chat/cancel/<stream_id>
+#   delta      {"text": "..."}          a piece of the answer
+#   usage      {"prompt_tokens": ...}    token usage, always the last event of an answer
+#   citations  {"citations": [...]}      sources, Perplexity only
+#   queue      {"position": 3}           queue position while waiting for a provider slot
+#   error      {"message": "..."}        the request failed
+#   heartbeat  {}                        keeps idle connections open
+EVENT_TYPES = ['start', 'delta', 'usage', 'citations', 'queue', 'error', 'heartbeat']
+
+def sse_event(event, data):
+    """Frames one event for the text/event-stream response."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+def start_event(stream_id):
+    return ('start', {'stream_id': stream_id})
+
+def delta_event(text):
+    return ('delta', {'text': text})
+
+def usage_event(usage_data):
+    return ('usage', usage_data or {})
+
+def queue_event(position):
+    """Tells the client its position in the provider queue while the request waits."""
+    return ('queue', {'position': position})
+
+def error_event(message):
+    return ('error', {'message': message})
+
+# Anthropic only caches prefixes from this size on, smaller cache_control blocks are ignored
+ANTHROPIC_MIN_CACHE_TOKENS = 1024
+
+# Providers that report usage in streams only when asked to with stream_options
+STREAM_USAGE_PROVIDERS = ['openai', 'azure']
+
+def anthropic_system(content):
+    """
+    Marks a large system message (e.g. a prompt with {context}) as cacheable, so
+    follow-up turns reuse the provider's prompt cache instead of re-reading it.
+    """
+    if isinstance(content, str) and estimate_tokens(content) >= ANTHROPIC_MIN_CACHE_TOKENS:
+        return [{'type': 'text', 'text': content, 'cache_control': {'type': 'ephemeral'}}]
+    return content
+
+def anthropic_usage(usage, output_tokens=0):
+    """Usage payload of an Anthropic response, including prompt cache reads and writes."""
+    cached_tokens = getattr(usage, 'cache_read_input_tokens', None) or 0
+    cache_creation_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    # input_tokens only counts the uncached part of the prompt
+    prompt_tokens = usage.input_tokens + cached_tokens + cache_creation_tokens
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': output_tokens,
+        'total_tokens': prompt_tokens + output_tokens,
+        'cached_tokens': cached_tokens,
+        'cache_creation_tokens': cache_creation_tokens
+    }
+
+def stream_options(model):
+    if model['provider'] in STREAM_USAGE_PROVIDERS:
+        return {'stream_options': {'include_usage': True}}
+    return {}
+
+def add_cached_tokens(usage_data):
+    """OpenAI and Azure cache prompt prefixes automatically, report the cached part flat."""
+    details = usage_data.get('prompt_tokens_details') or {}
+    usage_data['cached_tokens'] = details.get('cached_tokens') or 0
+    return usage_data
+
+BUSY_MESSAGE = "Der Dienst ist gerade ausgelastet, bitte versuche es gleich noch einmal."
+ERROR_MESSAGE = "Bei der Anfrage an das Modell ist ein Fehler aufgetreten."
+
+def o1_usage(response):
+    """Detailed usage data of a non-streaming O1 response."""
+    try:
+        usage_data = {
+            'completion_tokens': response.usage.completion_tokens,
+            'prompt_tokens': response.usage.prompt_tokens,
+            'total_tokens': response.usage.total_tokens
+        }
+
+        if getattr(response.usage, 'prompt_tokens_details', None) is not None:
+            usage_data['cached_tokens'] = getattr(response.usage.prompt_tokens_details, 'cached_tokens', 0) or 0
+
+        # Add detailed token information if available
+        if hasattr(response.usage, 'completion_tokens_details'):
+            usage_data['completion_tokens_details'] = {
+                'reasoning_tokens': getattr(response.usage.completion_tokens_details, 'reasoning_tokens', 0)
+            }
+        
+        # Add content filter results if available
+        if hasattr(response.choices[0], 'content_filter_results'):
+            usage_data['content_filter_results'] = response.choices[0].content_filter_results
+        
+        return usage_data
+    except Exception as e:
+        logger.error("Error extracting usage data: %s", e)
+        return None
+
+def final_events(line, usage_line=None):
+    """
+    Builds the citations and usage events from the last chunk of an OpenAI compatible stream.
+    usage_line is the usage-only chunk OpenAI and Azure send after the last choice.
+    """
+    events = []
+    try:
+        # Try to get data from model_dump or fallback to dictionary
+        try:
+            response_data = line.model_dump()
+            if response_data.get('citations'):
+                events.append(('citations', {'citations': response_data['citations']}))
+        except AttributeError:
+            pass
+        
+        # Build the final usage data
+        final_usage_data = {}
+        
+        # Traditional usage info
+        usage = getattr(usage_line or line, 'usage', None)
+        if usage is not None:
+            try:
+                usage_info = usage.model_dump()
+                final_usage_data.update(usage_info)
+            except AttributeError:
+                # Fallback for when model_dump is not available
+                if hasattr(usage, 'completion_tokens'):
+                    final_usage_data['completion_tokens'] = usage.completion_tokens
+                if hasattr(usage, 'prompt_tokens'):
+                    final_usage_data['prompt_tokens'] = usage.prompt_tokens
+                if hasattr(usage, 'total_tokens'):
+                    final_usage_data['total_tokens'] = usage.total_tokens
+            add_cached_tokens(final_usage_data)
+            
+        events.append(usage_event(final_usage_data))
+    except Exception as e:
+        logger.error("Error in final response processing: %s", e)
+        events.append(usage_event(None))
+    return events
+
+def sse_stream(events, token=None):
+    """
+    Encodes events for the response. Errors are sent as error event instead of cutting the stream.
+    With a CancelToken the stream starts with its id, and the server closing the generator
+    (the client disconnected) cancels the provider call.
+    """
+    try:
+        if token:
+            yield sse_event(*start_event(token.stream_id))
+        for event, data in events:
+            yield sse_event(event, data)
+    except GeneratorExit:
+        if token:
+            streams.disconnected(token)
+        raise
+    except Exception as e:
+        logger.error("Error while streaming: %s", e)
+        yield sse_event(*error_event(ERROR_MESSAGE))
+    finally:
+        events.close()
+        if token:
+            streams.finish(token)
 
 #Notice: I was not able to have a function with streaming (using yield) and no streaming (return) at the same time.
 
-def llm_call_stream(messages, model):
-    if model['provider'] == 'anthropic':
-        client = anthropic.Anthropic(api_key=anthropic_api_key)
+def llm_call_stream(messages, model, call=None, cancel=None):
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        client = get_client(model['provider'])
         response = client.messages.create(
             model=model['model'],
             max_tokens=1000,
             temperature=0,
-            system=messages[0]['content'],
+            system=anthropic_system(messages[0]['content']),
             messages=messages[1:],
             stream=True
         )
-        input_tokens = 0
+        if cancel:
+            # Cancelling closes the connection, the provider stops generating
+            cancel.on_cancel(response.close)
+        if call:
+            call.first_byte()
+        start_usage = None
         output_tokens = 0
-        accumulated_text = ""
-        for line in response:
-            print(line.type)
-            if line.type == 'message_start':
-                input_tokens = line.message.usage.input_tokens
-            elif line.type == 'message_delta':
-                output_tokens = line.usage.output_tokens
-            elif line.type == 'content_block_delta':
-                if line.delta.text:
-                    accumulated_text += line.delta.text
-                    yield line.delta.text.encode('utf-8')
-        if accumulated_text:
-            yield " ".encode('utf-8')
-        yield f"###STOP###{json.dumps({'prompt_tokens': input_tokens, 'completion_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens})}".encode('utf-8')
+        try:
+            for line in response:
+                if line.type == 'message_start':
+                    start_usage = line.message.usage
+                elif line.type == 'message_delta':
+                    output_tokens = line.usage.output_tokens
+                elif line.type == 'content_block_delta':
+                    if line.delta.text:
+                        yield delta_event(line.delta.text)
+        finally:
+            # Closing the response stops the provider from generating if we stop early
+            response.close()
+        yield usage_event(anthropic_usage(start_usage, output_tokens) if start_usage else None)
     else:
-        if model['provider']=='together':
-            client = OpenAI(api_key=together_api_key,base_url='https://api.together.xyz/v1')
-        elif model['provider']=='deepseek':
-            client = OpenAI(api_key=deepseek_api_key,base_url='https://api.deepseek.com')
-        elif model['provider']=='perplexity':
-            client = OpenAI(api_key=perplexity_api_key,base_url='https://api.perplexity.ai')
-        elif model['provider']=='openai':
-            client = OpenAI(api_key=openai_api_key)
-        elif model['provider']=='azure':
-            client = AzureOpenAI(azure_endpoint=azure_endpoint,api_key=azure_api_key,api_version=azure_api_version)
+        client = get_client(model['provider'])
 
         # Check if the model is an O1 model (o1-mini, o1-preview, etc.)
         is_o1_model = model['model'].startswith('o1-')
@@ -72,95 +231,135 @@ def llm_call_stream(messages, model):
                 model=model['model'],
                 messages=prepared_messages
             )
+            if call:
+                call.first_byte()
             # Handle non-streaming O1 response
             content = response.choices[0].message.content
-            yield content.encode('utf-8')
-            yield " ".encode('utf-8')
-            
-            # Extract detailed usage data from the response
-            try:
-                usage_data = {
-                    'completion_tokens': response.usage.completion_tokens,
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'total_tokens': response.usage.total_tokens
-                }
-                
-                # Add detailed token information if available
-                if hasattr(response.usage, 'completion_tokens_details'):
-                    usage_data['completion_tokens_details'] = {
-                        'reasoning_tokens': getattr(response.usage.completion_tokens_details, 'reasoning_tokens', 0)
-                    }
-                
-                # Add content filter results if available
-                if hasattr(response.choices[0], 'content_filter_results'):
-                    usage_data['content_filter_results'] = response.choices[0].content_filter_results
-                
-                yield f"###STOP###{json.dumps(usage_data)}".encode('utf-8')
-            except Exception as e:
-                print(f"Error extracting usage data: {e}")
-                yield "###STOP###null".encode('utf-8')
+            yield delta_event(content)
+            yield usage_event(o1_usage(response))
         else:
             # Use streaming for non-O1 models
+            # The message order is kept stable (system, then the conversation), so the
+            # provider's automatic prefix caching can reuse the system prompt
             response = client.chat.completions.create(
                 model=model['model'],
                 messages=messages,
-                stream=True
+                stream=True,
+                **stream_options(model)
             )
+            if cancel:
+                cancel.on_cancel(response.close)
+            if call:
+                call.first_byte()
             
-            accumulated_text = ""
-            citations = []
-            usage_data = {}
+            final_line = None
+            usage_line = None
             
-            for line in response:
-                # Skip empty chunks or chunks without choices
-                if not hasattr(line, 'choices') or len(line.choices) == 0:
-                    continue
-                    
-                # Handle content if present
-                if hasattr(line.choices[0], 'delta') and hasattr(line.choices[0].delta, 'content'):
-                    if line.choices[0].delta.content:
-                        accumulated_text += line.choices[0].delta.content
-                        yield line.choices[0].delta.content.encode('utf-8')
-                
-                # Handle completion
-                if hasattr(line.choices[0], 'finish_reason') and line.choices[0].finish_reason in ['eos', 'stop']:
-                    if accumulated_text:
-                        yield " ".encode('utf-8')
-                    try:
-                        # Try to get data from model_dump or fallback to dictionary
-                        try:
-                            response_data = line.model_dump()
-                            if 'citations' in response_data:
-                                citations = response_data['citations']
-                        except AttributeError:
-                            # If model_dump is not available, build usage data from what we've collected
-                            response_data = {}
-                        
-                        # Build the final usage data
-                        final_usage_data = {}
-                        
-                        # Traditional usage info
-                        if hasattr(line, 'usage'):
-                            try:
-                                usage_info = line.usage.model_dump()
-                                final_usage_data.update(usage_info)
-                            except AttributeError:
-                                # Fallback for when model_dump is not available
-                                if hasattr(line.usage, 'completion_tokens'):
-                                    final_usage_data['completion_tokens'] = line.usage.completion_tokens
-                                if hasattr(line.usage, 'prompt_tokens'):
-                                    final_usage_data['prompt_tokens'] = line.usage.prompt_tokens
-                                if hasattr(line.usage, 'total_tokens'):
-                                    final_usage_data['total_tokens'] = line.usage.total_tokens
+            try:
+                for line in response:
+                    # Usage arrives in a chunk without choices after the last one
+                    if getattr(line, 'usage', None) is not None:
+                        usage_line = line
+
+                    # Skip empty chunks or chunks without choices
+                    if not hasattr(line, 'choices') or len(line.choices) == 0:
+                        continue
                         
-                        # Add citations if found
-                        if citations:
-                            final_usage_data['citations'] = citations
-                            
-                        yield f"###STOP###{json.dumps(final_usage_data)}".encode('utf-8')
-                    except Exception as e:
-                        print(f"Error in final response processing: {e}")
-                        yield "###STOP###null".encode('utf-8')
+                    # Handle content if present
+                    if hasattr(line.choices[0], 'delta') and hasattr(line.choices[0].delta, 'content'):
+                        if line.choices[0].delta.content:
+                            yield delta_event(line.choices[0].delta.content)
+                    
+                    # Handle completion
+                    if hasattr(line.choices[0], 'finish_reason') and line.choices[0].finish_reason in ['eos', 'stop']:
+                        final_line = line
+            finally:
+                response.close()
+
+            if final_line is not None:
+                for event in final_events(final_line, usage_line):
+                    yield event
+
+async def llm_call_stream_async(messages, model, call=None):
+    """
+    Async counterpart of llm_call_stream used by the ASGI streaming gateway.
+    Yields the same events, but never blocks a thread while waiting for the provider.
+    """
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        client = get_async_client(model['provider'])
+        response = await client.messages.create(
+            model=model['model'],
+            max_tokens=1000,
+            temperature=0,
+            system=anthropic_system(messages[0]['content']),
+            messages=messages[1:],
+            stream=True
+        )
+        if call:
+            call.first_byte()
+        start_usage = None
+        output_tokens = 0
+        try:
+            async for line in response:
+                if line.type == 'message_start':
+                    start_usage = line.message.usage
+                elif line.type == 'message_delta':
+                    output_tokens = line.usage.output_tokens
+                elif line.type == 'content_block_delta':
+                    if line.delta.text:
+                        yield delta_event(line.delta.text)
+        finally:
+            # The gateway cancels the task on disconnect, closing stops the provider
+            await response.close()
+        yield usage_event(anthropic_usage(start_usage, output_tokens) if start_usage else None)
+    else:
+        client = get_async_client(model['provider'])
+
+        # O1 models don't support system messages or streaming
+        if model['model'].startswith('o1-'):
+            response = await client.chat.completions.create(
+                model=model['model'],
+                messages=prepare_messages_for_o1(messages)
+            )
+            if call:
+                call.first_byte()
+            content = response.choices[0].message.content
+            yield delta_event(content)
+            yield usage_event(o1_usage(response))
+        else:
+            response = await client.chat.completions.create(
+                model=model['model'],
+                messages=messages,
+                stream=True,
+                **stream_options(model)
+            )
+            if call:
+                call.first_byte()
+
+            final_line = None
+            usage_line = None
+
+            try:
+                async for line in response:
+                    if getattr(line, 'usage', None) is not None:
+                        usage_line = line
+
+                    # Skip empty chunks or chunks without choices
+                    if not hasattr(line, 'choices') or len(line.choices) == 0:
+                        continue
+
+                    if hasattr(line.choices[0], 'delta') and hasattr(line.choices[0].delta, 'content'):
+                        if line.choices[0].delta.content:
+                            yield delta_event(line.choices[0].delta.content)
+
+                    if hasattr(line.choices[0], 'finish_reason') and line.choices[0].finish_reason in ['eos', 'stop']:
+                        final_line = line
+            finally:
+                await response.close()
+
+            if final_line is not None:
+                for event in final_events(final_line, usage_line):
+                    yield event
 
 def prepare_messages_for_o1(messages):
     """
@@ -194,29 +393,29 @@ def prepare_messages_for_o1(messages):
     
     return prepared_messages
 
-def llm_call_no_stream(messages, model):
-    if model['provider'] == 'anthropic':
-        client = anthropic.Anthropic(api_key=anthropic_api_key)
+def completion_usage(usage):
+    """Usage payload of a non-streaming OpenAI compatible response."""
+    if usage is None:
+        return {}
+    usage_data = usage.model_dump() if hasattr(usage, 'model_dump') else dict(usage)
+    return add_cached_tokens(usage_data)
+
+def llm_complete(messages, model):
+    """Non-streaming call, returns the answer and its token usage."""
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        client = get_client(model['provider'])
         response = client.messages.create(
             model=model['model'],
             max_tokens=1000,
             temperature=0,
-            system=messages[0]['content'],
+            system=anthropic_system(messages[0]['content']),
             messages=messages[1:],
             stream=False
         )
-        return response.content[0].text
+        return {'text': response.content[0].text,
+                'usage': anthropic_usage(response.usage, response.usage.output_tokens)}
     else:
-        if model['provider']=='together':
-            client = OpenAI(api_key=together_api_key,base_url='https://api.together.xyz/v1')
-        elif model['provider']=='deepseek':
-            client = OpenAI(api_key=deepseek_api_key,base_url='https://api.deepseek.com')
-        elif model['provider']=='perplexity':
-            client = OpenAI(api_key=perplexity_api_key,base_url='https://api.perplexity.ai')
-        elif model['provider']=='openai':
-            client = OpenAI(api_key=openai_api_key)
-        elif model['provider']=='azure':
-            client = AzureOpenAI(azure_endpoint=azure_endpoint,api_key=azure_api_key,api_version=azure_api_version)
+        client = get_client(model['provider'])
 
         # Check if the model is an O1 model and handle system messages
         is_o1_model = model['model'].startswith('o1-')
@@ -234,9 +433,330 @@ def llm_call_no_stream(messages, model):
                 stream=False
             )
             
-        return response.choices[0].message.content
+        return {'text': response.choices[0].message.content,
+                'usage': completion_usage(getattr(response, 'usage', None))}
+
+def openai_tools(tools):
+    return [{'type': 'function', 'function': tool} for tool in tools]
+
+def anthropic_tools(tools):
+    return [{'name': tool['name'], 'description': tool['description'], 'input_schema': tool['parameters']}
+            for tool in tools]
+
+def tool_arguments(arguments):
+    """Arguments of an OpenAI tool call are a JSON string the model wrote, it may be broken."""
+    try:
+        parsed = json.loads(arguments or '{}')
+    except ValueError:
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+def llm_complete_tools(messages, model, tools, allow_calls=True):
+    """
+    Non-streaming call that lets the model call tools (definitions with name,
+    description and JSON schema parameters). Returns the answer text, the tool calls
+    [{'id', 'name', 'arguments'}], the usage and the assistant message that has to
+    precede the tool results in messages. With allow_calls=False the model must answer
+    in text; the tools are still sent, earlier tool calls in messages require them.
+    """
+    client = get_client(model['provider'])
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        response = client.messages.create(
+            model=model['model'],
+            max_tokens=1000,
+            temperature=0,
+            system=anthropic_system(messages[0]['content']),
+            messages=messages[1:],
+            tools=anthropic_tools(tools),
+            tool_choice={'type': 'auto' if allow_calls else 'none'},
+            stream=False
+        )
+        content = []
+        tool_calls = []
+        for block in response.content:
+            if block.type == 'text':
+                content.append({'type': 'text', 'text': block.text})
+            elif block.type == 'tool_use':
+                content.append({'type': 'tool_use', 'id': block.id, 'name': block.name, 'input': block.input})
+                tool_calls.append({'id': block.id, 'name': block.name, 'arguments': block.input or {}})
+        return {'text': ''.join(block['text'] for block in content if block['type'] == 'text'),
+                'tool_calls': tool_calls,
+                'usage': anthropic_usage(response.usage, response.usage.output_tokens),
+                'assistant_message': {'role': 'assistant', 'content': content}}
+
+    response = client.chat.completions.create(
+        model=model['model'],
+        messages=messages,
+        tools=openai_tools(tools),
+        tool_choice='auto' if allow_calls else 'none',
+        stream=False
+    )
+    message = response.choices[0].message
+    assistant_message = {'role': 'assistant', 'content': message.content}
+    tool_calls = []
+    if message.tool_calls:
+        assistant_message['tool_calls'] = [
+            {'id': call.id, 'type': 'function',
+             'function': {'name': call.function.name, 'arguments': call.function.arguments}}
+            for call in message.tool_calls
+        ]
+        tool_calls = [{'id': call.id, 'name': call.function.name, 'arguments': tool_arguments(call.function.arguments)}
+                      for call in message.tool_calls]
+    return {'text': message.content or '',
+            'tool_calls': tool_calls,
+            'usage': completion_usage(getattr(response, 'usage', None)),
+            'assistant_message': assistant_message}
+
+def tool_result_messages(model, results, note=None):
+    """
+    Messages that hand tool results [{'id', 'content'}] back to the model, in the
+    format of its provider. note is an additional instruction after the results.
+    """
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        content = [{'type': 'tool_result', 'tool_use_id': result['id'], 'content': result['content']}
+                   for result in results]
+        if note:
+            content.append({'type': 'text', 'text': note})
+        return [{'role': 'user', 'content': content}]
+    messages = [{'role': 'tool', 'tool_call_id': result['id'], 'content': result['content']} for result in results]
+    if note:
+        messages.append({'role': 'user', 'content': note})
+    return messages
+
+def llm_call_no_stream(messages, model):
+    return llm_complete(messages, model)['text']
 
-def llm_call(messages, model, stream=True):
+def hedge_target(model):
+    """Returns the equivalent deployment a model hedges to, or None if it doesn't exist."""
+    try:
+        return model_catalog.get(model['hedge_model'])
+    except Exception as e:
+        logger.warning("Could not load hedge model %s: %s", model['hedge_model'], e)
+        return None
+
+def provider_stream(messages, model, call=None, cancel=None):
+    """Streams from the provider, hedged across deployments if the model is configured for it."""
+    if hedge_enabled(model):
+        target = hedge_target(model)
+        if target:
+            return hedged_stream(messages, model, target,
+                                 lambda messages, model, cancel: llm_call_stream(messages, model, call, cancel),
+                                 cancel)
+    return llm_call_stream(messages, model, call, cancel)
+
+def finish_call(call, model, usage=None, error=None, cancelled=False):
+    """Records the call in the latency metrics and its token usage (or its error) in the usage ledger."""
+    call.finish(usage, error, cancelled)
+    record = call.usage_record()
+    if record:
+        record['cost'] = call_cost(model, usage) if usage else None
+        write_behind.add_usage(record)
+
+def scheduled_stream(messages, model, priority=PRIORITY_INTERACTIVE, user_id=None, cancel=None):
+    """
+    Waits for a scheduler slot (reporting the queue position), then streams the answer.
+    A cancelled stream (see ai_streams) leaves the queue or closes the provider response
+    and ends without an error event.
+    """
+    call = CallMetrics(model, user_id)
+    try:
+        ticket = scheduler.enqueue(model, messages, priority)
+    except SchedulerError as e:
+        logger.warning("Request rejected by scheduler: %s", e)
+        finish_call(call, model, error=e)
+        yield error_event(BUSY_MESSAGE)
+        return
+
+    completion_chars = 0
+    usage = None
+    error = None
+    try:
+        for position in scheduler.wait(ticket, cancel):
+            yield queue_event(position)
+        call.dequeued()
+        for event, data in provider_stream(messages, model, call, cancel):
+            if event == 'delta':
+                completion_chars += len(data['text'])
+                call.token(data['text'])
+            elif event == 'usage':
+                usage = data
+            yield event, data
+    except QueueCancelled as e:
+        logger.info("Stream %s cancelled while queued: %s", cancel.stream_id, cancel.reason)
+        error = e
+    except SchedulerError as e:
+        logger.warning("Request timed out in scheduler queue: %s", e)
+        error = e
+        yield error_event(BUSY_MESSAGE)
+    except Exception as e:
+        error = e
+        if not (cancel and cancel.cancelled):
+            raise
+        # Reading the closed provider response fails, that is the expected end of a cancelled stream
+        logger.info("Stream %s cancelled: %s", cancel.stream_id, cancel.reason)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        scheduler.cancel(ticket)
+        scheduler.release(ticket, completion_chars)
+        finish_call(call, model, usage, error, cancelled=bool(cancel and cancel.cancelled))
+
+async def scheduled_stream_async(messages, model, priority=PRIORITY_INTERACTIVE, user_id=None, cancel=None):
+    """Async variant of scheduled_stream for the ASGI gateway."""
+    call = CallMetrics(model, user_id)
+    try:
+        ticket = scheduler.enqueue(model, messages, priority)
+    except SchedulerError as e:
+        logger.warning("Request rejected by scheduler: %s", e)
+        finish_call(call, model, error=e)
+        yield error_event(BUSY_MESSAGE)
+        return
+
+    completion_chars = 0
+    usage = None
+    error = None
+    try:
+        async for position in scheduler.wait_async(ticket, cancel):
+            yield queue_event(position)
+        call.dequeued()
+        async for event, data in llm_call_stream_async(messages, model, call):
+            if event == 'delta':
+                completion_chars += len(data['text'])
+                call.token(data['text'])
+            elif event == 'usage':
+                usage = data
+            yield event, data
+    except QueueCancelled as e:
+        logger.info("Stream %s cancelled while queued: %s", cancel.stream_id, cancel.reason)
+        error = e
+    except SchedulerError as e:
+        logger.warning("Request timed out in scheduler queue: %s", e)
+        error = e
+        yield error_event(BUSY_MESSAGE)
+    except Exception as e:
+        error = e
+        if not (cancel and cancel.cancelled):
+            raise
+        # Reading the closed provider response fails, that is the expected end of a cancelled stream
+        logger.info("Stream %s cancelled: %s", cancel.stream_id, cancel.reason)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        scheduler.cancel(ticket)
+        scheduler.release(ticket, completion_chars)
+        finish_call(call, model, usage, error, cancelled=bool(cancel and cancel.cancelled))
+
+def scheduled_complete(messages, model, priority=PRIORITY_INTERACTIVE, user_id=None, complete=llm_complete):
+    """
+    Blocks until a scheduler slot is free. Raises SchedulerError if the queue is full or times out.
+    complete is the provider call, e.g. a llm_complete_tools with bound tools.
+    """
+    call = CallMetrics(model, user_id, stream=False)
+    try:
+        ticket = scheduler.enqueue(model, messages, priority)
+    except SchedulerError as e:
+        finish_call(call, model, error=e)
+        raise
+
+    completion_chars = None
+    result = None
+    error = None
+    try:
+        for position in scheduler.wait(ticket):
+            pass
+        call.dequeued()
+        result = complete(messages, model)
+        call.first_byte()
+        call.token(result['text'])
+        completion_chars = len(result['text'] or '')
+        return result
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        scheduler.cancel(ticket)
+        scheduler.release(ticket, completion_chars)
+        finish_call(call, model, result['usage'] if result else None, error)
+
+def cached_complete(messages, model, priority=PRIORITY_INTERACTIVE, user_id=None):
+    """Serves repeated identical requests from the response cache if the model allows caching."""
+    if not cache_enabled(model):
+        return scheduled_complete(messages, model, priority, user_id)
+
+    key = cache_key(model, messages)
+    text = response_cache.get(key)
+    if text is not None:
+        return {'text': text, 'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0,
+                                        'response_cache': True}}
+    result = scheduled_complete(messages, model, priority, user_id)
+    if result['text']:
+        response_cache.put(key, result['text'])
+    return result
+
+def semantic_cached_stream(messages, model, settings, priority=PRIORITY_INTERACTIVE, user_id=None, cancel=None):
+    """
+    Replays a cached answer to a similar question as normal stream events,
+    or streams a live answer and stores it for the next similar question.
+    """
+    if not is_single_turn(messages):
+        yield from scheduled_stream(messages, model, priority, user_id, cancel)
+        return
+
+    try:
+        embedding = embed(cache_text(messages))
+        answer = semantic_cache.lookup(cache_scope(settings, model), embedding, settings['threshold'])
+    except Exception as e:
+        logger.warning("Semantic cache lookup failed: %s", e)
+        yield from scheduled_stream(messages, model, priority, user_id, cancel)
+        return
+
+    if answer is not None:
+        yield delta_event(answer)
+        yield usage_event({'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'semantic_cache': True})
+        return
+
+    answer = ""
+    completed = False
+    for event, data in scheduled_stream(messages, model, priority, user_id, cancel):
+        if event == 'delta':
+            answer += data['text']
+        elif event == 'usage':
+            completed = True
+        elif event == 'error':
+            completed = False
+        yield event, data
+
+    if completed and answer.strip():
+        try:
+            semantic_cache.store(cache_scope(settings, model), last_user_message(messages), embedding, answer.strip())
+        except Exception as e:
+            logger.warning("Could not store semantic cache entry: %s", e)
+
+def stream_events(messages, model, settings=None, priority=PRIORITY_INTERACTIVE, user_id=None, cancel=None):
+    """The events of a chat stream: semantic cache if settings (see prompt_settings) are given, else scheduled."""
+    if settings:
+        return semantic_cached_stream(messages, model, settings, priority, user_id, cancel)
+    return scheduled_stream(messages, model, priority, user_id, cancel)
+
+def llm_call(messages, model, stream=True, priority=PRIORITY_INTERACTIVE, prompt_id=None, with_usage=False, user_id=None,
+             user=None):
+    """
+    Streams SSE events, or returns the answer text without streaming.
+    With with_usage=True the non-streaming call returns {'text': ..., 'usage': {...}}.
+    user_id tags the call in the latency metrics and owns the stream for /chat/cancel.
+    prompt_id enables the prompt's semantic cache if user may access the prompt; the
+    prompt's own system message is used then.
+    The model's capabilities are resolved from the model catalog.
+    """
+    model = model_catalog.resolve(model)
+    settings = prompt_settings(prompt_id, user) if stream else None
+    if settings:
+        messages = with_system_message(messages, settings['system_message'])
+    messages = fit_messages(messages, model)
     if stream:
-        return llm_call_stream(messages, model)
-    return llm_call_no_stream(messages, model)
\ No newline at end of file
+        token = streams.register(user_id)
+        return sse_stream(coalesced_stream(stream_events(messages, model, settings, priority, user_id, token)), token)
+    result = cached_complete(messages, model, priority, user_id)
+    return result if with_usage else result['text']
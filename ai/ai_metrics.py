@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Latency instrumentation for llm_call.
+
+Every call gets a CallMetrics object that records its timings:
+
+- queue_time:  waiting for a scheduler slot
+- ttfb:        request sent until the provider answered (response headers)
+- ttft:        call started until the first token was sent to the client
+- token_gap:   time between two chunks sent to the client
+- tokens_per_second: output tokens / time from first to last token
+- duration:    the whole call
+
+Finished calls are aggregated into in-process histograms per provider and model,
+counters per provider, model and error class, and a summary per user. The numbers
+are per process and reset on restart; /chat/metrics exports them.
+"""
+import time
+import threading
+from collections import deque
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+
+HISTOGRAMS = {
+    'queue_time': SECONDS_BUCKETS,
+    'ttfb': SECONDS_BUCKETS,
+    'ttft': SECONDS_BUCKETS,
+    'token_gap': SECONDS_BUCKETS,
+    'tokens_per_second': RATE_BUCKETS,
+    'duration': SECONDS_BUCKETS,
+}
+
+RECENT_CALLS = 200
+CHARS_PER_TOKEN = 4
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (the maximum for the last bucket)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        cumulative, seen = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            cumulative[str(bound)] = seen
+        cumulative['+Inf'] = self.count
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'avg': round(self.sum / self.count, 4) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative,
+        }
+
+
+def error_class(error):
+    if error is None:
+        return None
+    if isinstance(error, BaseException):
+        return type(error).__name__
+    return str(error)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._calls = {}
+            self._users = {}
+            self._recent = deque(maxlen=RECENT_CALLS)
+
+    def _observe(self, name, key, value):
+        histogram = self._histograms.setdefault((name,) + key, Histogram(HISTOGRAMS[name]))
+        histogram.observe(value)
+
+    def record(self, call):
+        key = (call.provider, call.model)
+        record = call.record()
+        with self._lock:
+            for name in ('queue_time', 'ttfb', 'ttft', 'tokens_per_second', 'duration'):
+                if record[name] is not None:
+                    self._observe(name, key, record[name])
+            for gap in call.gaps:
+                self._observe('token_gap', key, gap)
+
+            counter_key = key + (record['error'] or record['status'],)
+            self._calls[counter_key] = self._calls.get(counter_key, 0) + 1
+
+            user = self._users.setdefault(record['user_id'] or 'anonymous',
+                                          {'calls': 0, 'errors': 0, 'cancelled': 0, 'output_tokens': 0, 'duration': 0.0})
+            user['calls'] += 1
+            user['errors'] += 1 if record['status'] == 'error' else 0
+            user['cancelled'] += 1 if record['status'] == 'cancelled' else 0
+            user['output_tokens'] += record['output_tokens']
+            user['duration'] = round(user['duration'] + record['duration'], 3)
+
+            self._recent.append(record)
+
+    def snapshot(self):
+        with self._lock:
+            models = {}
+            for (name, provider, model), histogram in self._histograms.items():
+                entry = models.setdefault(f"{provider}/{model}", {'calls': {}})
+                entry[name] = histogram.snapshot()
+            for (provider, model, outcome), count in self._calls.items():
+                entry = models.setdefault(f"{provider}/{model}", {'calls': {}})
+                entry['calls'][outcome] = count
+            return {
+                'models': models,
+                'users': {user: dict(values) for user, values in self._users.items()},
+                'recent': list(self._recent),
+            }
+
+
+metrics = Metrics()
+
+
+class CallMetrics:
+    """Timings of one llm_call, recorded into metrics by finish()."""
+    def __init__(self, model, user_id=None, stream=True):
+        self.provider = model.get('provider', '')
+        self.model = model.get('model', '')
+        self.user_id = user_id
+        self.stream = stream
+        self.started = time.time()
+        self.dequeued_at = None
+        self.first_byte_at = None
+        self.first_token_at = None
+        self.last_token_at = None
+        self.output_chars = 0
+        self.gaps = []
+        self.usage = None
+        self.error = None
+        self.status = None
+        self.finished_at = None
+
+    def dequeued(self):
+        self.dequeued_at = time.time()
+
+    def first_byte(self):
+        if self.first_byte_at is None:
+            self.first_byte_at = time.time()
+
+    def token(self, text):
+        now = time.time()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.gaps.append(now - self.last_token_at)
+        self.last_token_at = now
+        self.output_chars += len(text or '')
+
+    def finish(self, usage=None, error=None, cancelled=False):
+        """
+        status is 'ok', 'error' or 'cancelled'. A cancelled call (or a stream closed by
+        its reader, GeneratorExit) is not an error, whatever the closed response raised.
+        """
+        if self.finished_at is not None:
+            return
+        self.finished_at = time.time()
+        self.usage = usage
+        if cancelled or isinstance(error, GeneratorExit):
+            self.status, self.error = 'cancelled', None
+        else:
+            self.status, self.error = ('ok', None) if error is None else ('error', error_class(error))
+        metrics.record(self)
+
+    def usage_record(self):
+        """
+        Token usage of the call for the token_usage collection. Failed and cancelled calls
+        get a record with their status (and zero tokens if the provider reported none), so
+        the rollups count them. None for successful calls without usage.
+        """
+        if not self.usage and self.status == 'ok':
+            return None
+        usage = self.usage or {}
+        return {
+            'user_id': self.user_id,
+            'provider': self.provider,
+            'model': self.model,
+            'stream': self.stream,
+            'prompt_tokens': usage.get('prompt_tokens') or 0,
+            'completion_tokens': usage.get('completion_tokens') or 0,
+            'total_tokens': usage.get('total_tokens') or 0,
+            'cached_tokens': usage.get('cached_tokens') or 0,
+            'status': self.status,
+            'error': self.error,
+        }
+
+    def output_tokens(self):
+        if self.usage and self.usage.get('completion_tokens'):
+            return self.usage['completion_tokens']
+        return self.output_chars // CHARS_PER_TOKEN
+
+    def record(self):
+        def since(start, end):
+            return round(end - start, 4) if start is not None and end is not None else None
+
+        request_sent = self.dequeued_at or self.started
+        tokens = self.output_tokens()
+        generation_time = since(self.first_token_at, self.last_token_at)
+        return {
+            'time': round(self.started, 3),
+            'provider': self.provider,
+            'model': self.model,
+            'user_id': self.user_id,
+            'stream': self.stream,
+            'queue_time': since(self.started, self.dequeued_at),
+            'ttfb': since(request_sent, self.first_byte_at),
+            'ttft': since(self.started, self.first_token_at),
+            'max_token_gap': round(max(self.gaps), 4) if self.gaps else None,
+            'tokens_per_second': round(tokens / generation_time, 2) if generation_time else None,
+            'output_tokens': tokens,
+            'duration': since(self.started, self.finished_at),
+            'status': self.status,
+            'error': self.error,
+        }
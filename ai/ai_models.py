@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cached model catalog.
+
+The Model collection changes a few times a month, but the chat page needs it on
+every load and llm_call on every request. The catalog keeps the models in memory,
+together with their JSON for the chat template, and reloads them only when the
+catalog version changes: Model.save() and Model.delete() (CRUD pages) and
+ai_insert_models.py bump the 'model' version in catalog_versions.
+
+Changes made by this process are seen at once. Changes made by other processes are
+seen after at most MODEL_CATALOG_CHECK_SECONDS, the interval at which the version
+stamp is read from the database.
+"""
+import os
+import json
+import time
+import threading
+
+from jinja2.utils import htmlsafe_json_dumps
+
+from core.db_document import Model, catalog_version, local_catalog_versions
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+check_seconds = float(os.getenv('MODEL_CATALOG_CHECK_SECONDS', '10'))
+
+CATALOG = 'model'
+
+# The only fields taken from a client model dict that is not in the catalog
+CLIENT_FIELDS = ('provider', 'model', 'name')
+
+
+class ModelCatalog:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._local_version = None
+        self._checked = 0
+        self._models = []
+        self._by_model = {}
+        self._serialized = '[]'
+
+    def _fresh(self, local_version):
+        return (self._checked and local_version == self._local_version
+                and time.time() - self._checked < check_seconds)
+
+    def _current(self):
+        """Reloads the models if the version stamp changed since the last load."""
+        local_version = local_catalog_versions.get(CATALOG, 0)
+        if self._fresh(local_version):
+            return
+        with self._lock:
+            if self._fresh(local_version):
+                return
+            self._checked = time.time()
+            self._local_version = local_version
+            try:
+                version = catalog_version(CATALOG)
+                if version == self._version:
+                    return
+                models = json.loads(Model.objects().to_json())
+            except Exception as e:
+                # Keeps serving the last loaded models and tries again after check_seconds
+                logger.error("Could not load the model catalog: %s", e)
+                return
+            self._models = models
+            self._by_model = {model['model']: model for model in models}
+            self._serialized = htmlsafe_json_dumps(models)
+            self._version = version
+            logger.info("Loaded %s models, catalog version %s", len(models), version)
+
+    def models(self):
+        """All models as dicts, shared between requests: don't modify them."""
+        self._current()
+        return self._models
+
+    def serialized(self):
+        """The models as JSON, safe to embed in a <script> block of a template."""
+        self._current()
+        return self._serialized
+
+    def get(self, name):
+        """The model with this model name (e.g. 'gpt-4o'), or None."""
+        self._current()
+        return self._by_model.get(name)
+
+    def resolve(self, model):
+        """
+        Capabilities of a model sent by the client (limits, caching, hedging, prices)
+        come from the catalog. Of a model that is not in the catalog only provider,
+        model and name are used, everything else gets the defaults.
+        """
+        known = self.get(model.get('model'))
+        if known:
+            return known
+        return {key: model[key] for key in CLIENT_FIELDS if key in model}
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+            self._checked = 0
+
+
+model_catalog = ModelCatalog()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-provider request scheduler for llm_call.
+
+Every call first takes a ticket. A ticket starts when the provider and the model
+are below their concurrency limits and the tokens-per-minute budget has room;
+otherwise it waits in a priority queue (interactive chat before batch work).
+Limits are per process.
+
+Provider limits come from the environment, e.g. LLM_CONCURRENCY_AZURE=8 and
+LLM_TPM_AZURE=200000. Model limits come from the Model document fields
+max_concurrency_int and tpm_int.
+"""
+import os
+import time
+import heapq
+import itertools
+import threading
+from collections import deque
+
+import anyio
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+default_concurrency = int(os.getenv('LLM_CONCURRENCY', '16'))
+default_tpm = int(os.getenv('LLM_TPM', '0'))  # 0 = unlimited
+max_queue = int(os.getenv('LLM_MAX_QUEUE', '200'))
+queue_timeout = float(os.getenv('LLM_QUEUE_TIMEOUT', '120'))
+
+# Tokens we reserve for the answer when estimating the cost of a request
+ESTIMATED_COMPLETION_TOKENS = 1000
+TPM_WINDOW = 60
+
+
+class SchedulerError(Exception):
+    pass
+
+
+class QueueFull(SchedulerError):
+    pass
+
+
+class QueueTimeout(SchedulerError):
+    pass
+
+
+class QueueCancelled(SchedulerError):
+    pass
+
+
+def estimate_tokens(messages):
+    """Rough token estimate (4 characters per token) used for the TPM budget."""
+    chars = 0
+    for message in messages:
+        content = message.get('content', '')
+        chars += len(content) if isinstance(content, str) else len(str(content))
+    return chars // 4 + ESTIMATED_COMPLETION_TOKENS
+
+
+def provider_limits(provider):
+    key = provider.upper()
+    concurrency = int(os.getenv(f'LLM_CONCURRENCY_{key}', default_concurrency))
+    tpm = int(os.getenv(f'LLM_TPM_{key}', default_tpm))
+    return concurrency, tpm
+
+
+def model_limits(model):
+    concurrency = int(model.get('max_concurrency_int') or 0)
+    tpm = int(model.get('tpm_int') or 0)
+    return concurrency, tpm
+
+
+class Ticket:
+    def __init__(self, model, tokens, priority, seq):
+        self.provider = model['provider']
+        self.model_key = (model['provider'], model['model'])
+        self.model = model
+        self.tokens = tokens
+        self.priority = priority
+        self.seq = seq
+        self.enqueued = time.time()
+        self.started = None
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Scheduler:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._active = {}
+        self._tokens = {}
+        self._seq = itertools.count()
+
+    def _window(self, key):
+        window = self._tokens.setdefault(key, deque())
+        cutoff = time.time() - TPM_WINDOW
+        while window and window[0][0] < cutoff:
+            window.popleft()
+        return window
+
+    def _has_capacity(self, key, concurrency, tpm, tokens):
+        if concurrency and self._active.get(key, 0) >= concurrency:
+            return False
+        if tpm:
+            window = self._window(key)
+            used = sum(t for _, t in window)
+            # An empty window always admits one request, even an oversized one
+            if window and used + tokens > tpm:
+                return False
+        return True
+
+    def _position(self, ticket):
+        """Returns 0 if the ticket may start now, otherwise its 1-based queue position."""
+        ahead = 0
+        for other in sorted(self._waiting):
+            if other is ticket:
+                break
+            if other.provider == ticket.provider:
+                ahead += 1
+        if ahead:
+            return ahead + 1
+
+        provider_concurrency, provider_tpm = provider_limits(ticket.provider)
+        concurrency, tpm = model_limits(ticket.model)
+        if (self._has_capacity(ticket.provider, provider_concurrency, provider_tpm, ticket.tokens)
+                and self._has_capacity(ticket.model_key, concurrency, tpm, ticket.tokens)):
+            return 0
+        return 1
+
+    def _start(self, ticket):
+        self._waiting.remove(ticket)
+        heapq.heapify(self._waiting)
+        now = time.time()
+        ticket.started = now
+        for key in (ticket.provider, ticket.model_key):
+            self._active[key] = self._active.get(key, 0) + 1
+            self._window(key).append((now, ticket.tokens))
+
+    def enqueue(self, model, messages, priority=PRIORITY_INTERACTIVE):
+        with self._cond:
+            if len(self._waiting) >= max_queue:
+                raise QueueFull(f"Queue is full ({max_queue} requests across all providers, LLM_MAX_QUEUE), "
+                                f"rejected request for {model['provider']}")
+            ticket = Ticket(model, estimate_tokens(messages), priority, next(self._seq))
+            heapq.heappush(self._waiting, ticket)
+            return ticket
+
+    def try_start(self, ticket):
+        """Starts the ticket if possible. Returns 0 when started, otherwise the queue position."""
+        with self._cond:
+            position = self._position(ticket)
+            if position == 0:
+                self._start(ticket)
+            return position
+
+    def cancel(self, ticket):
+        with self._cond:
+            if ticket.started is None and ticket in self._waiting:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def _check_timeout(self, ticket):
+        if time.time() - ticket.enqueued > queue_timeout:
+            self.cancel(ticket)
+            raise QueueTimeout(f"Request for {ticket.model_key[1]} waited longer than {queue_timeout}s")
+
+    def _check_cancel(self, ticket, cancel):
+        if cancel is not None and cancel.cancelled:
+            self.cancel(ticket)
+            raise QueueCancelled(f"Request for {ticket.model_key[1]} was cancelled while queued")
+
+    def wait(self, ticket, cancel=None):
+        """
+        Blocks until the ticket can start. Yields the queue position every time it
+        changes, so streaming callers can report it to the client. cancel is the
+        CancelToken of the stream, a cancelled stream leaves the queue.
+        """
+        last_position = None
+        while True:
+            position = self.try_start(ticket)
+            if position == 0:
+                return
+            if position != last_position:
+                last_position = position
+                yield position
+            self._check_timeout(ticket)
+            self._check_cancel(ticket, cancel)
+            with self._cond:
+                # Wake up on release, or periodically for the TPM window to move on
+                self._cond.wait(timeout=1.0)
+
+    async def wait_async(self, ticket, cancel=None):
+        """Async variant of wait() for the ASGI gateway, never blocks the event loop."""
+        last_position = None
+        while True:
+            position = self.try_start(ticket)
+            if position == 0:
+                return
+            if position != last_position:
+                last_position = position
+                yield position
+            self._check_timeout(ticket)
+            self._check_cancel(ticket, cancel)
+            await anyio.sleep(0.25)
+
+    def release(self, ticket, completion_chars=None):
+        """Frees the slot. The TPM window is corrected with the real answer length if known."""
+        with self._cond:
+            if ticket.started is None:
+                return
+            for key in (ticket.provider, ticket.model_key):
+                self._active[key] = max(0, self._active.get(key, 0) - 1)
+                if completion_chars is not None:
+                    correction = completion_chars // 4 - ESTIMATED_COMPLETION_TOKENS
+                    self._window(key).append((time.time(), correction))
+            ticket.started = None
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'waiting': len(self._waiting),
+                'active': {str(key): count for key, count in self._active.items() if count},
+            }
+
+
+scheduler = Scheduler()
@@ -1,58 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Web search for the chat (Google Custom Search).
+
+- search(): result list (title, url, snippet, source) of one query
+- search_context(): searches, then fetches the top result pages in parallel and
+  extracts their text, all under one deadline. Returns numbered context blocks and
+  their text, ready to be put into a chat turn.
+
+Requests go through one pooled HTTP client. Search results are cached in memory
+(SEARCH_CACHE_TTL) under the normalised query and its parameters, extracted pages
+under their URL.
+
+Result pages can point anywhere. A page (and every redirect, followed by hand) is
+only fetched if its host resolves to public addresses, never to private, loopback or
+link-local ones. SEARCH_API_URL and the page URLs can point to a local stub
+(ai_fake_server.py serves /customsearch/v1 and test pages) with
+SEARCH_ALLOW_PRIVATE_ADDRESSES=1, so the whole pipeline runs without Google.
+"""
 import os
-import requests
-from datetime import datetime
-import dotenv
+import json
+import time
+import socket
+import hashlib
+import ipaddress
+import threading
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import httpx
 
 from dotenv import load_dotenv
 load_dotenv()
 
-def search(question, num_results=10, days=5, start=0):
-    # Read API key and cx from environment variables
-    google_search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY")
-    google_cse_id = os.getenv("GOOGLE_CSE_ID")
+from ai.ai_cache import ResponseCache
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+search_api_url = os.getenv('SEARCH_API_URL', 'https://customsearch.googleapis.com/customsearch/v1')
+search_timeout = float(os.getenv('SEARCH_TIMEOUT', '5'))
+search_deadline = float(os.getenv('SEARCH_DEADLINE', '8'))
+fetch_pages = int(os.getenv('SEARCH_FETCH_PAGES', '3'))
+max_page_chars = int(os.getenv('SEARCH_MAX_PAGE_CHARS', '4000'))
+max_page_bytes = int(os.getenv('SEARCH_MAX_PAGE_BYTES', str(2 * 1024 * 1024)))
+pool_max_connections = int(os.getenv('SEARCH_POOL_MAX_CONNECTIONS', '20'))
+allow_private_addresses = os.getenv('SEARCH_ALLOW_PRIVATE_ADDRESSES', '0') == '1'
+
+search_cache = ResponseCache(max_entries=int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '500')),
+                             ttl=int(os.getenv('SEARCH_CACHE_TTL', '900')), directory='')
+
+USER_AGENT = 'Mozilla/5.0 (compatible; FireworksBot/1.0)'
+MAX_REDIRECTS = 5
+
+# Elements whose text is not part of the page content
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'svg', 'nav', 'header', 'footer', 'form', 'aside', 'template'}
+BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'article', 'blockquote', 'pre'}
+
+_client = None
+_client_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=pool_max_connections, thread_name_prefix='search-fetch')
+
 
-    # API endpoint and parameters
-    url = "https://customsearch.googleapis.com/customsearch/v1"
+def get_http_client():
+    """The pooled client of this process, shared by searches and page fetches."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                timeout=httpx.Timeout(search_timeout),
+                limits=httpx.Limits(max_connections=pool_max_connections,
+                                    max_keepalive_connections=pool_max_connections),
+                headers={'User-Agent': USER_AGENT},
+                # fetch_page checks the target of every redirect itself
+                follow_redirects=False,
+            )
+        return _client
+
+
+def normalise_query(question):
+    return ' '.join(question.lower().split())
+
+
+def cache_key(kind, question, params):
+    canonical = json.dumps({'kind': kind, 'q': question, 'params': params}, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def search(question, num_results=10, days=5, start=0):
+    """Google results of the last days for a German audience, cached."""
     params = {
-        "q": question,
-        "key": google_search_api_key,
-        "cx": google_cse_id,
         "lr": "lang_de",
         "gl": "de",
-        "dateRestrict" : "d" + str(days),
+        "dateRestrict": "d" + str(days),
         "num": num_results,  # Get the specified number of search results
         "googlehost": "google.de",  # Search on google.de domain
         "cr": "countryDE",  # Restrict search to Germany
         "start": start  # The index to start the search results from
     }
+    key = cache_key('search', normalise_query(question), params)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
 
-    # Make request to API and extract news results
-    response = requests.get(url, params=params).json()
-
-    # Check if the "items" key exists in the response
-    if "items" in response:
-        results = response["items"]
-    else:
-        results = []
+    response = get_http_client().get(search_api_url, params=dict(
+        params, q=question, key=os.getenv("GOOGLE_SEARCH_API_KEY"), cx=os.getenv("GOOGLE_CSE_ID")))
+    response.raise_for_status()
 
-    # Extract article URL, title, snippet, source, and image URL for each search result and store in list
     news_results = []
-    for result in results:
+    for result in response.json().get("items", []):
         news_result = {
             "url": result["link"],
             "title": result["title"],
-            "snippet": result["snippet"],
-            "source": result["displayLink"]
+            "snippet": result.get("snippet", ""),
+            "source": result.get("displayLink", "")
         }
-
-        print (news_result['title'])
-
         # Extract image URL if available
         if "pagemap" in result and "cse_image" in result["pagemap"]:
             news_result["image_url"] = result["pagemap"]["cse_image"][0]["src"]
-
         news_results.append(news_result)
 
+    logger.debug("Search for %r returned %s results", question, len(news_results))
+    search_cache.put(key, news_results)
     return news_results
 
-search("Wann spielt der FCBayern?")
\ No newline at end of file
+
+class TextExtractor(HTMLParser):
+    """Collects the visible text of an HTML page, without scripts, navigation and footers."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.title = ''
+        self._skip = 0
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip += 1
+        elif tag == 'title':
+            self._in_title = True
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS and self._skip:
+            self._skip -= 1
+        elif tag == 'title':
+            self._in_title = False
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skip:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (' '.join(line.split()) for line in ''.join(self.parts).split('\n'))
+        return '\n'.join(line for line in lines if line)
+
+
+def extract_text(html):
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.text()
+
+
+def check_public_url(url):
+    """Raises ValueError unless url is http(s) and its host resolves to public addresses only."""
+    if url.scheme not in ('http', 'https'):
+        raise ValueError(f"Unsupported URL scheme {url.scheme}")
+    if allow_private_addresses:
+        return
+    host = url.raw_host.decode('ascii')
+    try:
+        infos = socket.getaddrinfo(host, url.port or (443 if url.scheme == 'https' else 80), type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ValueError(f"Could not resolve {host}: {e}")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"{host} resolves to the non-public address {address}")
+
+
+def read_page(response):
+    """Text of a page response, the body is read up to max_page_bytes."""
+    response.raise_for_status()
+    content_type = response.headers.get('content-type', '')
+    if 'html' not in content_type and 'text/plain' not in content_type:
+        raise ValueError(f"Unsupported content type {content_type}")
+    body = b''
+    for chunk in response.iter_bytes():
+        body += chunk
+        if len(body) >= max_page_bytes:
+            break
+
+    page = body.decode(response.encoding or 'utf-8', errors='replace')
+    return extract_text(page) if 'html' in content_type else page.strip()
+
+
+def fetch_page(url, timeout):
+    """Text of a result page (HTML or plain text), cut to max_page_chars. Cached."""
+    key = cache_key('page', url, {'chars': max_page_chars})
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+
+    client = get_http_client()
+    target = httpx.URL(url)
+    for redirect in range(MAX_REDIRECTS + 1):
+        # The host is resolved again when connecting; a DNS answer changing in between is not caught
+        check_public_url(target)
+        response = client.send(client.build_request('GET', target, timeout=timeout), stream=True)
+        try:
+            if not response.is_redirect:
+                text = read_page(response)[:max_page_chars]
+                break
+            target = target.join(response.headers['location'])
+        finally:
+            response.close()
+    else:
+        raise ValueError(f"More than {MAX_REDIRECTS} redirects")
+
+    search_cache.put(key, text)
+    return text
+
+
+def search_context(question, num_results=5, pages=fetch_pages, deadline=search_deadline):
+    """
+    Searches and fetches the top pages in parallel until the deadline. Pages that
+    fail or are late keep their snippet. Returns {'blocks': [...], 'text': ...}, the
+    blocks are numbered so the answer can cite them as [1], [2], ...
+    """
+    ends = time.time() + deadline
+    results = search(question, num_results=num_results)
+    blocks = [{'index': i + 1, 'title': r['title'], 'url': r['url'], 'source': r['source'], 'text': r['snippet']}
+              for i, r in enumerate(results)]
+
+    futures = {}
+    for block in blocks[:pages]:
+        remaining = ends - time.time()
+        if remaining <= 0:
+            break
+        futures[_executor.submit(fetch_page, block['url'], min(search_timeout, remaining))] = block
+    done, late = wait(futures, timeout=max(0, ends - time.time()))
+    for future in done:
+        try:
+            text = future.result()
+        except Exception as e:
+            logger.debug("Could not fetch %s: %s", futures[future]['url'], e)
+            continue
+        if text:
+            futures[future]['text'] = text
+    if late:
+        logger.debug("%s of %s pages missed the search deadline of %ss", len(late), len(futures), deadline)
+
+    return {'blocks': blocks, 'text': format_context(blocks)}
+
+
+def format_context(blocks):
+    return '\n\n'.join(f"[{block['index']}] {block['title']} ({block['url']})\n{block['text']}" for block in blocks)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Semantic answer cache for prompt templates.
+
+For prompts with the 'Semantic Cache' switch on, the user question is embedded and
+compared with earlier questions to the same prompt. If an earlier question is similar
+enough, its answer is replayed instead of calling the model. Only single-turn
+conversations are cached, because follow-up answers depend on the whole chat.
+
+The prompt id comes from the request, so the prompt is loaded and checked against the
+user, and the answer is generated with the prompt's own system message, not the one
+sent by the browser. Otherwise any client could store answers under any prompt.
+
+Entries are keyed by the prompt, the model and a hash of the system message, so an
+answer of one model is never replayed for another, and editing the prompt (or its
+files) starts a fresh cache.
+"""
+import os
+import math
+import hashlib
+import time
+import threading
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from ai.ai_clients import get_client
+from core.db_document import Prompt, File, SemanticCache
+from core.helper import prepare_context_from_files
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+embedding_provider = os.getenv('SEMANTIC_CACHE_EMBEDDING_PROVIDER', 'openai')
+embedding_model = os.getenv('SEMANTIC_CACHE_EMBEDDING_MODEL', 'text-embedding-3-small')
+default_threshold = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+max_age_days = float(os.getenv('SEMANTIC_CACHE_MAX_AGE_DAYS', '30'))
+max_entries = int(os.getenv('SEMANTIC_CACHE_MAX_ENTRIES', '500'))
+refresh_seconds = float(os.getenv('SEMANTIC_CACHE_REFRESH', '60'))
+
+# Embedding models accept ~8k tokens
+MAX_EMBEDDING_CHARS = 24000
+
+# prompt_id -> (loaded at, system message with the file context filled in)
+_system_messages = {}
+_system_messages_lock = threading.Lock()
+
+
+def system_message(prompt):
+    """The prompt's system message as the chat page builds it ({context} replaced by its files)."""
+    prompt_id = str(prompt.id)
+    with _system_messages_lock:
+        loaded = _system_messages.get(prompt_id)
+        if loaded and time.time() - loaded[0] < refresh_seconds:
+            return loaded[1]
+
+    message = prompt.system_message
+    if '{context}' in message:
+        files = [file.to_mongo().to_dict() for file in File.objects(document_id=prompt_id)]
+        context = prepare_context_from_files(files)
+        if context['status'] == 'ok':
+            message = message.replace('{context}', context['data'])
+    with _system_messages_lock:
+        _system_messages[prompt_id] = (time.time(), message)
+    return message
+
+
+def prompt_settings(prompt_id, user=None):
+    """
+    Returns the semantic cache settings of a prompt or None if it is not enabled or the
+    user (None for anonymous requests) may not use the prompt.
+    """
+    if not prompt_id or user is None:
+        return None
+    try:
+        prompt = Prompt.objects(id=prompt_id).first()
+        if not prompt or getattr(prompt, 'semantic_cache', 'Off') != 'On' or not prompt.can_access(user):
+            return None
+        system = system_message(prompt)
+    except Exception as e:
+        logger.warning("Could not load prompt %s for semantic cache: %s", prompt_id, e)
+        return None
+    threshold = getattr(prompt, 'similarity_threshold_float', None)
+    return {'prompt_id': str(prompt.id), 'threshold': threshold or default_threshold, 'system_message': system,
+            'system_hash': hashlib.sha256(system.encode('utf-8')).hexdigest()[:16]}
+
+
+def cache_scope(settings, model):
+    """The fields an entry must match to be replayed: prompt, model and system message."""
+    return {'prompt_id': settings['prompt_id'], 'model': model['model'], 'system_hash': settings['system_hash']}
+
+
+def with_system_message(messages, system):
+    """The messages with the system message replaced (or added) by the server side one."""
+    rest = [m for m in messages if m.get('role') != 'system']
+    return [{'role': 'system', 'content': system}] + rest
+
+
+def is_single_turn(messages):
+    return len([m for m in messages if m.get('role') == 'user']) == 1
+
+
+def last_user_message(messages):
+    question = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+    return question if isinstance(question, str) else str(question)
+
+
+def cache_text(messages):
+    """
+    The text that identifies a question: the last user message. The system prompt is
+    the same for all entries of a prompt, embedding it would only dilute the question.
+    """
+    return last_user_message(messages)[:MAX_EMBEDDING_CHARS]
+
+
+def embed(text):
+    client = get_client(embedding_provider)
+    response = client.embeddings.create(model=embedding_model, input=text)
+    return response.data[0].embedding
+
+
+def _norm(vector):
+    return math.sqrt(sum(x * x for x in vector)) or 1.0
+
+
+def cosine_similarity(a, norm_a, b, norm_b):
+    return sum(x * y for x, y in zip(a, b)) / (norm_a * norm_b)
+
+
+def _key(scope):
+    return scope['prompt_id'], scope['model'], scope['system_hash']
+
+
+class SemanticAnswerCache:
+    """
+    Keeps the embeddings of each scope (see cache_scope) in memory and reloads them
+    from MongoDB every minute, so entries written by other workers are found as well.
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0}
+
+    def _load(self, scope):
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        SemanticCache.objects(prompt_id=scope['prompt_id'], created_date__lt=cutoff).delete()
+        documents = SemanticCache.objects(**scope).only('embedding', 'answer')
+        entries = [(doc.embedding, _norm(doc.embedding), doc.answer) for doc in documents]
+        self._entries[_key(scope)] = (time.time(), entries)
+        return entries
+
+    def _get_entries(self, scope):
+        with self._lock:
+            loaded = self._entries.get(_key(scope))
+            if loaded and time.time() - loaded[0] < refresh_seconds:
+                return loaded[1]
+            return self._load(scope)
+
+    def lookup(self, scope, embedding, threshold):
+        """Returns the answer of the most similar cached question of the scope above the threshold."""
+        norm = _norm(embedding)
+        best_score, best_answer = 0.0, None
+        for vector, vector_norm, answer in self._get_entries(scope):
+            score = cosine_similarity(embedding, norm, vector, vector_norm)
+            if score > best_score:
+                best_score, best_answer = score, answer
+
+        if best_answer is not None and best_score >= threshold:
+            self.counters['hits'] += 1
+            logger.debug("Semantic cache hit for prompt %s, model %s (similarity %.3f)",
+                         scope['prompt_id'], scope['model'], best_score)
+            return best_answer
+        self.counters['misses'] += 1
+        return None
+
+    def store(self, scope, question, embedding, answer):
+        SemanticCache(question=question, embedding=embedding, answer=answer, **scope).save()
+        self.counters['stores'] += 1
+
+        # Keep only the newest max_entries answers per scope
+        stale = SemanticCache.objects(**scope).order_by('-created_date').skip(max_entries).only('id')
+        stale_ids = [doc.id for doc in stale]
+        if stale_ids:
+            SemanticCache.objects(id__in=stale_ids).delete()
+
+        with self._lock:
+            self._entries.pop(_key(scope), None)
+
+
+semantic_cache = SemanticAnswerCache()
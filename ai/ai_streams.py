@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Registry of running chat streams, so they can be cancelled.
+
+Every stream gets a random id that is sent to the client in the 'start' event. A
+stream is cancelled when the client disconnects (the server closes the response
+generator) or when the stop button calls /chat/cancel/<stream_id>. Cancelling closes
+the provider response at once, so the provider stops generating tokens we pay for.
+
+The registry is per process: the cancel request must reach the process that serves
+the stream (the Flask app or the ASGI gateway).
+"""
+import uuid
+import threading
+
+
+class CancelToken:
+    """Cancellation state of one stream. Callbacks run once, on the first cancel()."""
+    def __init__(self, stream_id, user_id=None):
+        self.stream_id = stream_id
+        self.user_id = user_id
+        self.reason = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def on_cancel(self, callback):
+        """Registers a callback, e.g. response.close. Runs at once if already cancelled."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                # Closing an already broken response may fail, the stream ends either way
+                pass
+        return True
+
+
+class StreamRegistry:
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+        self.counters = {'started': 0, 'completed': 0, 'client_disconnect': 0, 'cancel_request': 0}
+
+    def register(self, user_id=None):
+        token = CancelToken(uuid.uuid4().hex, user_id)
+        with self._lock:
+            self._streams[token.stream_id] = token
+            self.counters['started'] += 1
+        return token
+
+    def cancel(self, stream_id, user_id):
+        """Cancels a stream of this user on request. Returns False if there is no such stream."""
+        with self._lock:
+            token = self._streams.get(stream_id)
+        if token is None or token.user_id is None or token.user_id != user_id:
+            return False
+        if token.cancel('cancel_request'):
+            with self._lock:
+                self.counters['cancel_request'] += 1
+        return True
+
+    def disconnected(self, token):
+        if token.cancel('client_disconnect'):
+            with self._lock:
+                self.counters['client_disconnect'] += 1
+
+    def finish(self, token):
+        with self._lock:
+            if self._streams.pop(token.stream_id, None) is not None and not token.cancelled:
+                self.counters['completed'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, active=len(self._streams))
+
+
+streams = StreamRegistry()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Token usage ledger.
+
+Every finished model call (streaming or not) leaves a usage record in the
+write-behind buffer (ai_write_behind.py). When the buffer is flushed, the records
+are inserted into token_usage and added with $inc to pre-aggregated rollups in
+usage_rollups: one document per hour and per day for every user, provider and model.
+Reports read the few rollup documents of a time range through the
+(period, bucket) index instead of scanning calls or chat histories.
+
+Spend is calculated at call time from the model's prices in USD per million tokens
+(input_price_float and output_price_float, set in the model form).
+"""
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+from core.db_document import UsageRollup
+
+PERIODS = ['hour', 'day']
+
+COUNTERS = ['calls', 'errors', 'cancelled', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'cost']
+
+GROUPS = ['user_id', 'provider', 'model']
+
+
+def call_cost(model, usage):
+    """Spend of one call in USD, None if the model has no prices."""
+    input_price = model.get('input_price_float')
+    output_price = model.get('output_price_float')
+    if not input_price and not output_price:
+        return None
+    return ((usage.get('prompt_tokens') or 0) * float(input_price or 0)
+            + (usage.get('completion_tokens') or 0) * float(output_price or 0)) / 1000000
+
+
+def bucket_start(date, period):
+    if period == 'hour':
+        return date.replace(minute=0, second=0, microsecond=0)
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def rollup_increments(records):
+    """Sums usage records per rollup document, so every document gets one $inc per flush."""
+    increments = {}
+    for record in records:
+        for period in PERIODS:
+            key = (period, bucket_start(record['created_date'], period),
+                   record.get('user_id') or '', record.get('provider') or '', record.get('model') or '')
+            counters = increments.setdefault(key, dict.fromkeys(COUNTERS, 0))
+            counters['calls'] += 1
+            counters['errors'] += 1 if record.get('error') else 0
+            counters['cancelled'] += 1 if record.get('status') == 'cancelled' else 0
+            for name in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'cached_tokens', 'cost'):
+                counters[name] += record.get(name) or 0
+    return increments
+
+
+def merge_increments(target, increments):
+    for key, counters in increments.items():
+        existing = target.setdefault(key, dict.fromkeys(COUNTERS, 0))
+        for name, value in counters.items():
+            existing[name] += value
+
+
+def rollup_update(key, counters):
+    period, bucket, user_id, provider, model = key
+    return UpdateOne(
+        {'period': period, 'bucket': bucket, 'user_id': user_id, 'provider': provider, 'model': model},
+        {'$inc': counters, '$set': {'modified_date': datetime.now()}},
+        upsert=True
+    )
+
+
+def usage_report(period='day', days=30, group_by='model', user_id=None):
+    """
+    Totals per group (user_id, provider or model) and per bucket of the last days,
+    read from the rollups. Returns {'totals': [...], 'series': [...]}.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"Unknown period {period}, use one of {PERIODS}")
+    if group_by not in GROUPS:
+        raise ValueError(f"Unknown group {group_by}, use one of {GROUPS}")
+
+    match = {'period': period, 'bucket': {'$gte': bucket_start(datetime.now() - timedelta(days=days), period)}}
+    if user_id:
+        match['user_id'] = user_id
+    sums = {name: {'$sum': f"${name}"} for name in COUNTERS}
+
+    collection = UsageRollup._get_collection()
+    totals = collection.aggregate([
+        {'$match': match},
+        {'$group': dict({'_id': f"${group_by}"}, **sums)},
+        {'$sort': {'total_tokens': -1}},
+    ])
+    series = collection.aggregate([
+        {'$match': match},
+        {'$group': dict({'_id': {'bucket': '$bucket', group_by: f"${group_by}"}}, **sums)},
+        {'$sort': {'_id.bucket': 1}},
+    ])
+    return {'period': period, 'days': days, 'group_by': group_by,
+            'totals': report_rows(totals, group_by), 'series': report_rows(series, group_by)}
+
+
+def report_rows(entries, group_by):
+    """Flattens the $group ids of usage_report into plain fields."""
+    rows = []
+    for entry in entries:
+        key = entry.pop('_id')
+        if isinstance(key, dict):
+            entry['bucket'] = key['bucket'].isoformat()
+            key = key.get(group_by)
+        entry[group_by] = key
+        entry['cost'] = round(entry['cost'], 6)
+        rows.append(entry)
+    return rows
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Write-behind buffer for chat histories and token usage records.
+
+The chat page saves the whole conversation after every user message and every
+answer. Instead of a query plus a full document rewrite per save, /chat/save_chat
+puts the conversation into this buffer and answers at once. Saves of the same
+conversation within the flush interval are coalesced (only the latest one is
+written), and all buffered writes go to MongoDB in one unordered bulk write per
+collection. Token usage of finished calls is buffered the same way, together with
+its hourly and daily rollups (see ai_usage.py).
+
+The buffer is flushed every WRITE_BEHIND_SECONDS, when WRITE_BEHIND_MAX_PENDING
+conversations are waiting, and when the process exits. Failed writes are kept and
+retried with the next flush. Reads that must see the latest state (e.g. deleting
+all histories of a user) call flush() first; deleting one history discards its
+pending saves (discard_history, registered by ai_chat.py as a delete hook of
+core/db_crud.py), so a flush can't bring it back.
+
+A history write only applies if the stored conversation is not newer than the save
+(modified_date), so a retried or late save never overwrites a newer one. The unique
+(user_id, chat_started) index turns such a write into a duplicate key error, which is
+skipped.
+"""
+import os
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+
+from pymongo import UpdateOne, InsertOne
+from pymongo.errors import BulkWriteError
+
+from core.db_document import History, TokenUsage, UsageRollup
+from ai.ai_usage import rollup_increments, merge_increments, rollup_update
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+flush_seconds = float(os.getenv('WRITE_BEHIND_SECONDS', '1'))
+max_pending = int(os.getenv('WRITE_BEHIND_MAX_PENDING', '500'))
+# Usage records kept while the database is unreachable, the oldest are dropped beyond this
+max_usage_records = int(os.getenv('WRITE_BEHIND_MAX_USAGE', '10000'))
+
+DEFAULT_FIRST_MESSAGE = "Neuer Chat"
+
+# Retried inserts that already made it into the collection fail with this code
+DUPLICATE_KEY = 11000
+
+
+def first_user_message(messages):
+    for msg in messages:
+        if msg.get('role') == 'user' and isinstance(msg.get('content'), str):
+            return msg['content']
+    return None
+
+
+def attachment_ids(messages):
+    file_ids = []
+    for msg in messages:
+        for attachment in msg.get('attachments') or []:
+            file_ids.append(attachment['id'])
+    return file_ids
+
+
+def history_update(save):
+    """
+    Upsert of one conversation as an update pipeline, so the first message and the
+    audit fields of an existing history are kept. Values are wrapped in $literal, a
+    message starting with '$' would otherwise be read as a field path. Histories
+    modified after the save don't match the filter (see module docstring).
+    """
+    first_message = save['first_message'] or DEFAULT_FIRST_MESSAGE
+    return UpdateOne(
+        {'user_id': save['user_id'], 'chat_started': save['chat_started'],
+         'modified_date': {'$not': {'$gt': save['saved_date']}}},
+        [{'$set': {
+            'messages': {'$literal': save['messages']},
+            'file_ids': {'$literal': save['file_ids']},
+            'first_message': {'$cond': [
+                {'$eq': [{'$ifNull': ['$first_message', DEFAULT_FIRST_MESSAGE]}, DEFAULT_FIRST_MESSAGE]},
+                {'$literal': first_message},
+                '$first_message'
+            ]},
+            'link': {'$ifNull': ['$link', '']},
+            'created_date': {'$ifNull': ['$created_date', save['saved_date']]},
+            'created_by': {'$ifNull': ['$created_by', save['user_id']]},
+            'modified_date': save['saved_date'],
+            'modified_by': save['user_id'],
+        }}],
+        upsert=True
+    )
+
+
+class WriteBehindBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # One flush at a time, so flush() returns only when earlier buffered writes are written too
+        self._flushing = threading.Lock()
+        self._histories = {}
+        self._usage = []
+        # Rollups are summed when a record is added, so retried records are never counted twice
+        self._rollups = {}
+        self._thread = None
+        self.counters = {'saves': 0, 'coalesced': 0, 'discarded': 0, 'history_writes': 0, 'usage_records': 0,
+                         'usage_dropped': 0, 'rollup_writes': 0, 'flushes': 0, 'failed_flushes': 0}
+
+    def _start(self):
+        # Started on first use, so importing the module (e.g. in scripts) spawns no thread
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def save_history(self, user_id, chat_started, messages):
+        """Buffers a save of a whole conversation. messages is the JSON string from the client."""
+        parsed_messages = json.loads(messages)
+        save = {
+            'user_id': user_id,
+            'chat_started': chat_started,
+            'messages': messages,
+            'first_message': first_user_message(parsed_messages),
+            'file_ids': attachment_ids(parsed_messages),
+            'saved_date': datetime.now(),
+        }
+        key = (user_id, chat_started)
+        with self._lock:
+            self._start()
+            if key in self._histories:
+                self.counters['coalesced'] += 1
+            self._histories[key] = save
+            self.counters['saves'] += 1
+            full = len(self._histories) >= max_pending
+        if full:
+            self._wake.set()
+
+    def discard_history(self, user_id, chat_started):
+        """Drops the pending saves of a conversation that is being deleted."""
+        # Waits for a running flush, it may be writing a save of this conversation
+        with self._flushing:
+            with self._lock:
+                if self._histories.pop((user_id, chat_started), None) is not None:
+                    self.counters['discarded'] += 1
+
+    def add_usage(self, record):
+        """Buffers a token usage record (see TokenUsage) and adds it to the pending rollups."""
+        record = dict(record, created_date=datetime.now())
+        increments = rollup_increments([record])
+        with self._lock:
+            self._start()
+            self._usage.append(record)
+            merge_increments(self._rollups, increments)
+            if len(self._usage) > max_usage_records:
+                dropped = len(self._usage) - max_usage_records
+                del self._usage[:dropped]
+                self.counters['usage_dropped'] += dropped
+
+    def _run(self):
+        while True:
+            self._wake.wait(flush_seconds)
+            self._wake.clear()
+            self.flush()
+
+    def _bulk_write(self, document, operations, what):
+        """Unordered bulk write, returns the indexes of the operations to retry."""
+        try:
+            document._get_collection().bulk_write(operations, ordered=False)
+            return []
+        except BulkWriteError as e:
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+            if errors:
+                logger.error("Write-behind: %s of %s %s failed, first error: %s",
+                             len(errors), len(operations), what, errors[0].get('errmsg'))
+            return [error['index'] for error in errors]
+        except Exception as e:
+            logger.error("Write-behind flush of %s %s failed: %s", len(operations), what, e)
+            return list(range(len(operations)))
+
+    def flush(self):
+        """Writes everything buffered. Safe to call from any thread."""
+        with self._flushing:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            histories, self._histories = self._histories, {}
+            usage, self._usage = self._usage, []
+            rollups, self._rollups = self._rollups, {}
+        if not histories and not usage and not rollups:
+            return
+
+        started = time.time()
+        failed = False
+        if histories:
+            saves = list(histories.items())
+            retry = self._bulk_write(History, [history_update(save) for key, save in saves], 'histories')
+            self.counters['history_writes'] += len(saves) - len(retry)
+            if retry:
+                failed = True
+                with self._lock:
+                    # Keep the failed saves unless the conversation was saved again meanwhile
+                    for index in retry:
+                        key, save = saves[index]
+                        self._histories.setdefault(key, save)
+        if usage:
+            # InsertOne sets the _id on the record, so a retried record is never inserted twice
+            retry = self._bulk_write(TokenUsage, [InsertOne(record) for record in usage], 'usage records')
+            self.counters['usage_records'] += len(usage) - len(retry)
+            if retry:
+                failed = True
+                with self._lock:
+                    self._usage[:0] = [usage[index] for index in retry]
+        if rollups:
+            # $inc is not idempotent: a write that failed on the network after the server
+            # applied it is counted twice on retry. Write errors reported by the server are exact.
+            increments = list(rollups.items())
+            retry = self._bulk_write(UsageRollup, [rollup_update(key, counters) for key, counters in increments],
+                                     'usage rollups')
+            self.counters['rollup_writes'] += len(increments) - len(retry)
+            if retry:
+                failed = True
+                with self._lock:
+                    merge_increments(self._rollups, dict(increments[index] for index in retry))
+        with self._lock:
+            self.counters['failed_flushes' if failed else 'flushes'] += 1
+        logger.debug("Write-behind flushed %s histories and %s usage records in %.3fs",
+                     len(histories), len(usage), time.time() - started)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending_histories=len(self._histories), pending_usage=len(self._usage),
+                        pending_rollups=len(self._rollups))
+
+
+write_behind = WriteBehindBuffer()
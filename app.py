@@ -13,6 +13,9 @@ from bson.objectid import ObjectId
 from core.helper import getList, handleDocument, deleteDocument, upload_file
 from core.db_helper import getFile
 from core.db_document import File, Prompt, getDefaults, History
+from core.logger import get_logger
+
+logger = get_logger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
@@ -106,7 +109,7 @@ def doc(name, id='', return_format='html'):
 					flash('Access denied. You can only view your own history.', 'error')
 					return redirect(url_for('list', collection='history'))
 			except Exception as e:
-				print(f"[DEBUG] Error accessing history document: {str(e)}")
+				logger.error("Error accessing history document: %s", e)
 				flash('Error accessing history document', 'error')
 				return redirect(url_for('list', collection='history'))
 
@@ -123,9 +126,9 @@ def doc(name, id='', return_format='html'):
 @app.route('/document/delete')
 @login_required
 def delete_document():
-	print(f"[DEBUG] Delete request received with args: {request.args}")
+	logger.debug("Delete request received with args: %s", request.args)
 	result = deleteDocument(request)
-	print(f"[DEBUG] Delete result: {result}")
+	logger.debug("Delete result: %s", result)
 	return jsonify(result)
 
 # Route to return a list of documents
@@ -165,7 +168,7 @@ def download_file(file_id):
 			filename = f"{file_id}.{file_data['file_type'].lower()}"
 			original_filename = file_data['name']
 			
-			print(f"[DEBUG] Attempting to send file: {path}/{filename}")
+			logger.debug("Attempting to send file: %s/%s", path, filename)
 			
 			# Get base path for absolute file locations
 			base_path = os.path.abspath(os.path.dirname(__file__))
@@ -173,7 +176,7 @@ def download_file(file_id):
 			# Try the direct path first
 			file_path = os.path.join(path, filename)
 			if os.path.exists(file_path):
-				print(f"[DEBUG] Found file at: {file_path}")
+				logger.debug("Found file at: %s", file_path)
 				return send_from_directory(
 					path, 
 					filename,
@@ -184,7 +187,7 @@ def download_file(file_id):
 			# Try absolute path
 			absolute_path = os.path.join(base_path, path, filename)
 			if os.path.exists(absolute_path):
-				print(f"[DEBUG] Found file at absolute path: {absolute_path}")
+				logger.debug("Found file at absolute path: %s", absolute_path)
 				directory, file = os.path.split(absolute_path)
 				return send_from_directory(
 					directory, 
@@ -198,7 +201,7 @@ def download_file(file_id):
 			if category:
 				standard_path = os.path.join(base_path, 'core', 'documents', category, filename)
 				if os.path.exists(standard_path):
-					print(f"[DEBUG] Found file in standard location: {standard_path}")
+					logger.debug("Found file in standard location: %s", standard_path)
 					directory, file = os.path.split(standard_path)
 					# Update the database record
 					file_obj.path = os.path.join('core', 'documents', category)
@@ -210,15 +213,15 @@ def download_file(file_id):
 						download_name=original_filename
 					)
 			
-			print(f"[DEBUG] File not found for id: {file_id}")
+			logger.warning("File not found for id: %s", file_id)
 			flash('The file could not be found on the server.', 'error')
 			return redirect(url_for('index'))
 		else:
-			print(f"[DEBUG] getFile returned error for id: {file_id} - {data.get('message', 'Unknown error')}")
+			logger.warning("getFile returned error for id: %s - %s", file_id, data.get('message', 'Unknown error'))
 			flash('Error retrieving file information.', 'error')
 			return redirect(url_for('index'))
 	except Exception as e:
-		print(f"[DEBUG] Error in download_file: {str(e)}")
+		logger.error("Error in download_file: %s", e)
 		flash('An error occurred while downloading the file.', 'error')
 		return redirect(url_for('index'))
 
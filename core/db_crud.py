@@ -12,9 +12,19 @@ from flask_login import current_user
 
 from db_default import getCounter
 from bson import ObjectId
+from core.logger import get_logger
+
+logger = get_logger(__name__)
+
+# collection -> callbacks run with the document before eraseDocument deletes it
+delete_hooks = {}
+
+def on_delete(collection, callback):
+    """Registers callback(document), run before a document of collection is deleted by eraseDocument"""
+    delete_hooks.setdefault(collection, []).append(callback)
 
 def createDocument(form_data, document, request=None):
-    print(f"[DEBUG] Starting createDocument with form_data keys: {form_data.keys()}")
+    logger.debug("Starting createDocument with form_data keys: %s", form_data.keys())
     # Remove csrf_token before processing
     form_data = {k: v for k, v in form_data.items() if k != 'csrf_token'}
     
@@ -29,7 +39,7 @@ def createDocument(form_data, document, request=None):
             counter = getCounter(counter_name)
             document[counter_name] = counter
         except Exception as e:
-            print(f"[DEBUG] Counter error: {str(e)}")
+            logger.error("Counter error: %s", e)
 
         # Process all non-file fields
         for key in form_data.keys():
@@ -72,14 +82,14 @@ def createDocument(form_data, document, request=None):
             return {'status': 'ok', 'message': '', 'data': document.to_json()}
             
         except ValidationError as e:
-            print(f"[DEBUG] Validation error: {str(e)}")
+            logger.error("Validation error: %s", e)
             return {'status': 'error', 'message': f'validation error: {str(e)}', 'data': document.to_json()}
         except Exception as e:
-            print(f"[DEBUG] Save error: {str(e)}")
+            logger.error("Save error: %s", e)
             return {'status': 'error', 'message': f'document not created: {str(e)}'}
 
     except Exception as e:
-        print(f"[DEBUG] Error in createDocument: {str(e)}")
+        logger.error("Error in createDocument: %s", e)
         return {'status': 'error', 'message': f'Error creating document: {str(e)}'}
 
 def updateDocument(form_data, document, collection):
@@ -87,7 +97,7 @@ def updateDocument(form_data, document, collection):
     form_data = {k: v for k, v in form_data.items() if k != 'csrf_token'}
     
     try:
-        print(f"[DEBUG] Updating document with id={form_data['id']}")
+        logger.debug("Updating document with id=%s", form_data['id'])
         object_id = ObjectId(form_data['id'])
         document = collection.objects(_id=object_id).first()
         
@@ -133,66 +143,69 @@ def updateDocument(form_data, document, collection):
             document.save()
             return {'status': 'ok', 'message': '', 'data': document.to_json()}
         except ValidationError as e:
-            print(f"Validation error: {str(e)}")
+            logger.error("Validation error: %s", e)
             return {'status': 'error', 'message': f'validation error: {str(e)}', 'data': document.to_json()}
         except Exception as e:
-            print(f"Error saving document: {str(e)}")
+            logger.error("Error saving document: %s", e)
             return {'status': 'error', 'message': f'error saving document: {str(e)}'}
             
     except Exception as e:
-        print(f"[DEBUG] Error in updateDocument: {str(e)}")
+        logger.error("Error in updateDocument: %s", e)
         return {'status': 'error', 'message': f'Error updating document: {str(e)}'}
 
 def eraseDocument(id, document, collection):
     try:
-        print(f"[DEBUG] eraseDocument called with id={id}, collection={collection.__name__}")
+        logger.debug("eraseDocument called with id=%s, collection=%s", id, collection.__name__)
         object_id = ObjectId(id)
         document = collection.objects(_id=object_id).first()
         
         if document is not None:
-            print(f"[DEBUG] Found document to delete: {document.to_json()}")
+            logger.debug("Found document to delete: %s", document.id)
             
             # Get base path for constructing absolute paths
             base_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-            print(f"[DEBUG] Base path: {base_path}")
+            logger.debug("Base path: %s", base_path)
             
             # Handle file deletion for both File collection and associated files
             if collection == File:
                 # Check if user has permission to delete this file
                 if not document.can_access(current_user):
-                    print(f"[DEBUG] Access denied for file deletion: {id}")
+                    logger.warning("Access denied for file deletion: %s", id)
                     return {'status': 'error', 'message': 'Access denied. You can only delete your own files.'}
                 
                 # Check if file is used by any prompt
                 prompts_using_file = Prompt.objects(document_id=str(id))
                 if prompts_using_file:
-                    print(f"[DEBUG] File {id} is used by prompts, cannot delete")
+                    logger.debug("File %s is used by prompts, cannot delete", id)
                     return {'status': 'error', 'message': 'File is used by one or more prompts and cannot be deleted'}
                     
                 # Direct file document deletion
                 try:
                     # Use the same path construction as upload_files
                     file_path = os.path.join(base_path, document.path, f"{id}.{document.file_type}")
-                    print(f"[DEBUG] Attempting to delete file at: {file_path}")
-                    print(f"[DEBUG] File exists: {os.path.exists(file_path)}")
+                    logger.debug("Attempting to delete file at: %s", file_path)
+                    logger.debug("File exists: %s", os.path.exists(file_path))
                     
                     if os.path.exists(file_path):
                         os.remove(file_path)
-                        print(f"[DEBUG] Successfully deleted file: {file_path}")
+                        logger.debug("Successfully deleted file: %s", file_path)
                     else:
-                        print(f'[DEBUG] Physical file not found at: {file_path}')
+                        logger.warning("Physical file not found at: %s", file_path)
                 except Exception as e:
-                    print(f'[DEBUG] Error deleting physical file: {str(e)}')
+                    logger.error("Error deleting physical file: %s", e)
                     return {'status': 'error', 'message': f'Error deleting physical file: {str(e)}'}
                 
                 try:
                     document.delete()
-                    print(f"[DEBUG] Successfully deleted file document from database")
+                    logger.debug("Successfully deleted file document from database")
                     return {'status': 'ok', 'message': 'deleted'}
                 except Exception as e:
-                    print(f'[DEBUG] Error deleting file document: {str(e)}')
+                    logger.error("Error deleting file document: %s", e)
                     return {'status': 'error', 'message': f'Error deleting file document: {str(e)}'}
             else:
+                for callback in delete_hooks.get(collection, []):
+                    callback(document)
+
                 # For non-File collections, handle associated files
                 file_ids = []
                 
@@ -206,52 +219,52 @@ def eraseDocument(id, document, collection):
                 
                 # Remove duplicates
                 file_ids = list(set(file_ids))
-                print(f"[DEBUG] Found {len(file_ids)} associated files")
-                print(f"[DEBUG] File IDs to process: {file_ids}")
+                logger.debug("Found %s associated files", len(file_ids))
+                logger.debug("File IDs to process: %s", file_ids)
                 
                 deleted_files = []
                 failed_files = []
                 
                 for file_id in file_ids:
                     try:
-                        print(f"[DEBUG] Processing associated file: {file_id}")
+                        logger.debug("Processing associated file: %s", file_id)
                         file_doc = File.objects(id=file_id).first()
                         if not file_doc:
-                            print(f"[DEBUG] File document not found: {file_id}")
+                            logger.warning("File document not found: %s", file_id)
                             failed_files.append(file_id)
                             continue
                             
                         # Check if file is used by any prompt
                         prompts_using_file = Prompt.objects(document_id=str(file_id))
                         if prompts_using_file:
-                            print(f"[DEBUG] File {file_id} is used by prompts, skipping")
+                            logger.debug("File %s is used by prompts, skipping", file_id)
                             failed_files.append(file_id)
                             continue
                         
                         # Check if user has permission to delete this file
                         if not file_doc.can_access(current_user):
-                            print(f"[DEBUG] Access denied for associated file deletion: {file_id}")
+                            logger.warning("Access denied for associated file deletion: %s", file_id)
                             failed_files.append(file_id)
                             continue
                             
                         # Delete physical file
                         # Use the same path construction as upload_files
                         file_path = os.path.join(base_path, file_doc.path, f"{file_id}.{file_doc.file_type}")
-                        print(f"[DEBUG] Attempting to delete associated file at: {file_path}")
-                        print(f"[DEBUG] File exists: {os.path.exists(file_path)}")
+                        logger.debug("Attempting to delete associated file at: %s", file_path)
+                        logger.debug("File exists: %s", os.path.exists(file_path))
                         
                         if os.path.exists(file_path):
                             os.remove(file_path)
-                            print(f"[DEBUG] Successfully deleted associated file: {file_path}")
+                            logger.debug("Successfully deleted associated file: %s", file_path)
                         else:
-                            print(f'[DEBUG] Physical file not found at: {file_path}')
+                            logger.warning("Physical file not found at: %s", file_path)
                         
                         # Delete file document
                         file_doc.delete()
                         deleted_files.append(file_id)
-                        print(f"[DEBUG] Successfully deleted associated file document: {file_id}")
+                        logger.debug("Successfully deleted associated file document: %s", file_id)
                     except Exception as e:
-                        print(f'[DEBUG] Error deleting associated file {file_id}: {str(e)}')
+                        logger.error("Error deleting associated file %s: %s", file_id, e)
                         failed_files.append(file_id)
                 
                 try:
@@ -259,24 +272,24 @@ def eraseDocument(id, document, collection):
                     status_msg = 'deleted'
                     if failed_files:
                         status_msg += f' (some associated files could not be deleted: {", ".join(map(str, failed_files))})'
-                    print(f"[DEBUG] Successfully deleted main document with status: {status_msg}")
+                    logger.debug("Successfully deleted main document with status: %s", status_msg)
                     return {'status': 'ok', 'message': status_msg}
                 except Exception as e:
-                    print(f'[DEBUG] Error deleting main document: {str(e)}')
+                    logger.error("Error deleting main document: %s", e)
                     return {'status': 'error', 'message': f'Error deleting document: {str(e)}'}
         else:
-            print(f"[DEBUG] No document found with id={id}")
+            logger.debug("No document found with id=%s", id)
             return {'status': 'error', 'message': 'document not found'}
     except Exception as e:
-        print(f"[DEBUG] Error in eraseDocument: {str(e)}")
+        logger.error("Error in eraseDocument: %s", e)
         return {'status': 'error', 'message': f'Error deleting document: {str(e)}'}
 
 def getDocument(id, document, collection):
     try:
-        print(f"[DEBUG] Querying collection {collection.__name__} for document with id={id}")
+        logger.debug("Querying collection %s for document with id=%s", collection.__name__, id)
         # Convert string id to ObjectId
         object_id = ObjectId(id)
-        print(f"[DEBUG] Using ObjectId: {object_id}")
+        logger.debug("Using ObjectId: %s", object_id)
         
         # Try direct query first
         document = collection.objects(_id=object_id).first()
@@ -289,11 +302,8 @@ def getDocument(id, document, collection):
             #print(f"[DEBUG] Found document: {document.to_json()}")
             return {'status': 'ok', 'message': '', 'data': document.to_json()}
         else:
-            # Let's print all documents in collection to debug
-            all_docs = collection.objects().limit(1)
-            print(f"[DEBUG] Sample document from collection: {[doc.to_json() for doc in all_docs]}")
-            print(f"[DEBUG] No document found with id={id} in collection {collection.__name__}")
+            logger.debug("No document found with id=%s in collection %s", id, collection.__name__)
             return {'status': 'error', 'message': f'Document not found in {collection.__name__}'}
     except Exception as e:
-        print(f"[DEBUG] Error in getDocument: {str(e)}")
+        logger.error("Error in getDocument: %s", e)
         return {'status': 'error', 'message': f'Error retrieving document: {str(e)}'}
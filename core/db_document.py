@@ -6,6 +6,9 @@ from flask_login import UserMixin, current_user
 from flask import url_for
 from datetime import datetime
 from mongoengine import *
+from core.logger import get_logger
+
+logger = get_logger(__name__)
 
 class AuditMixin:
     created_date = DateTimeField(default=lambda: datetime.now())
@@ -37,8 +40,9 @@ class AuditMixin:
 #every document needs a required name field !!!
 
 #converts mongo to Json and formats _date properly
-def mongoToJson(document):
-    data = document.to_mongo()
+#fields limits the output to these fields (e.g. of a list loaded with a projection)
+def mongoToJson(document, fields=None):
+    data = document.to_mongo(fields=['id'] + list(fields)) if fields else document.to_mongo()
     
     # Format all date fields (including audit fields)
     for key, value in data.items():
@@ -59,6 +63,16 @@ def mongoToJson(document):
 
     return json_util.dumps(data)
 
+# Language of the text indexes (stemming and stop words of the list search)
+TEXT_SEARCH_LANGUAGE = 'german'
+
+def text_index(fields, weights=None):
+    """Text index over the searchFields() of a document, used by the list search (db_helper.searchDocuments)"""
+    spec = {'fields': ['$' + name for name in fields], 'default_language': TEXT_SEARCH_LANGUAGE}
+    if weights:
+        spec['weights'] = weights
+    return spec
+
 class CustomQuerySet(QuerySet):
     def to_json(self):
         return "[%s]" % (",".join([doc.to_json() for doc in self]))
@@ -77,14 +91,14 @@ class Default(DynamicDocument):
         return mongoToJson(self)
     
 def getDefaults(name):
-    print(f"[DEBUG] getDefaults called with name={name}")
+    logger.debug("getDefaults called with name=%s", name)
     defaults = None
     
     def create_document(doc_class):
         try:
             return doc_class()
         except Exception as e:
-            print(f"[DEBUG] Error creating document instance: {str(e)}")
+            logger.error("Error creating document instance: %s", e)
             return None
     
     if name == 'filter':
@@ -100,10 +114,10 @@ def getDefaults(name):
     elif name == 'history':
         defaults = ['history', 'history', 'History','Histories', History, create_document(History), 'history']
     elif name == 'prompt' or name == 'prompts':
-        print("[DEBUG] Found prompt match")
+        logger.debug("Found prompt match")
         defaults = ['prompt', 'prompts', 'Prompt','Prompts', Prompt, create_document(Prompt), 'prompts']
 
-    print(f"[DEBUG] defaults={defaults}")
+    logger.debug("defaults=%s", defaults)
     if defaults:
         try:
             d = Default()
@@ -117,16 +131,16 @@ def getDefaults(name):
             d.collection = defaults[4]
             d.document = defaults[5]
             if d.document is None:
-                print("[DEBUG] Failed to create document instance")
+                logger.warning("Failed to create document instance")
                 return None
             d.menu = {defaults[6]: 'open active', defaults[1]: 'open active'}
-            print("[DEBUG] Created Default object successfully")
+            logger.debug("Created Default object successfully")
             return d
         except Exception as e:
-            print(f"[DEBUG] Error creating Default object: {str(e)}")
+            logger.error("Error creating Default object: %s", e)
             return None
     else:
-        print("[DEBUG] No defaults found")
+        logger.debug("No defaults found")
         return None
 
 class AccessControlMixin:
@@ -143,6 +157,11 @@ class AccessControlMixin:
         """Default list filter - no filtering"""
         return None
 
+    @classmethod
+    def access_fields(cls):
+        """Fields can_access needs, loaded with every list row"""
+        return []
+
 class User(UserMixin, AccessControlMixin, DynamicDocument):
     firstname = StringField(required=True)
     name = StringField(required=True)
@@ -159,7 +178,8 @@ class User(UserMixin, AccessControlMixin, DynamicDocument):
     
     meta = {
         'collection': 'user',
-        'queryset_class': CustomQuerySet
+        'queryset_class': CustomQuerySet,
+        'indexes': [text_index(['email', 'firstname', 'name'])]
     }
     def searchFields(self):
         return ['email','firstname','name']
@@ -210,7 +230,15 @@ class File(AccessControlMixin, AuditMixin, DynamicDocument):
     name = StringField(required=True, min_length=4)
     owner_id = StringField(required=True)
     category = StringField(default='')  # 'prompt' or 'history' or other categories
-    meta = {'queryset_class': CustomQuerySet}
+    meta = {
+        'queryset_class': CustomQuerySet,
+        'indexes': [
+            text_index(['name']),
+            'document_id',  # files of a prompt
+            ['owner_id', 'category'],  # list filter, both parts of its $or need an index
+            'category',
+        ]
+    }
     
     def searchFields(self):
         return ['name']
@@ -255,6 +283,10 @@ class File(AccessControlMixin, AuditMixin, DynamicDocument):
             ]
         }
 
+    @classmethod
+    def access_fields(cls):
+        return ['owner_id', 'category']
+
     def save(self, *args, **kwargs):
         if not self.owner_id and current_user and current_user.is_authenticated:
             self.owner_id = str(current_user.id)
@@ -265,7 +297,10 @@ class File(AccessControlMixin, AuditMixin, DynamicDocument):
 
 class Filter(AccessControlMixin, AuditMixin, DynamicDocument):
     name = StringField(required=True, min_length=4)
-    meta = {'queryset_class': CustomQuerySet}
+    meta = {
+        'queryset_class': CustomQuerySet,
+        'indexes': [text_index(['name']), 'category']
+    }
     
     def searchFields(self):
         return ['name']
@@ -314,7 +349,10 @@ class Example(AccessControlMixin, AuditMixin, DynamicDocument):
     more_files = StringField(default='')
     link = StringField(default='')
     
-    meta = {'queryset_class': CustomQuerySet}
+    meta = {
+        'queryset_class': CustomQuerySet,
+        'indexes': [text_index(['name', 'email', 'firstname'])]
+    }
     
     #these are the search fields for the search field in the document list overview page
     def searchFields(self):
@@ -399,12 +437,33 @@ class Example(AccessControlMixin, AuditMixin, DynamicDocument):
 
 #AI Documents
 #AI Chat Bot Code
+class CatalogVersion(Document):
+    """Version stamp of a cached catalog (e.g. the model catalog), bumped on every change"""
+    name = StringField(required=True, unique=True)
+    version = IntField(default=0)
+
+    meta = {'collection': 'catalog_versions'}
+
+# Changes made by this process, so its own caches notice them without asking the database
+local_catalog_versions = {}
+
+def bump_catalog_version(name):
+    local_catalog_versions[name] = local_catalog_versions.get(name, 0) + 1
+    CatalogVersion.objects(name=name).update_one(inc__version=1, upsert=True)
+
+def catalog_version(name):
+    stamp = CatalogVersion.objects(name=name).only('version').first()
+    return stamp.version if stamp else 0
+
 class Model(AccessControlMixin, AuditMixin, DynamicDocument):
     provider = StringField(required=True, min_length=1)
     model = StringField(required=True, min_length=1)
     name = StringField(required=True, min_length=1)
 
-    meta = {'queryset_class': CustomQuerySet}
+    meta = {
+        'queryset_class': CustomQuerySet,
+        'indexes': [text_index(['provider', 'model', 'name'])]
+    }
 
     def searchFields(self):
         return ['provider', 'model', 'name']
@@ -413,10 +472,21 @@ class Model(AccessControlMixin, AuditMixin, DynamicDocument):
         provider = {'name': 'provider', 'label': 'Provider', 'class': '', 'type': 'SingleLine', 'required': True, 'full_width': True}
         model = {'name': 'model', 'label': 'Model', 'class': '', 'type': 'SingleLine', 'required': True, 'full_width': True}
         name = {'name': 'name', 'label': 'Name', 'class': '', 'type': 'SingleLine', 'required': True, 'full_width': True}
+        max_concurrency = {'name': 'max_concurrency_int', 'label': 'Max. parallel Requests', 'class': '', 'type': 'IntField', 'full_width': False}
+        tpm = {'name': 'tpm_int', 'label': 'Tokens per Minute', 'class': '', 'type': 'IntField', 'full_width': False}
+        response_cache = {'name': 'response_cache', 'label': 'Response Cache', 'class': '', 'type': 'CheckBox', 'full_width': False}
+        hedge_model = {'name': 'hedge_model', 'label': 'Hedge Model', 'class': '', 'type': 'SingleLine', 'full_width': False}
+        hedge_percentile = {'name': 'hedge_percentile_int', 'label': 'Hedge Percentile', 'class': '', 'type': 'IntField', 'full_width': False}
+        context_window = {'name': 'context_window_int', 'label': 'Context Window (Tokens)', 'class': '', 'type': 'IntField', 'full_width': False}
+        context_budget = {'name': 'context_budget_int', 'label': 'Context Budget (Tokens)', 'class': '', 'type': 'IntField', 'full_width': False}
+        input_price = {'name': 'input_price_float', 'label': 'Input Price (USD / 1M Tokens)', 'class': '', 'type': 'FloatField', 'full_width': False}
+        output_price = {'name': 'output_price_float', 'label': 'Output Price (USD / 1M Tokens)', 'class': '', 'type': 'FloatField', 'full_width': False}
+        tool_calling = {'name': 'tool_calling', 'label': 'Tool Calling', 'class': '', 'type': 'CheckBox', 'full_width': False}
 
         if list_order:
             return [name, provider, model]
-        return [name, provider, model]
+        return [name, provider, model, max_concurrency, tpm, response_cache, hedge_model, hedge_percentile, context_window, context_budget,
+                input_price, output_price, tool_calling]
 
     def can_access(self, user):
         """Only admins can access models"""
@@ -431,6 +501,16 @@ class Model(AccessControlMixin, AuditMixin, DynamicDocument):
         """No additional filtering needed since access is already admin-only"""
         return None
 
+    def save(self, *args, **kwargs):
+        # Invalidates the cached model catalogs of all processes (ai/ai_models.py)
+        result = super().save(*args, **kwargs)
+        bump_catalog_version('model')
+        return result
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        bump_catalog_version('model')
+
     def to_json(self):
         return mongoToJson(self)
 
@@ -442,7 +522,21 @@ class History(AccessControlMixin, AuditMixin, DynamicDocument):
     link = StringField(default='')
     file_ids = ListField(StringField())
     
-    meta = {'queryset_class': CustomQuerySet}
+    meta = {
+        'queryset_class': CustomQuerySet,
+        # The unique and the text index can take long or fail on existing data (duplicate chats,
+        # see scripts/dedupe_history.py): built by core/db_indexes.py ensure-indexes, not on first use
+        'auto_create_index': False,
+        # A match in the first message ranks above one somewhere in the conversation
+        'indexes': [
+            text_index(['messages', 'first_message'], weights={'first_message': 10, 'messages': 1}),
+            # save_chat; unique, a write-behind save older than the stored history must not insert a copy
+            {'fields': ['user_id', 'chat_started'], 'unique': True,
+             'partialFilterExpression': {'chat_started': {'$exists': True}}},
+            ['user_id', '-modified_date', '-_id'],  # recent chats in the chat navigation
+            ['user_id', '_id'],  # history list
+        ]
+    }
     
     def searchFields(self):
         return ['messages', 'first_message']
@@ -472,10 +566,14 @@ class History(AccessControlMixin, AuditMixin, DynamicDocument):
     @classmethod
     def get_list_filter(cls, user):
         """Filter to only show user's own history"""
-        print(f"[DEBUG] Getting list filter for user {user.id}")
+        logger.debug("Getting list filter for user %s", user.id)
         filter_dict = {'user_id': str(user.id)}
-        print(f"[DEBUG] Returning filter: {filter_dict}")
+        logger.debug("Returning filter: %s", filter_dict)
         return filter_dict
+
+    @classmethod
+    def access_fields(cls):
+        return ['user_id']
     
     def save(self, *args, **kwargs):
         if not self.user_id and current_user and current_user.is_authenticated:
@@ -495,7 +593,12 @@ class Prompt(AccessControlMixin, AuditMixin, DynamicDocument):
 
     meta = {
         'collection': 'prompts',
-        'queryset_class': CustomQuerySet
+        'queryset_class': CustomQuerySet,
+        'indexes': [
+            text_index(['name', 'system_message', 'prompt'], weights={'name': 10, 'system_message': 1, 'prompt': 2}),
+            # Prompts using a file, checked before the file is deleted
+            {'fields': ['document_id'], 'sparse': True},
+        ]
     }
 
     def __init__(self, *args, **kwargs):
@@ -513,10 +616,12 @@ class Prompt(AccessControlMixin, AuditMixin, DynamicDocument):
         prompt = {'name': 'prompt', 'label': 'Prompt', 'class': '', 'type': 'MultiLine', 'required': True, 'full_width': True}
         link = {'name': 'link', 'label': 'Use Prompt', 'class': '', 'type': 'ButtonField', 'full_width': False, 'link': '/chat/prompt'}
         files = {'name': 'files', 'label': 'Files', 'class': 'hidden-xs', 'type': 'FileField', 'full_width': True}
+        semantic_cache = {'name': 'semantic_cache', 'label': 'Semantic Cache', 'class': '', 'type': 'CheckBox', 'full_width': False}
+        similarity_threshold = {'name': 'similarity_threshold_float', 'label': 'Similarity Threshold', 'class': '', 'type': 'FloatField', 'full_width': False}
 
         if list_order:
             return [link, name, prompt]
-        return [name, welcome_message, system_message, prompt, files, link]
+        return [name, welcome_message, system_message, prompt, files, semantic_cache, similarity_threshold, link]
 
     def can_access(self, user):
         """Check if user can access this prompt"""
@@ -533,3 +638,88 @@ class Prompt(AccessControlMixin, AuditMixin, DynamicDocument):
 
     def to_json(self):
         return mongoToJson(self)
+
+class SemanticCache(DynamicDocument):
+    """Cached answers of the semantic cache, see ai/ai_semantic_cache.py"""
+    prompt_id = StringField(required=True)
+    model = StringField()
+    system_hash = StringField()
+    question = StringField()
+    embedding = ListField(FloatField())
+    answer = StringField()
+    created_date = DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'semantic_cache',
+        'queryset_class': CustomQuerySet,
+        'indexes': [['prompt_id', '-created_date'], ['prompt_id', 'model', 'system_hash', '-created_date']]
+    }
+
+class TokenUsage(DynamicDocument):
+    """Token usage of one model call, written by the write-behind buffer (ai/ai_write_behind.py)"""
+    user_id = StringField()
+    provider = StringField()
+    model = StringField()
+    stream = BooleanField()
+    prompt_tokens = IntField(default=0)
+    completion_tokens = IntField(default=0)
+    total_tokens = IntField(default=0)
+    cached_tokens = IntField(default=0)
+    cost = FloatField()
+    status = StringField()  # ok, error, cancelled
+    error = StringField()
+    created_date = DateTimeField(default=datetime.now)
+
+    meta = {
+        'collection': 'token_usage',
+        'queryset_class': CustomQuerySet
+    }
+
+class UsageRollup(DynamicDocument):
+    """Token usage per hour or day, user, provider and model, see ai/ai_usage.py"""
+    period = StringField(required=True)  # hour, day
+    bucket = DateTimeField(required=True)
+    user_id = StringField()
+    provider = StringField()
+    model = StringField()
+    calls = IntField(default=0)
+    errors = IntField(default=0)
+    cancelled = IntField(default=0)
+    prompt_tokens = IntField(default=0)
+    completion_tokens = IntField(default=0)
+    total_tokens = IntField(default=0)
+    cached_tokens = IntField(default=0)
+    cost = FloatField(default=0)
+    modified_date = DateTimeField()
+
+    meta = {
+        'collection': 'usage_rollups',
+        'queryset_class': CustomQuerySet,
+        'indexes': [
+            {'fields': ['period', 'bucket', 'user_id', 'provider', 'model'], 'unique': True},
+            ['user_id', 'period', 'bucket'],
+        ]
+    }
+
+class BatchJob(DynamicDocument):
+    """Offline batch runs of a prompt over a JSONL input file, see ai/ai_batch.py"""
+    prompt_id = StringField(required=True)
+    model = StringField(required=True)
+    input_file = StringField(required=True)
+    output_file = StringField(required=True)
+    status = StringField(default='created')  # created, running, completed, failed
+    workers = IntField(default=0)
+    total = IntField(default=0)
+    completed = IntField(default=0)
+    failed = IntField(default=0)
+    usage = DictField()
+    error = StringField(default='')
+    created_date = DateTimeField(default=datetime.now)
+    started_date = DateTimeField()
+    finished_date = DateTimeField()
+
+    meta = {
+        'collection': 'batch_jobs',
+        'queryset_class': CustomQuerySet,
+        'indexes': ['-created_date']
+    }
@@ -2,27 +2,49 @@
 # -*- coding: utf-8 -*-
 from core.db_connect import *
 from core.db_date import dbDates
-from core.db_document import File, getDefaults, Filter
+from core.db_document import File, getDefaults, Filter, mongoToJson
+from bson import json_util, ObjectId
+import base64
+import datetime
 import json
 import os
+import re
+import time
+from core.logger import get_logger
 
-def searchDocuments(collection, searchFields, start=0, limit=10, search='', filter=None, product_name='', mode=''):
-    print(f"[DEBUG] searchDocuments called with filter={filter}")
+logger = get_logger(__name__)
+
+# before=LAST_PAGE loads the last page by reading the sort order backwards
+LAST_PAGE = 'last'
+
+def searchDocuments(collection, searchFields, start=0, limit=10, search='', filter=None, product_name='', mode='', count=True,
+                    sort=None, order=1, after=None, before=None, fields=None):
+    """
+    One page of the documents matching search, filter and product name, sorted by
+    sort (+ _id) in order (1 or -1). Pages by offset (start) or, with an after or
+    before cursor from a previous page, by keyset: the query continues after the
+    sort key of the cursor document, so deep pages cost the same as the first one.
+    With a cursor, start is only used to number the rows. fields limits the loaded
+    (and returned) fields, the id is always included.
+
+    The search uses the text index of the collection (see text_index in db_document)
+    and without sort the results are ranked by relevance. A search ending with '*'
+    (e.g. 'Proj*') finds the searchFields starting with it instead.
+    """
+    logger.debug("searchDocuments called with filter=%s", filter)
     searchDict = {}
+    text_search = False
 
     # Handle search term if provided
     if search and search.strip():
-        searchArray = []
-        for name in searchFields:
-            searchArray.append({name: {'$regex': search, '$options': 'i'}})
-        searchDict = {'$or': searchArray}
+        searchDict, text_search = searchCondition(collection, searchFields, search.strip())
 
     # Handle filter
     if filter:
         if isinstance(filter, str):
             # For string filters, use getFilterDict
             filter_dict = getFilterDict(filter)
-            print(f"[DEBUG] Filter string converted to: {filter_dict}")
+            logger.debug("Filter string converted to: %s", filter_dict)
             if filter_dict:
                 if searchDict:
                     if '$and' not in searchDict:
@@ -32,7 +54,7 @@ def searchDocuments(collection, searchFields, start=0, limit=10, search='', filt
                     searchDict = {'$and': filter_dict}
         else:
             # For direct dictionary filters (like user_id filter)
-            print(f"[DEBUG] Using direct filter: {filter}")
+            logger.debug("Using direct filter: %s", filter)
             if searchDict:
                 if '$and' not in searchDict:
                     searchDict = {'$and': [searchDict, filter]}
@@ -52,29 +74,211 @@ def searchDocuments(collection, searchFields, start=0, limit=10, search='', filt
         else:
             searchDict = product_filter
 
-    print(f"[DEBUG] Final search dict: {searchDict}")
+    logger.debug("Final search dict: %s", searchDict)
+
+    relevance = text_search and sort is None
+    if sort is None:
+        sort = 'category_id' if mode == 'channels' else '_id'
+    if fields and sort != '_id' and sort not in fields:
+        # Page tokens are made from the sort field
+        fields = list(fields) + [sort]
 
     try:
-        # Test the query first
-        test_count = collection.objects(__raw__=searchDict).count()
-        print(f"[DEBUG] Test query found {test_count} documents")
-        
-        # Apply the query
-        if mode == 'channels':
-            recordsTotal = collection.objects(__raw__=searchDict).count()
-            documents = collection.objects(__raw__=searchDict).order_by('category_id').skip(start).limit(limit)
+        cursor = None
+        if relevance:
+            # Ranked pages have no sort key for a cursor, they are paged by offset
+            documents, recordsTotal, stats = facetQuery(collection, searchDict, start, limit, count=count,
+                                                        sort={'score': {'$meta': 'textScore'}, '_id': 1}, fields=fields)
+            result = processDocuments(documents, recordsTotal, start, limit)
+            result['after'] = result['before'] = None
+            result['query'] = stats
+            return result
+        if after or before:
+            cursor = LAST_PAGE if before == LAST_PAGE else decodeCursor(after or before, sort, order)
+        if cursor is None:
+            sort_spec = {sort: order} if sort == '_id' else {sort: order, '_id': order}
+            documents, recordsTotal, stats = facetQuery(collection, searchDict, start, limit, sort=sort_spec, count=count,
+                                                        fields=fields)
+            result = processDocuments(documents, recordsTotal, start, limit)
+            # Without count, facetQuery read one document more than the page
+            documents = documents[:limit]
+            has_prev, has_next = start > 0, result['next'] is not None
         else:
-            recordsTotal = collection.objects(__raw__=searchDict).count()
-            documents = collection.objects(__raw__=searchDict).skip(start).limit(limit)
-
-        return processDocuments(documents, recordsTotal, start, limit)
+            backwards = not after
+            documents, has_more, recordsTotal, stats = keysetQuery(
+                collection, searchDict, sort, order, limit, None if cursor == LAST_PAGE else cursor, backwards, count, fields)
+            if cursor == LAST_PAGE and recordsTotal is not None:
+                start = max(0, recordsTotal - len(documents))
+            has_prev = has_more if backwards else True
+            has_next = cursor != LAST_PAGE and (True if backwards else has_more)
+            result = processKeysetDocuments(documents, recordsTotal, start, limit, has_prev, has_next)
+        result['after'] = encodeCursor(documents[-1], sort, order) if has_next and documents else None
+        result['before'] = encodeCursor(documents[0], sort, order) if has_prev and documents else None
+        result['query'] = stats
+        return result
     except Exception as e:
-        print(f"[DEBUG] Error in searchDocuments: {str(e)}")
-        print(f"[DEBUG] Collection: {collection}")
-        print(f"[DEBUG] Search dict: {searchDict}")
+        logger.error("Error in searchDocuments: %s", e)
+        logger.debug("Collection: %s", collection)
+        logger.debug("Search dict: %s", searchDict)
         return {'status': 'error', 'message': str(e)}
 
 
+def hasTextIndex(collection):
+    return any(direction == 'text' for spec in collection._meta.get('index_specs', [])
+               for name, direction in spec['fields'])
+
+
+def searchCondition(collection, searchFields, search):
+    """
+    Query of a search term: a $text search, or for 'term*' (and collections without
+    text index) an anchored prefix match of the escaped term on the searchFields.
+    Returns (query, text_search).
+    """
+    if search.endswith('*') or not hasTextIndex(collection):
+        prefix = re.escape(search.rstrip('*'))
+        return {'$or': [{name: {'$regex': '^' + prefix, '$options': 'i'}} for name in searchFields]}, False
+    return {'$text': {'$search': search}}, True
+
+
+def encodeCursor(document, sort, order):
+    """Opaque page token with the sort key (sort value and id) of a document"""
+    value = document.pk if sort == '_id' else getattr(document, sort, None)
+    payload = json_util.dumps({'s': sort, 'o': order, 'v': value, 'id': document.pk})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+# Types a sort key in a page token may have; a dict or list would be read as a query operator
+CURSOR_VALUE_TYPES = (str, int, float, datetime.datetime, ObjectId, type(None))
+
+
+def decodeCursor(token, sort, order):
+    """(value, id) of a page token, None if it is invalid or was made for another sort"""
+    try:
+        payload = json_util.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except Exception:
+        logger.debug("Invalid page token %s", token)
+        return None
+    if not isinstance(payload, dict) or payload.get('s') != sort or payload.get('o') != order:
+        return None
+    value, id = payload.get('v'), payload.get('id')
+    if not isinstance(value, CURSOR_VALUE_TYPES) or not isinstance(id, CURSOR_VALUE_TYPES) or id is None:
+        logger.warning("Page token with a non-scalar sort key rejected: %s", token)
+        return None
+    return value, id
+
+
+def keysetCondition(sort, value, id, direction):
+    """Documents after (direction 1) or before (direction -1) the sort key (value, id)"""
+    op = '$gt' if direction > 0 else '$lt'
+    if sort == '_id':
+        return {'_id': {op: id}}
+    conditions = [{sort: value, '_id': {op: id}}]
+    # Missing and null values sort before all others
+    if value is None:
+        if direction > 0:
+            conditions.append({sort: {'$ne': None}})
+    else:
+        conditions.append({sort: {op: value}})
+        if direction < 0:
+            conditions.append({sort: None})
+    return {'$or': conditions}
+
+
+def keysetFind(query, sort, order, cursor=None, backwards=False):
+    """Filter and sort [(field, direction)] of a keyset page, see keysetQuery"""
+    direction = -order if backwards else order
+    match = query
+    if cursor is not None:
+        condition = keysetCondition(sort, cursor[0], cursor[1], direction)
+        match = {'$and': [query, condition]} if query else condition
+    sort_spec = [('_id', direction)] if sort == '_id' else [(sort, direction), ('_id', direction)]
+    return match, sort_spec
+
+
+def keysetQuery(collection, query, sort, order, limit, cursor=None, backwards=False, count=True, fields=None):
+    """
+    The limit documents after cursor (value, id) in the sort order, or before it with
+    backwards=True (without cursor: the last page). Reads one document more to know
+    if there are more. Counting all matches takes a second round trip.
+    Returns (documents, has_more, recordsTotal, stats).
+    """
+    started = time.time()
+    match, sort_spec = keysetFind(query, sort, order, cursor, backwards)
+    collection_object = collection._get_collection()
+    raw_documents = list(collection_object.find(match, projection(fields)).sort(sort_spec).limit(limit + 1))
+    has_more = len(raw_documents) > limit
+    raw_documents = raw_documents[:limit]
+    if backwards:
+        raw_documents.reverse()
+    round_trips = 1
+    recordsTotal = None
+    if count:
+        recordsTotal = collection_object.count_documents(query)
+        round_trips += 1
+
+    documents = DocumentList((collection._from_son(raw) for raw in raw_documents), fields)
+    stats = {'round_trips': round_trips, 'counted': count, 'seconds': round(time.time() - started, 4)}
+    logger.debug("keysetQuery on %s: %s documents in %ss", collection.__name__, len(documents), stats['seconds'])
+    return documents, has_more, recordsTotal, stats
+
+
+class DocumentList(list):
+    """Documents loaded by an aggregation, serialized like a CustomQuerySet (only fields, if given)"""
+    def __init__(self, documents=(), fields=None):
+        super().__init__(documents)
+        self.fields = fields
+
+    def to_json(self):
+        if self.fields:
+            # Fields that were not loaded would show up with their defaults
+            return "[%s]" % (",".join([mongoToJson(doc, self.fields) for doc in self]))
+        return "[%s]" % (",".join([doc.to_json() for doc in self]))
+
+
+def projection(fields):
+    return {name: 1 for name in fields} if fields else None
+
+
+def facetPipeline(query, start=0, limit=10, sort=None, count=True, fields=None):
+    pipeline = [{'$match': query}]
+    if sort:
+        pipeline.append({'$sort': sort})
+    page = [{'$skip': start}, {'$limit': limit if count else limit + 1}]
+    if fields:
+        page.append({'$project': projection(fields)})
+    if count:
+        # The whole result is one document, so a page must stay below 16 MB
+        pipeline.append({'$facet': {'page': page, 'total': [{'$count': 'count'}]}})
+    else:
+        pipeline.extend(page)
+    return pipeline
+
+
+def facetQuery(collection, query, start=0, limit=10, sort=None, count=True, fields=None):
+    """
+    Loads one page of documents and the number of all matching documents with a
+    single $facet aggregation (one round trip instead of a count plus a find).
+    With count=False the total is not computed (None); one extra document is read
+    instead, so the caller still knows if there is a next page. fields limits the
+    loaded fields.
+    Returns (documents, recordsTotal, stats), stats has the round trips and seconds.
+    """
+    started = time.time()
+    result = list(collection._get_collection().aggregate(facetPipeline(query, start, limit, sort, count, fields)))
+    if count:
+        raw_documents = result[0]['page'] if result else []
+        total = result[0]['total'] if result else []
+        recordsTotal = total[0]['count'] if total else 0
+    else:
+        raw_documents = result
+        recordsTotal = None
+
+    documents = DocumentList((collection._from_son(raw) for raw in raw_documents), fields)
+    stats = {'round_trips': 1, 'counted': count, 'seconds': round(time.time() - started, 4)}
+    logger.debug("facetQuery on %s: %s documents in %ss", collection.__name__, len(documents), stats['seconds'])
+    return documents, recordsTotal, stats
+
+
 
 
 def getFile(file_id):
@@ -87,33 +291,33 @@ def getFile(file_id):
             # Check relative path
             file_path = os.path.join(file.path, f"{file_id}.{file.file_type}")
             if os.path.exists(file_path):
-                print(f"[DEBUG] File exists at path: {file_path}")
+                logger.debug("File exists at path: %s", file_path)
                 return {'status': 'ok', 'message': '', 'data': file.to_json()}
             
             # Check absolute path
             abs_path = os.path.join(base_path, file.path, f"{file_id}.{file.file_type}")
             if os.path.exists(abs_path):
-                print(f"[DEBUG] File exists at absolute path: {abs_path}")
+                logger.debug("File exists at absolute path: %s", abs_path)
                 return {'status': 'ok', 'message': '', 'data': file.to_json()}
             
             # Check if the file exists in the category folder
             if hasattr(file, 'category') and file.category:
                 category_path = os.path.join(base_path, 'core', 'documents', file.category, f"{file_id}.{file.file_type}")
                 if os.path.exists(category_path):
-                    print(f"[DEBUG] File found in category folder: {category_path}")
+                    logger.debug("File found in category folder: %s", category_path)
                     # Update the file path in the database
                     file.path = os.path.join('core', 'documents', file.category)
                     file.save()
                     return {'status': 'ok', 'message': '', 'data': file.to_json()}
             
-            print(f"[DEBUG] Physical file not found at: {file_path}")
+            logger.warning("Physical file not found at: %s", file_path)
             # Just return the file data anyway and let download_file handle the rest
             return {'status': 'ok', 'message': '', 'data': file.to_json()}
         else:
-            print(f"[DEBUG] No file record found for id: {file_id}")
+            logger.debug("No file record found for id: %s", file_id)
             return {'status': 'error', 'message': 'File record not found'}
     except Exception as e:
-        print(f"[DEBUG] Error in getFile: {str(e)}")
+        logger.error("Error in getFile: %s", e)
         return {'status': 'error', 'message': str(e)}
 
 
@@ -134,11 +338,10 @@ def getDocumentsByID(collection, name, start=0, limit=10, id=''):
         }
         
     try:
-        recordsTotal = collection.objects(__raw__={name: {'$regex': id}}).count()
-        documents = collection.objects(__raw__={name: {'$regex': id}}).skip(start).limit(limit)
+        documents, recordsTotal, stats = facetQuery(collection, {name: {'$regex': id}}, start, limit)
         return processDocuments(documents, recordsTotal, start, limit)
     except Exception as e:
-        print(f"[DEBUG] Error in getDocumentsByID: {str(e)}")
+        logger.error("Error in getDocumentsByID: %s", e)
         return {'status': 'error', 'message': 'Error retrieving documents'}
 
 def getDocumentName(id, mode,field):
@@ -180,7 +383,7 @@ def getFilter(category):
 #         return []
 
 def processDocuments(documents, recordsTotal, start, limit):
-    print('processDocuments')
+    logger.debug("processDocuments")
     
     # Handle case where documents is None
     if documents is None:
@@ -188,12 +391,20 @@ def processDocuments(documents, recordsTotal, start, limit):
 
     # Calculate pagination values
     prev = max(0, start - limit) if start - limit > -1 else 0
-    next = start + limit if start + limit < recordsTotal else None
-    last = recordsTotal - limit if recordsTotal > limit else None
-    
-    # Adjust start and end values
-    end = min(start + limit, recordsTotal)
-    display_start = start + 1 if recordsTotal > 0 else start
+    if recordsTotal is None:
+        # Not counted (facetQuery with count=False): one document more than the page was read
+        next = start + limit if len(documents) > limit else None
+        last = None
+        documents = DocumentList(documents[:limit], documents.fields)
+        end = start + len(documents)
+        display_start = start + 1 if documents else start
+    else:
+        next = start + limit if start + limit < recordsTotal else None
+        last = recordsTotal - limit if recordsTotal > limit else None
+
+        # Adjust start and end values
+        end = min(start + limit, recordsTotal)
+        display_start = start + 1 if recordsTotal > 0 else start
 
     # Return successful response even if no documents found (empty list is valid)
     return {
@@ -209,6 +420,22 @@ def processDocuments(documents, recordsTotal, start, limit):
         'last': last
     }
 
+def processKeysetDocuments(documents, recordsTotal, start, limit, has_prev, has_next):
+    """Like processDocuments for a keyset page, start is the offset of its first row"""
+    end = start + len(documents)
+    return {
+        'status': 'ok',
+        'message': '',
+        'data': documents.to_json(),
+        'recordsTotal': recordsTotal,
+        'limit': limit,
+        'prev': max(0, start - limit) if has_prev else None,
+        'next': end if has_next else None,
+        'start': start + 1 if documents else start,
+        'end': end,
+        'last': max(0, recordsTotal - limit) if recordsTotal is not None and has_next else None
+    }
+
 def getFilterDict(filter_id):
     data = []
     try:
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Index maintenance for the collections of core/db_document.py.
+
+    python core/db_indexes.py ensure-indexes   # builds the indexes declared in meta
+    python core/db_indexes.py explain          # query plans of the hot queries
+
+The indexes are declared in the meta of each document. MongoEngine builds missing
+ones on first use, which can block a request for a long time on a big collection:
+run ensure-indexes on deployment instead. History has auto_create_index off, its
+indexes are only built here. ensure-indexes also lists indexes in the database that
+are no longer declared (they are not dropped). A failed build (e.g. the unique
+History index while duplicate chats exist, see scripts/dedupe_history.py) is
+reported and makes the command exit with status 1.
+
+explain runs explain() on the queries of getList (page, text search, keyset page),
+handleDocument, get_nav_items, save_chat and eraseDocument with sample values and
+prints the stages of the winning plans. Queries reading the whole collection
+(COLLSCAN) are flagged and make the command exit with status 1.
+"""
+import os
+import sys
+import argparse
+
+from bson import ObjectId
+
+# Add parent directory to Python path to find core module
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.db_document import (User, File, Filter, Example, Model, History, Prompt, SemanticCache, TokenUsage,
+                              UsageRollup, BatchJob, CatalogVersion)
+from core.db_helper import facetPipeline, keysetFind, searchCondition
+
+DOCUMENTS = [User, File, Filter, Example, Model, History, Prompt, SemanticCache, TokenUsage, UsageRollup, BatchJob,
+             CatalogVersion]
+
+# Documents with a list view (getList)
+LIST_DOCUMENTS = [User, File, Filter, Example, Model, History, Prompt]
+
+
+def ensure_indexes():
+    """Builds the declared indexes of every document, returns the number of failed builds."""
+    failed = 0
+    for document in DOCUMENTS:
+        name = document._get_collection_name()
+        try:
+            document.ensure_indexes()
+        except Exception as e:
+            print(f"{name:<18} ERROR building indexes: {e}")
+            failed += 1
+        differences = document.compare_indexes()
+        print(f"{name:<18} {len(document._meta.get('index_specs') or [])} declared indexes")
+        for index in differences['missing']:
+            print(f"  missing: {index}")
+        for index in differences['extra']:
+            print(f"  not declared: {index}")
+    return failed
+
+
+def find_command(document, query, sort=None, limit=None):
+    command = {'find': document._get_collection_name(), 'filter': query}
+    if sort:
+        command['sort'] = dict(sort)
+    if limit:
+        command['limit'] = limit
+    return command
+
+
+def aggregate_command(document, pipeline):
+    return {'aggregate': document._get_collection_name(), 'pipeline': pipeline, 'cursor': {}}
+
+
+def list_filter(document, user):
+    return document.get_list_filter(user) or {}
+
+
+def hot_queries():
+    """(name, document, explain command) of the queries the app runs most, with sample values."""
+    user = User(id=ObjectId(), role='user')
+    document_id = ObjectId()
+    queries = []
+
+    for document in LIST_DOCUMENTS:
+        name = document._get_collection_name()
+        query = list_filter(document, user)
+        search = searchCondition(document, document().searchFields(), 'beispiel')[0]
+        text_query = {'$and': [search, query]} if query else search
+        keyset_query, keyset_sort = keysetFind(query, '_id', 1, (document_id, document_id))
+        queries += [
+            (f"getList {name}", document, aggregate_command(document, facetPipeline(query, 0, 50, {'_id': 1}))),
+            (f"getList {name} search", document, aggregate_command(document, facetPipeline(
+                text_query, 0, 50, {'score': {'$meta': 'textScore'}, '_id': 1}))),
+            (f"getList {name} after", document, find_command(document, keyset_query, keyset_sort, 51)),
+            (f"handleDocument {name}", document, find_command(document, {'_id': document_id}, limit=1)),
+        ]
+
+    queries += [
+        ("get_nav_items history", History, find_command(
+            History, {'user_id': str(user.id)}, [('modified_date', -1), ('_id', -1)], 15)),
+        ("get_nav_items prompts", Prompt, find_command(Prompt, {}, [('_id', -1)], 5)),
+        ("save_chat", History, find_command(History, {'user_id': str(user.id), 'chat_started': 1700000000000})),
+        ("eraseDocument prompts using file", Prompt, find_command(Prompt, {'document_id': str(document_id)})),
+        ("eraseDocument files of document", File, find_command(File, {'document_id': str(document_id)})),
+    ]
+    return queries
+
+
+def winning_stages(explain):
+    """Stages of the winning plan(s) in an explain result, for find and aggregate."""
+    stages = []
+
+    def collect(node):
+        if isinstance(node, dict):
+            if 'stage' in node:
+                stages.append(node['stage'])
+            for value in node.values():
+                collect(value)
+        elif isinstance(node, list):
+            for value in node:
+                collect(value)
+
+    def search(node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'winningPlan':
+                    collect(value)
+                elif key != 'rejectedPlans':
+                    search(value)
+        elif isinstance(node, list):
+            for value in node:
+                search(value)
+
+    search(explain)
+    return stages
+
+
+def explain_report():
+    """Prints the plan of every hot query, returns the number of collection scans."""
+    collscans = 0
+    for name, document, command in hot_queries():
+        try:
+            explain = document._get_db().command('explain', command, verbosity='queryPlanner')
+        except Exception as e:
+            print(f"ERROR     {name}: {e}")
+            continue
+        stages = winning_stages(explain)
+        flag = 'OK'
+        if 'COLLSCAN' in stages:
+            flag = 'COLLSCAN'
+            collscans += 1
+        elif 'SORT' in stages:
+            flag = 'SORT'
+        print(f"{flag:<9} {name:<36} {' <- '.join(stages)}")
+    print(f"\n{collscans} queries scan a whole collection" if collscans else "\nNo collection scans")
+    return collscans
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the declared indexes and check the query plans.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('ensure-indexes', help='build the indexes declared in the document meta')
+    commands.add_parser('explain', help='explain the hot queries and flag collection scans')
+    args = parser.parse_args()
+
+    if args.command == 'ensure-indexes':
+        if ensure_indexes():
+            sys.exit(1)
+    elif explain_report():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
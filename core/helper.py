@@ -24,6 +24,9 @@ UPLOAD_FOLDER = 'temp'
 DOCUMENT_FOLDER = 'documents'
 
 import logging
+from core.logger import get_logger
+
+logger = get_logger(__name__)
 current_path = os.path.dirname(os.path.realpath(__file__)) + '/'
 # logging.basicConfig(format='%(asctime)s %(message)s\n\r',filename=current_path+'import_leads.log', level=logging.INFO,filemode='w')
 
@@ -67,6 +70,34 @@ def getRequestData(request):
 
     return start,limit,end,search, id,filter,product_name,offer_id
 
+def sortFields(document):
+    """Columns of the list view the list can be sorted by (all but buttons)"""
+    return [field['name'] for field in document.fields(list_order=True) if field['type'] != 'ButtonField']
+
+AUDIT_FIELDS = ['created_date', 'created_by', 'modified_date', 'modified_by']
+
+def listFields(document, request, return_json=False):
+    """
+    Fields a list loads: the list columns and the fields access control needs. JSON
+    requests may ask for other fields of the form with fields=name,name (unknown ones
+    are ignored). Large fields like the messages of a history stay in the database.
+    """
+    names = [field['name'] for field in document.fields(list_order=True)]
+    requested = request.args.get('fields') if return_json else None
+    if requested:
+        allowed = set(names) | {field['name'] for field in document.fields()} | set(AUDIT_FIELDS)
+        names = [name.strip() for name in requested.split(',') if name.strip() in allowed]
+    return list(dict.fromkeys(names + document.access_fields()))
+
+def getSortData(request, document):
+    """Sort column (None: default order), order (1/-1) and page cursors of a list request"""
+    sort = request.args.get('sort') or None
+    if sort and sort != '_id' and sort not in sortFields(document):
+        logger.debug("Ignoring unknown sort column %s", sort)
+        sort = None
+    order = -1 if request.args.get('order') == 'desc' else 1
+    return sort, order, request.args.get('after') or None, request.args.get('before') or None
+
 def initData():
     data = []
     prev = None
@@ -95,27 +126,28 @@ def loadData(mydata):
     return None
 
 def getList(name, request, filter=None, return_json=False):
-    print(f"[DEBUG] getList called for {name}")
+    logger.debug("getList called for %s", name)
     default = getDefaults(name)
     if default == None:
-        print("[DEBUG] No defaults found")
+        logger.debug("No defaults found")
         return redirect(url_for('index'))
         
     # Check if user can list this collection
     if not default.document.can_list(current_user):
-        print("[DEBUG] User cannot list this collection")
+        logger.debug("User cannot list this collection")
         flash('Access denied.', 'error')
         return redirect(url_for('index'))
         
     data, prev, next, last, recordsTotal = initData()
     start,limit,end,search,id,filter_param,product_name,offer_id = getRequestData(request)
+    sort, order, after, before = getSortData(request, default.document)
     
     filter_data = getFilter(default.document_name)
     mode = default.collection_name
     
     # Get access control filter for this document type
     access_filter = default.document.get_list_filter(current_user)
-    print(f"[DEBUG] Access filter: {access_filter}")
+    logger.debug("Access filter: %s", access_filter)
     
     # Combine all filters
     combined_filter = {}
@@ -127,20 +159,24 @@ def getList(name, request, filter=None, return_json=False):
         filter_dict = getFilterDict(filter_param)
         combined_filter.update(filter_dict)
     
-    print(f"[DEBUG] Combined filter: {combined_filter}")
+    logger.debug("Combined filter: %s", combined_filter)
 
     # Process the search query with combined filters
     # Pass empty dict if no filter to avoid "no filter found" error
     filter_to_use = combined_filter if combined_filter else {}
+    # JSON clients that page with next only can skip counting the whole collection (count=0)
+    count = not (return_json and request.args.get('count') in ('0', 'false'))
     mydata = searchDocuments(default.collection, default.document.searchFields(), 
-                           start, limit, search, filter_to_use, product_name, mode)
-    print(f"[DEBUG] Search results: {mydata}")
+                           start, limit, search, filter_to_use, product_name, mode, count=count,
+                           sort=sort, order=order, after=after, before=before,
+                           fields=listFields(default.document, request, return_json))
+    page_after = mydata.get('after')
+    page_before = mydata.get('before')
 
     processedData = loadData(mydata)
     if processedData:
         data, start, end, prev, next, recordsTotal, last = processedData
-        print(f"[DEBUG] Found {recordsTotal} records")
-        recordsTotal = int(recordsTotal) if recordsTotal is not None else 0
+        logger.debug("Found %s records in %s round trip(s)", recordsTotal, mydata['query']['round_trips'])
         if return_json:
             return jsonify({
                 'status': 'ok',
@@ -151,11 +187,19 @@ def getList(name, request, filter=None, return_json=False):
                 'next': next,
                 'last': last,
                 'start': start,
-                'end': end
+                'end': end,
+                'after': page_after,
+                'before': page_before,
+                'sort': sort,
+                'order': 'desc' if order == -1 else 'asc',
+                'query': mydata['query']
             })
+        recordsTotal = int(recordsTotal) if recordsTotal is not None else 0
 
     table_header = default.document.fields(list_order = True)
     table_content = tableContent(data, table_header)
+    sort_fields = sortFields(default.document)
+    order_name = 'desc' if order == -1 else 'asc'
 
     try:
         table = request.args.get('table')
@@ -183,7 +227,12 @@ def getList(name, request, filter=None, return_json=False):
                                  filter=filter_param,
                                  filter_data=filter_data,
                                  show_new_button=True,
-                                 product_name=product_name)
+                                 product_name=product_name,
+                                 sort=sort or '',
+                                 order=order_name,
+                                 sort_fields=sort_fields,
+                                 after=page_after,
+                                 before=page_before)
     except:
         pass
 
@@ -210,7 +259,12 @@ def getList(name, request, filter=None, return_json=False):
                          filter=filter_param,
                          filter_data=filter_data,
                          show_new_button=True,
-                         product_name=product_name)
+                         product_name=product_name,
+                         sort=sort or '',
+                         order=order_name,
+                         sort_fields=sort_fields,
+                         after=page_after,
+                         before=page_before)
 
 def handleDocument(name, id, request, return_json=False):
     try:
@@ -239,13 +293,13 @@ def handleDocument(name, id, request, return_json=False):
                 form_data['user_id'] = str(current_user.id)
                 request.form = form_data
 
-        print(f"[DEBUG] Got defaults: document_name={default.document_name}, collection_name={default.collection_name}")
+        logger.debug("Got defaults: document_name=%s, collection_name=%s", default.document_name, default.collection_name)
         mode = default.document_name
 
         # Initialize empty document data for new documents
         data = {}
         if not id:
-            print("[DEBUG] Creating new document")
+            logger.debug("Creating new document")
             try:
                 # Get the document instance that was already created in getDefaults
                 doc = default.document
@@ -257,7 +311,7 @@ def handleDocument(name, id, request, return_json=False):
                 if name == 'history':
                     data['user_id'] = str(current_user.id)
             except Exception as e:
-                print(f"[DEBUG] Error initializing new document: {str(e)}")
+                logger.error("Error initializing new document: %s", e)
                 flash('Error creating new document', 'error')
                 return redirect(url_for('index'))
 
@@ -271,46 +325,46 @@ def handleDocument(name, id, request, return_json=False):
         }
         
         form_data = htmlFormToDict(request.form)
-        print(f"[DEBUG] Form data: {form_data}")
+        logger.debug("Form data: %s", form_data)
         category_fields = []
 
         if name=='filter':
             form_data = prepFilterData(form_data)
 
         if request.method == 'POST':
-            print("[DEBUG] Processing POST request")
+            logger.debug("Processing POST request")
             if (form_data.get('id') and form_data['id'] not in ['', 'None', None]):
-                print(f'[DEBUG] Updating Document with ID: {form_data["id"]}')
+                logger.debug("Updating Document with ID: %s", form_data["id"])
                 data = updateDocument(form_data, default.document, default.collection)
             else:
-                print('[DEBUG] Creating new Document')
+                logger.debug("Creating new Document")
                 data = createDocument(form_data, default.document, request)
 
             if (data['status'] == 'ok'):
                 data = json.loads(data['data'])
                 data['id'] = data['_id']['$oid']
                 file_status = upload_files(request, default.collection_name, data['id'])
-                print(f"[DEBUG] File status: {file_status}")
+                logger.debug("File status: %s", file_status)
                 if return_json:
                     return json.dumps(data)
                 return redirect(url_for('doc', name=default.document_name) + '/' + data['id'])
             else:
-                print(f"[DEBUG] Error in POST: {data.get('message', 'Unknown error')}")
+                logger.warning("Error in POST: %s", data.get('message', 'Unknown error'))
                 return json.dumps(data)
 
         elif request.method == 'GET':
-            print(f"[DEBUG] Processing GET request with id={id}")
+            logger.debug("Processing GET request with id=%s", id)
             if id:
-                print(f'[DEBUG] Getting Document with ID: {id}')
+                logger.debug("Getting Document with ID: %s", id)
                 data = getDocument(id, default.document, default.collection)
-                print(f"[DEBUG] getDocument result: {data}")
+                logger.debug("getDocument result: %s", data)
                 if (data['status'] == 'ok'):
                     page = {'title': 'Edit ' + default.page_name_document, 'collection_title': default.collection_title, 'document_name': default.document_name, 'document_url': default.document_url, 'collection_url': default.collection_url, 'document_title': default.page_name_document}
                     data = json.loads(data['data'])
                     data['id'] = data['_id']['$oid']
                     
                     files = json.loads(File.objects(document_id=data['id']).to_json())
-                    print(f"[DEBUG] Found files: {files}")
+                    logger.debug("Found files: %s", files)
                     for file in files:
                         if not data.get(file['element_id']):
                             data[file['element_id']] = []
@@ -324,55 +378,54 @@ def handleDocument(name, id, request, return_json=False):
                     if 'category' in data and name == 'filter':
                         category_fields = getFields(data['category'])
                 else:
-                    print(f"[DEBUG] Error getting document: {data.get('message', 'Unknown error')}")
-                    print(f"[DEBUG] Redirecting to list with name={default.collection_name}")
+                    logger.warning("Error getting document: %s", data.get('message', 'Unknown error'))
+                    logger.debug("Redirecting to list with name=%s", default.collection_name)
                     return redirect(url_for('list', collection=default.collection_name))
 
-        print("[DEBUG] Getting elements")
+        logger.debug("Getting elements")
         elements = getElements(data, default.document)
         #print(f"[DEBUG] Elements: {elements}")
         return render_template('/base/document/form.html', elements=elements, menu=default.menu, page=page, document=data, mode=mode, category_fields=category_fields)
     except Exception as e:
-        print(f"[DEBUG] Error in handleDocument: {str(e)}")
+        logger.error("Error in handleDocument: %s", e)
         flash('An error occurred while processing your request', 'error')
         return redirect(url_for('index'))
 
 def deleteDocument(request):
     type = request.args.get('type')
     id = request.args.get('id')
-    print(f"[DEBUG] deleteDocument called with type={type}, id={id}")
+    logger.debug("deleteDocument called with type=%s, id=%s", type, id)
     
     if not id:
-        print("[DEBUG] No ID provided")
+        logger.debug("No ID provided")
         return {'status': 'error', 'message': 'no id'}
         
     # Special handling for file deletions
     if type == 'files':
-        print(f"[DEBUG] Handling file deletion for id={id}")
+        logger.debug("Handling file deletion for id=%s", id)
         data = eraseDocument(id, File, File)
-        print(f"[DEBUG] File deletion result: {data}")
+        logger.debug("File deletion result: %s", data)
     else:
-        print(f"[DEBUG] Handling document deletion for type={type}, id={id}")
+        logger.debug("Handling document deletion for type=%s, id=%s", type, id)
         default = getDefaults(type)
         if default == []:
-            print(f"[DEBUG] No defaults found for type={type}")
+            logger.debug("No defaults found for type=%s", type)
             return {'status': 'error', 'message': 'no document found'}
         data = eraseDocument(id, default.document, default.collection)
-        print(f"[DEBUG] Document deletion result: {data}")
+        logger.debug("Document deletion result: %s", data)
         
     if data['status'] == 'ok':
-        print("[DEBUG] Deletion successful")
+        logger.debug("Deletion successful")
         return {'status': 'ok', 'message': 'document deleted'}
     else:
-        print(f"[DEBUG] Deletion failed: {data.get('message', 'unknown error')}")
+        logger.warning("Deletion failed: %s", data.get('message', 'unknown error'))
         return {'status': 'error', 'message': data.get('message', 'document not deleted')}
 
 def tableContent(documents, table_header):
-    print(f"[DEBUG] Creating table content for {len(documents)} documents")
+    logger.debug("Creating table content for %s documents", len(documents))
     tableContent = []
 
     for document in documents:
-        print(f"[DEBUG] Processing document: {document}")
         tableRow = []
         for field in table_header:
             if field['name'] in document.keys() and 'id' in document.keys():
@@ -406,13 +459,13 @@ def tableContent(documents, table_header):
                         'label': field.get('label', field['name'])
                     })
             else:
-                print(f"[DEBUG] Field {field['name']} not found in document or no id")
+                logger.warning("Field %s not found in document or no id", field['name'])
                 tableRow.append('')
         
         if tableRow:  # Only add rows that have content
             tableContent.append(tableRow)
             
-    print(f"[DEBUG] Created {len(tableContent)} table rows")
+    logger.debug("Created %s table rows", len(tableContent))
     return tableContent
 
 def getElements(data, document):
@@ -479,10 +532,10 @@ def htmlFormToDict(form_data):
         elif isinstance(form_data, list):
             return {item['name']: item['value'] for item in form_data if 'name' in item and 'value' in item}
         else:
-            print(f"[DEBUG] Unexpected form_data type: {type(form_data)}")
+            logger.warning("Unexpected form_data type: %s", type(form_data))
             return {}
     except Exception as e:
-        print(f"[DEBUG] Error in htmlFormToDict: {str(e)}")
+        logger.error("Error in htmlFormToDict: %s", e)
         return {}
 def allowed_file(filename):
     return '.' in filename and \
@@ -513,11 +566,11 @@ def upload_files(request, category='', document_id=''):
                         relative_path = os.path.join('core', 'documents', category) if category else os.path.join('core', UPLOAD_FOLDER)
                         absolute_path = os.path.join(base_path, relative_path)
                         
-                        print(f"[DEBUG] Upload path (absolute): {absolute_path}")
-                        print(f"[DEBUG] Upload path (relative): {relative_path}")
+                        logger.debug("Upload path (absolute): %s", absolute_path)
+                        logger.debug("Upload path (relative): %s", relative_path)
 
                         if not os.path.exists(absolute_path):
-                            print(f"[DEBUG] Creating directory: {absolute_path}")
+                            logger.debug("Creating directory: %s", absolute_path)
                             os.makedirs(absolute_path)
 
                         file_type = filename.rsplit('.', 1)[1]
@@ -534,7 +587,7 @@ def upload_files(request, category='', document_id=''):
                         fileID = getDocumentID(fileDB)
 
                         file_save_path = os.path.join(absolute_path, f"{fileID}.{file_type}")
-                        print(f"[DEBUG] Saving file to: {file_save_path}")
+                        logger.debug("Saving file to: %s", file_save_path)
                         file.save(file_save_path)
 
                         status[element_id].append({
@@ -593,10 +646,10 @@ def prepare_context_from_files(files):
         "character_count": 0
     }
     
-    print(f"[DEBUG] prepare_context_from_files called with {len(files)} files")
+    logger.debug("prepare_context_from_files called with %s files", len(files))
     
     if not files:
-        print("[DEBUG] No files provided")
+        logger.debug("No files provided")
         result["status"] = "error"
         result["data"] = "No files provided"
         return result
@@ -604,15 +657,15 @@ def prepare_context_from_files(files):
     try:
         combined_text = []
         base_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
-        print(f"[DEBUG] Base path for file reading: {base_path}")
+        logger.debug("Base path for file reading: %s", base_path)
         
         for file in files:
             try:
-                print(f"[DEBUG] Processing file: {file.get('name', 'Unknown')}")
+                logger.debug("Processing file: %s", file.get('name', 'Unknown'))
                 # Convert MongoDB document to dict if needed
                 if hasattr(file, 'to_mongo'):
                     file = file.to_mongo().to_dict()
-                    print("[DEBUG] Converted MongoDB document to dict")
+                    logger.debug("Converted MongoDB document to dict")
                 
                 # Get file ID consistently
                 if isinstance(file.get('_id'), dict) and '$oid' in file['_id']:
@@ -621,71 +674,71 @@ def prepare_context_from_files(files):
                     file_id = file['_id']
                 else:
                     file_id = str(file['_id'])
-                print(f"[DEBUG] File ID: {file_id}")
+                logger.debug("File ID: %s", file_id)
                 
                 # Build full file path
                 file_path = os.path.join(base_path, file['path'], f"{file_id}.{file['file_type'].lower()}")
-                print(f"[DEBUG] Full file path: {file_path}")
+                logger.debug("Full file path: %s", file_path)
                 
                 if not os.path.exists(file_path):
-                    print(f"[DEBUG] File not found at path: {file_path}")
+                    logger.warning("File not found at path: %s", file_path)
                     continue
                 
-                print(f"[DEBUG] Reading file: {file['name']}")
+                logger.debug("Reading file: %s", file['name'])
                 file_content = f"\nContent of File: {file['name']}\n{'='*50}\n"
                 
                 if file['file_type'].lower() == 'pdf':
                     try:
                         with open(file_path, 'rb') as pdf_file:
                             pdf_reader = PdfReader(pdf_file)
-                            print(f"[DEBUG] PDF has {len(pdf_reader.pages)} pages")
+                            logger.debug("PDF has %s pages", len(pdf_reader.pages))
                             for page_num in range(len(pdf_reader.pages)):
                                 page = pdf_reader.pages[page_num]
                                 text = page.extract_text()
                                 if text:
-                                    print(f"[DEBUG] Extracted text from page {page_num + 1}")
+                                    logger.debug("Extracted text from page %s", page_num + 1)
                                     text = ' '.join(text.split())
                                     text = text.replace(' .', '.').replace(' ,', ',')
                                     paragraphs = text.split('\n')
                                     formatted_text = '\n\n'.join(p.strip() for p in paragraphs if p.strip())
                                     file_content += formatted_text + "\n\n"
                                 else:
-                                    print(f"[DEBUG] No text found on page {page_num + 1}")
+                                    logger.debug("No text found on page %s", page_num + 1)
                                     file_content += "[No text found on this page]\n\n"
                     except Exception as e:
-                        print(f"[DEBUG] Error reading PDF {file['name']}: {str(e)}")
+                        logger.error("Error reading PDF %s: %s", file['name'], e)
                         continue
                         
                 elif file['file_type'].lower() == 'txt':
                     try:
                         with open(file_path, 'r', encoding='utf-8') as txt_file:
                             text = txt_file.read()
-                            print(f"[DEBUG] Read {len(text)} characters from text file")
+                            logger.debug("Read %s characters from text file", len(text))
                             file_content += text
                     except Exception as e:
-                        print(f"[DEBUG] Error reading TXT {file['name']}: {str(e)}")
+                        logger.error("Error reading TXT %s: %s", file['name'], e)
                         continue
                         
                 file_content += f"\n{'='*50}\n"
-                print(f"[DEBUG] Added {len(file_content)} characters of content")
+                logger.debug("Added %s characters of content", len(file_content))
                 combined_text.append(file_content)
                 
             except Exception as e:
-                print(f"[DEBUG] Error processing file: {str(e)}")
+                logger.error("Error processing file: %s", e)
                 continue
             
         if combined_text:
             result["status"] = "ok"
             result["data"] = "\n".join(combined_text)
             result["character_count"] = len(result["data"])
-            print(f"[DEBUG] Successfully combined {len(combined_text)} files with total {result['character_count']} characters")
+            logger.debug("Successfully combined %s files with total %s characters", len(combined_text), result['character_count'])
         else:
-            print("[DEBUG] No content could be extracted from files")
+            logger.debug("No content could be extracted from files")
             result["status"] = "error"
             result["data"] = "No content could be extracted from files"
             
     except Exception as e:
-        print(f"[DEBUG] Error in prepare_context_from_files: {str(e)}")
+        logger.error("Error in prepare_context_from_files: %s", e)
         result["status"] = "error"
         result["data"] = f"Error processing files: {str(e)}"
 
@@ -699,36 +752,36 @@ def upload_file(file, category='history'):
     """Handle file upload for chat functionality and return file context"""
     try:
         if not file:
-            print("[DEBUG] No file object provided")
+            logger.debug("No file object provided")
             return {'status': 'error', 'message': 'No file provided'}
             
         if not hasattr(file, 'filename'):
-            print("[DEBUG] File object has no filename attribute")
+            logger.debug("File object has no filename attribute")
             return {'status': 'error', 'message': 'Invalid file object'}
             
         if not file.filename:
-            print("[DEBUG] Empty filename")
+            logger.debug("Empty filename")
             return {'status': 'error', 'message': 'No file selected'}
             
-        print(f"[DEBUG] Processing file: {file.filename}")
+        logger.debug("Processing file: %s", file.filename)
         filename = secure_filename(file.filename)
         
         # More robust file type extraction
         try:
             file_type = filename.rsplit('.', 1)[1].lower() if '.' in filename else None
             if not file_type:
-                print("[DEBUG] Could not extract file type")
+                logger.warning("Could not extract file type")
                 return {'status': 'error', 'message': 'Could not determine file type'}
         except Exception as e:
-            print(f"[DEBUG] Error extracting file type: {str(e)}")
+            logger.error("Error extracting file type: %s", e)
             return {'status': 'error', 'message': 'Invalid file type'}
             
         if not allowed_file(filename):
-            print(f"[DEBUG] File type {file_type} not allowed")
+            logger.warning("File type %s not allowed", file_type)
             return {'status': 'error', 'message': f'File type {file_type} not allowed'}
         
         if file_type not in ['pdf', 'txt', 'jpeg', 'jpg', 'png']:
-            print(f"[DEBUG] Unsupported file type: {file_type}")
+            logger.warning("Unsupported file type: %s", file_type)
             return {'status': 'error', 'message': 'Only PDF, TXT, and image files are supported'}
             
         # Get base path and construct relative/absolute paths consistently
@@ -736,12 +789,12 @@ def upload_file(file, category='history'):
         relative_path = os.path.join('core', 'documents', category)
         absolute_path = os.path.join(base_path, relative_path)
         
-        print(f"[DEBUG] Upload base path: {base_path}")
-        print(f"[DEBUG] Upload relative path: {relative_path}")
-        print(f"[DEBUG] Upload absolute path: {absolute_path}")
+        logger.debug("Upload base path: %s", base_path)
+        logger.debug("Upload relative path: %s", relative_path)
+        logger.debug("Upload absolute path: %s", absolute_path)
         
         if not os.path.exists(absolute_path):
-            print(f"[DEBUG] Creating directory: {absolute_path}")
+            logger.debug("Creating directory: %s", absolute_path)
             os.makedirs(absolute_path)
             
         fileDB = File(
@@ -755,7 +808,7 @@ def upload_file(file, category='history'):
         fileID = str(fileDB.id)
         
         file_save_path = os.path.join(absolute_path, f"{fileID}.{file_type}")
-        print(f"[DEBUG] Saving file to: {file_save_path}")
+        logger.debug("Saving file to: %s", file_save_path)
         file.save(file_save_path)
         
         response = {
@@ -779,18 +832,18 @@ def upload_file(file, category='history'):
                     'file_type': file_type
                 }
                 
-                print(f"[DEBUG] Getting context for file: {file_dict}")
+                logger.debug("Getting context for file: %s", file_dict)
                 context = prepare_context_from_files([file_dict])
                 
                 if context['status'] == 'ok':
-                    print(f"[DEBUG] Successfully extracted context with {context['character_count']} characters")
+                    logger.debug("Successfully extracted context with %s characters", context['character_count'])
                     response['content'] = context['data']
                     response['character_count'] = context['character_count']
                 else:
-                    print(f"[DEBUG] Context extraction failed: {context['data']}")
+                    logger.warning("Context extraction failed: %s", context['data'])
                     response['content'] = f"[Error extracting content from {filename}]"
             except Exception as e:
-                print(f"[DEBUG] Error getting file context: {str(e)}")
+                logger.error("Error getting file context: %s", e)
                 response['content'] = f"[Error processing {filename}: {str(e)}]"
                 
         # Add base64 for images
@@ -798,13 +851,13 @@ def upload_file(file, category='history'):
             try:
                 response['base64_image'] = encode_image(file_save_path)
             except Exception as e:
-                print(f"[DEBUG] Error encoding image: {str(e)}")
+                logger.error("Error encoding image: %s", e)
                 response['base64_image'] = None
                 
-        print(f"[DEBUG] Upload successful, returning response: {response}")
+        logger.debug("Upload successful, returning response: %s", response)
         return response
         
     except Exception as e:
-        print(f"[DEBUG] Upload error: {str(e)}")
+        logger.error("Upload error: %s", e)
         return {'status': 'error', 'message': str(e)}
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Logging for core/ and ai/.
+
+    from core.logger import get_logger
+    logger = get_logger(__name__)
+    logger.debug("Found %s records", count)
+
+Pass values as arguments instead of formatting them into the message: they are only
+formatted if the record is actually written, so disabled DEBUG calls cost next to
+nothing. Guard anything expensive to compute with logger.isEnabledFor(logging.DEBUG).
+
+- LOG_LEVEL: DEBUG, INFO (default), WARNING, ERROR
+- LOG_FORMAT: json (default, one JSON object per line) or text
+- LOG_SAMPLE_<LOGGER>: share of DEBUG/INFO records of a logger that is written, e.g.
+  LOG_SAMPLE_CORE_HELPER=0.01. Warnings and errors are never sampled.
+"""
+import os
+import sys
+import json
+import random
+import logging
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+load_dotenv()
+
+log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+log_format = os.getenv('LOG_FORMAT', 'json').lower()
+
+# Attributes every LogRecord has, everything else was passed with extra={...}
+STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+_configured = set()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through a share of the DEBUG and INFO records, all warnings and errors."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+def sample_rate(name):
+    value = os.getenv('LOG_SAMPLE_' + name.upper().replace('.', '_'))
+    return float(value) if value else 1.0
+
+
+def _configure(root_name):
+    """Sets up the handler once per top level logger (core, ai, app, ...)."""
+    if root_name in _configured:
+        return
+    _configured.add(root_name)
+
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'text':
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    else:
+        handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger(root_name)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, log_level, logging.INFO))
+    # Don't write records a second time through Flask's or the server's root handler
+    root.propagate = False
+
+
+def get_logger(name):
+    _configure(name.split('.')[0])
+    logger = logging.getLogger(name)
+    rate = sample_rate(name)
+    if rate < 1.0 and not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(rate))
+    return logger
@@ -0,0 +1,15 @@
+import sys
+import os
+
+# Add your project directory to Python path
+sys.path.insert(0, '/var/www/tests_alex/fireworks')
+sys.path.insert(0, '/var/www/tests_alex/fireworks/core')
+
+# Set environment variables if needed
+from dotenv import load_dotenv
+project_folder = os.path.expanduser('/var/www/tests_alex/fireworks')
+load_dotenv(os.path.join(project_folder, '.env'))
+
+# Import the ASGI streaming gateway, serve with e.g.
+# uvicorn fireworks_asgi:application --workers 2
+from ai.ai_asgi import application
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures how much latency and CPU our own streaming layers add per token.
+
+Starts the fake provider (ai/ai_fake_server.py) in a subprocess and runs the same
+streams at 1, 10 and 100 concurrent streams twice:
+
+- sdk:      directly with the provider SDK client (baseline)
+- llm_call: through llm_call (context fitting, scheduler, metrics, SSE framing)
+
+The difference between the two is the overhead of our layers. CPU is the CPU time of
+this process only, the fake server runs in its own process. Delta coalescing is off,
+so every delta event is one token like in the SDK stream. The benchmark model is not
+looked up in the model catalog and no usage records are written, so no MongoDB is
+needed.
+
+    python scripts/bench_stream.py --provider fake --levels 1,10,100 --rounds 3
+"""
+import os
+import sys
+import time
+import json
+import socket
+import argparse
+import subprocess
+import threading
+
+# The scheduler must not queue benchmark streams
+os.environ.setdefault('LLM_CONCURRENCY_FAKE', '10000')
+os.environ.setdefault('LLM_CONCURRENCY_FAKE_ANTHROPIC', '10000')
+os.environ.setdefault('LLM_POOL_MAX_CONNECTIONS', '1000')
+os.environ.setdefault('LLM_POOL_MAX_KEEPALIVE', '1000')
+# Coalesced frames carry several tokens, the token gaps must be comparable with the SDK stream
+os.environ['STREAM_COALESCE_MS'] = '0'
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai.ai_clients import get_client, ANTHROPIC_PROVIDERS
+from ai.ai_hedge import percentile
+from ai.ai_llm_helper import llm_call
+from ai.ai_models import model_catalog
+from ai.ai_write_behind import write_behind
+
+# The catalog's version check waits for MongoDB, the benchmark model is used as given
+model_catalog.resolve = lambda model: model
+# Flushing usage records would wait for MongoDB too (also at exit)
+write_behind.add_usage = lambda record: None
+
+MESSAGES = [
+    {'role': 'system', 'content': 'Du bist ein hilfreicher Assistent.'},
+    {'role': 'user', 'content': 'Erzähl mir etwas über Streaming.'}
+]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Fake server did not start on port {port}")
+
+
+def sdk_stream(model):
+    """Yields once per token, straight from the provider SDK."""
+    client = get_client(model['provider'])
+    if model['provider'] in ANTHROPIC_PROVIDERS:
+        response = client.messages.create(model=model['model'], max_tokens=1000, system=MESSAGES[0]['content'],
+                                          messages=MESSAGES[1:], stream=True)
+        for line in response:
+            if line.type == 'content_block_delta':
+                yield line.delta.text
+    else:
+        response = client.chat.completions.create(model=model['model'], messages=MESSAGES, stream=True)
+        for line in response:
+            if line.choices and line.choices[0].delta.content:
+                yield line.choices[0].delta.content
+
+
+def llm_call_stream_tokens(model):
+    """Yields once per delta event (one token, coalescing is off) of the full llm_call stack."""
+    for chunk in llm_call(MESSAGES, model):
+        if chunk.startswith(b'event: delta'):
+            yield chunk
+        elif chunk.startswith(b'event: error'):
+            raise RuntimeError(chunk.decode('utf-8'))
+
+
+def run_stream(stream_fn, model, results):
+    started = time.time()
+    first = last = None
+    gaps = []
+    tokens = 0
+    try:
+        for _ in stream_fn(model):
+            now = time.time()
+            if first is None:
+                first = now
+            else:
+                gaps.append(now - last)
+            last = now
+            tokens += 1
+    except Exception as e:
+        results.append({'error': f"{type(e).__name__}: {e}"})
+        return
+    results.append({'ttft': first - started if first else None, 'gaps': gaps, 'tokens': tokens,
+                    'duration': time.time() - started})
+
+
+def run_level(stream_fn, model, concurrency, rounds):
+    results = []
+
+    def worker():
+        for _ in range(rounds):
+            run_stream(stream_fn, model, results)
+
+    cpu_started = time.process_time()
+    started = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - started
+    cpu = time.process_time() - cpu_started
+
+    ok = [r for r in results if 'error' not in r]
+    tokens = sum(r['tokens'] for r in ok)
+    gaps = [gap for r in ok for gap in r['gaps']]
+    ttfts = [r['ttft'] for r in ok if r['ttft'] is not None]
+    durations = [r['duration'] for r in ok]
+    return {
+        'streams': len(results),
+        'errors': len(results) - len(ok),
+        'tokens': tokens,
+        'ttft_p50_ms': ms(percentile(ttfts, 50)),
+        'ttft_p95_ms': ms(percentile(ttfts, 95)),
+        'gap_p50_ms': ms(percentile(gaps, 50)),
+        'gap_p99_ms': ms(percentile(gaps, 99)),
+        'duration_p50_ms': ms(percentile(durations, 50)),
+        'cpu_us_per_token': round(cpu / tokens * 1e6, 1) if tokens else None,
+        'wall_s': round(wall, 2),
+    }
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming overhead benchmark against the fake provider.')
+    parser.add_argument('--provider', default='fake', choices=['fake', 'fake_anthropic'])
+    parser.add_argument('--levels', default='1,10,100', help='comma separated numbers of concurrent streams')
+    parser.add_argument('--rounds', type=int, default=3, help='streams per concurrent worker')
+    parser.add_argument('--ttft', type=float, default=0.2)
+    parser.add_argument('--tps', type=float, default=100)
+    parser.add_argument('--tokens', type=int, default=200)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--no-server', action='store_true', help='use an already running fake server')
+    args = parser.parse_args()
+
+    server = None
+    if not args.no_server:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        server = subprocess.Popen([sys.executable, os.path.join(root, 'ai', 'ai_fake_server.py'), str(args.port)])
+    try:
+        wait_for_port(args.port)
+        model = {'provider': args.provider, 'name': 'Benchmark',
+                 'model': f"fake:ttft={args.ttft},tps={args.tps},tokens={args.tokens}"}
+
+        # Warm up connection pools and imports
+        run_level(sdk_stream, model, 1, 1)
+        run_level(llm_call_stream_tokens, model, 1, 1)
+
+        report = []
+        for level in [int(level) for level in args.levels.split(',')]:
+            sdk = run_level(sdk_stream, model, level, args.rounds)
+            ours = run_level(llm_call_stream_tokens, model, level, args.rounds)
+            overhead = {key: round(ours[key] - sdk[key], 2)
+                        for key in ('ttft_p50_ms', 'gap_p50_ms', 'gap_p99_ms', 'cpu_us_per_token')
+                        if ours[key] is not None and sdk[key] is not None}
+            report.append({'concurrency': level, 'sdk': sdk, 'llm_call': ours, 'overhead': overhead})
+            print(f"{level:>4} streams  overhead: {overhead}  errors: sdk {sdk['errors']}, llm_call {ours['errors']}")
+
+        print(json.dumps(report, indent=2))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
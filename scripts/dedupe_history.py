@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Merges duplicate chat histories before the unique (user_id, chat_started) index is built.
+
+The old save_chat (count, then insert) could store a conversation twice when two saves
+raced. Of every group of histories with the same user_id and chat_started, the most
+recently modified one is kept; the file_ids of the others are added to it and the others
+are deleted. A non-unique (user_id, chat_started) index from before is dropped, so
+core/db_indexes.py ensure-indexes can build the unique one.
+
+    python scripts/dedupe_history.py --dry-run   # only report the duplicates
+    python scripts/dedupe_history.py
+    python core/db_indexes.py ensure-indexes
+"""
+import os
+import sys
+import argparse
+
+# Add parent directory to Python path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.db_document import History
+
+INDEX_KEY = [('user_id', 1), ('chat_started', 1)]
+
+
+def duplicate_groups(collection):
+    """Ids of each group of histories sharing user_id and chat_started, newest first."""
+    return collection.aggregate([
+        {'$match': {'chat_started': {'$exists': True}}},
+        {'$sort': {'modified_date': -1, '_id': -1}},
+        {'$group': {'_id': {'user_id': '$user_id', 'chat_started': '$chat_started'},
+                    'ids': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ], allowDiskUse=True)
+
+
+def dedupe_history(dry_run=False):
+    print("Looking for duplicate histories...")
+    collection = History._get_collection()
+    groups = 0
+    removed = 0
+
+    for group in duplicate_groups(collection):
+        keep, duplicates = group['ids'][0], group['ids'][1:]
+        groups += 1
+        removed += len(duplicates)
+        print(f"user {group['_id']['user_id']}, chat {group['_id']['chat_started']}: "
+              f"keeping {keep}, removing {len(duplicates)}")
+        if dry_run:
+            continue
+        file_ids = [file_id for history in collection.find({'_id': {'$in': duplicates}}, {'file_ids': 1})
+                    for file_id in history.get('file_ids') or []]
+        if file_ids:
+            collection.update_one({'_id': keep}, {'$addToSet': {'file_ids': {'$each': file_ids}}})
+        collection.delete_many({'_id': {'$in': duplicates}})
+
+    for name, index in collection.index_information().items():
+        if index['key'] == INDEX_KEY and not index.get('unique'):
+            print(f"Dropping non-unique index {name}")
+            if not dry_run:
+                collection.drop_index(name)
+
+    print("\nDeduplication complete!" if not dry_run else "\nDry run, nothing changed")
+    print(f"Duplicate chats: {groups}")
+    print(f"Histories removed: {removed}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge duplicate chat histories.')
+    parser.add_argument('--dry-run', action='store_true', help='only report the duplicates')
+    dedupe_history(parser.parse_args().dry_run)
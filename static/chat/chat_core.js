@@ -1,6 +1,7 @@
 let isInCodeBlock = false;
 let currentCodeElement = null;
 let stop_stream = false;
+let currentStreamId = null; // Id of the running stream, for /chat/cancel
 let uploadedFilesCount = 0;
 let currentMessageAttachments = [];
 let displayedFileIds = new Set(); // Track which files we've already displayed
@@ -253,9 +254,47 @@ function saveChatData(messages) {
     });
 }
 
+// Progress line of the agent mode while a tool runs
+const TOOL_LABELS = {
+  web_search: "Websuche",
+  search_files: "Suche in Dateien",
+  search_documents: "Suche in Dokumenten",
+};
+
+function toolProgressText(data) {
+  const label = TOOL_LABELS[data.name] || data.name;
+  const query = data.arguments && data.arguments.query ? `: ${data.arguments.query}` : "";
+  switch (data.status) {
+    case "running":
+      return `${label}${query} ...`;
+    case "done":
+      return `${label} abgeschlossen (${data.seconds}s) ...`;
+    case "timeout":
+      return `${label}: Zeitüberschreitung ...`;
+    default:
+      return `${label} fehlgeschlagen ...`;
+  }
+}
+
 async function stopStreaming() {
   // Set the flag to true to stop streaming
   stop_stream = true;
+  if (!currentStreamId) return;
+
+  // Tell the server to cancel the provider call, so it stops generating tokens
+  const streamId = currentStreamId;
+  currentStreamId = null;
+  const csrfToken = document
+    .querySelector('meta[name="csrf-token"]')
+    .getAttribute("content");
+  try {
+    await fetch(`/chat/cancel/${streamId}`, {
+      method: "POST",
+      headers: { "X-CSRFToken": csrfToken },
+    });
+  } catch (error) {
+    console.error("Error cancelling stream:", error);
+  }
 }
 
 function appendNormalText(container, text) {
@@ -766,7 +805,12 @@ async function streamMessage() {
           "Content-Type": "application/json",
           "X-CSRFToken": csrfToken,
         },
-        body: JSON.stringify({ messages: messages, model: current_model }),
+        body: JSON.stringify({
+          messages: messages,
+          model: current_model,
+          prompt_id: prompt_id,
+          agent: document.getElementById("agent_mode")?.checked || false,
+        }),
       });
 
       if (!response.body) {
@@ -774,72 +818,89 @@ async function streamMessage() {
       }
 
       const reader = response.body.getReader();
-
-      while (true) {
-        const { done, value } = await reader.read();
-        if (done || stop_stream) {
-          const stopIndexAccumulated =
-            accumulatedResponse.indexOf("###STOP###");
-          if (stopIndexAccumulated !== -1) {
-            accumulatedResponse = accumulatedResponse.substring(
-              0,
-              stopIndexAccumulated,
-            );
-          }
+      const decoder = new TextDecoder();
+      let renderFrame = null;
+      let streamError = null;
+
+      // Re-render at most once per animation frame instead of once per chunk
+      const scheduleRender = () => {
+        if (renderFrame !== null) return;
+        renderFrame = requestAnimationFrame(() => {
+          renderFrame = null;
           botMessageElement.innerHTML = "";
           appendData(accumulatedResponse, botMessageElement);
-          messages.push({ role: "assistant", content: accumulatedResponse });
-
-          console.log(
-            "Current messages array before saving after AI response:",
-            messages,
-          );
+          scrollToBottom();
+        });
+      };
 
-          // Save chat after AI response
-          try {
-            await saveChatData(messages);
-            console.log("Chat saved after AI response");
-          } catch (error) {
-            console.error("Failed to save chat after AI response:", error);
-          }
+      const feed = createEventStreamParser((event, data) => {
+        switch (event) {
+          case "start":
+            currentStreamId = data.stream_id;
+            break;
+          case "delta":
+            accumulatedResponse += data.text;
+            scheduleRender();
+            break;
+          case "queue":
+            if (accumulatedResponse === "") {
+              botMessageElement.textContent = `In Warteschlange (Position ${data.position}) ...`;
+            }
+            break;
+          case "usage":
+            console.log("Token usage:", data);
+            break;
+          case "citations":
+            console.log("Citations:", data.citations);
+            break;
+          case "error":
+            streamError = data.message;
+            break;
+          case "tool":
+            if (accumulatedResponse === "") {
+              botMessageElement.textContent = toolProgressText(data);
+            }
+            break;
+          case "heartbeat":
+            break;
+        }
+      });
 
-          toggleButtonVisibility();
-          chatInput.readOnly = false;
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done || stop_stream) {
+          if (!done) reader.cancel();
+          currentStreamId = null;
           break;
         }
+        feed(decoder.decode(value, { stream: true }));
+      }
 
-        const text = new TextDecoder().decode(value);
-        const stopIndex = text.indexOf("###STOP###");
-
-        if (stopIndex !== -1) {
-          accumulatedResponse += text.substring(0, stopIndex);
-          botMessageElement.innerHTML = "";
-          appendData(accumulatedResponse, botMessageElement);
-          messages.push({ role: "assistant", content: accumulatedResponse });
-
-          console.log(
-            "Current messages array before saving after AI response:",
-            messages,
-          );
+      if (streamError) {
+        accumulatedResponse = accumulatedResponse
+          ? `${accumulatedResponse}\n\n${streamError}`
+          : streamError;
+      }
+      if (renderFrame !== null) cancelAnimationFrame(renderFrame);
+      botMessageElement.innerHTML = "";
+      appendData(accumulatedResponse, botMessageElement);
+      messages.push({ role: "assistant", content: accumulatedResponse });
 
-          // Save chat after AI response
-          try {
-            await saveChatData(messages);
-            console.log("Chat saved after AI response");
-          } catch (error) {
-            console.error("Failed to save chat after AI response:", error);
-          }
+      console.log(
+        "Current messages array before saving after AI response:",
+        messages,
+      );
 
-          toggleButtonVisibility();
-          chatInput.readOnly = false;
-          break;
-        } else {
-          accumulatedResponse += text;
-          botMessageElement.innerHTML = "";
-          appendData(accumulatedResponse, botMessageElement);
-          scrollToBottom();
-        }
+      // Save chat after AI response
+      try {
+        await saveChatData(messages);
+        console.log("Chat saved after AI response");
+      } catch (error) {
+        console.error("Failed to save chat after AI response:", error);
       }
+
+      toggleButtonVisibility();
+      chatInput.readOnly = false;
     } catch (error) {
       console.error("Streaming failed:", error);
       botMessageElement.textContent = `Error occurred: ${error.message}`;
@@ -867,6 +928,37 @@ async function streamMessage() {
   }
 }
 
+// Incremental parser for the text/event-stream response of /chat/stream.
+// Only the unparsed tail is kept, so every byte is looked at once no matter
+// how long the answer gets.
+function createEventStreamParser(onEvent) {
+  let buffer = "";
+  return function feed(text) {
+    buffer += text;
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice(5).trim();
+        }
+      }
+
+      try {
+        onEvent(event, data ? JSON.parse(data) : null);
+      } catch (error) {
+        console.error("Invalid stream event:", event, data, error);
+      }
+    }
+  };
+}
+
 function toggleButtonVisibility() {
   const chatButton = document.getElementById("chat_button");
   const stopButton = document.getElementById("stop_button");
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Agent tools run through run_tools, in the worker threads they use in the chat."""
+import time
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import mongoengine
+
+import core.db_connect  # noqa: F401, connects to MONGODB_URI first, replaced below
+from core.db_document import Prompt, User
+import ai.ai_agent as agent
+from ai.ai_agent import run_tools, agent_stream
+
+
+@pytest.fixture(autouse=True)
+def database():
+    mongoengine.disconnect()
+    mongoengine.connect('fireworks_test', mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
+
+
+def run(calls, context):
+    """Events and results of run_tools (the results are the generator's return value)."""
+    events = []
+    generator = run_tools(calls, context, time.time() + 10)
+    while True:
+        try:
+            events.append(next(generator))
+        except StopIteration as stop:
+            return events, stop.value
+
+
+def test_search_documents_runs_without_app_context():
+    Prompt._get_collection().insert_one({'name': 'Zusammenfassung', 'welcome_message': 'Hallo',
+                                         'system_message': 'Fasse zusammen', 'prompt': 'Text:'})
+    user = User(firstname='Ada', name='Lovelace', email='ada@example.com', pw_hash='x', role='user')
+    call = {'id': 'call_1', 'name': 'search_documents', 'arguments': {'collection': 'prompts', 'query': 'Zusammen*'}}
+
+    events, results = run([call], {'user': user, 'file_ids': []})
+
+    assert [event[1]['status'] for event in events] == ['running', 'done']
+    assert 'Zusammenfassung' in results[0]['content']
+
+
+def test_unknown_collection_is_reported_to_the_model():
+    user = User(firstname='Ada', name='Lovelace', email='ada@example.com', pw_hash='x', role='user')
+    call = {'id': 'call_1', 'name': 'search_documents', 'arguments': {'collection': 'users', 'query': 'ada'}}
+
+    events, results = run([call], {'user': user, 'file_ids': []})
+
+    assert events[-1][1]['status'] == 'done'
+    assert 'Unbekannte Sammlung' in results[0]['content']
+
+
+def test_final_step_forbids_tool_calls_and_fits_the_context(monkeypatch):
+    steps = []
+
+    def complete_tools(messages, model, tools, allow_calls=True):
+        steps.append({'allow_calls': allow_calls, 'tokens': sum(len(str(m.get('content'))) for m in messages) // 4})
+        if not allow_calls:
+            return {'text': 'Antwort', 'tool_calls': [], 'usage': {'total_tokens': 1}, 'assistant_message': None}
+        call = {'id': f"call_{len(steps)}", 'name': 'web_search', 'arguments': {'query': 'x'}}
+        return {'text': '', 'tool_calls': [call], 'usage': {'total_tokens': 1},
+                'assistant_message': {'role': 'assistant', 'content': None, 'tool_calls': [
+                    {'id': call['id'], 'type': 'function', 'function': {'name': 'web_search', 'arguments': '{}'}}]}}
+
+    monkeypatch.setattr(agent, 'max_steps', 2)
+    monkeypatch.setattr(agent, 'llm_complete_tools', complete_tools)
+    monkeypatch.setattr(agent, 'scheduled_complete', lambda messages, model, priority, user_id, complete: complete(messages, model))
+    monkeypatch.setitem(agent.TOOLS['web_search'], 'function', lambda arguments, context: 'x' * 4000)
+
+    model = {'provider': 'openai', 'model': 'gpt-test', 'context_budget_int': 1500}
+    messages = [{'role': 'system', 'content': 'System'}, {'role': 'user', 'content': 'Frage'}]
+    events = list(agent_stream(messages, model, user=None))
+
+    assert [step['allow_calls'] for step in steps] == [True, True, False]
+    # Two results of ~1000 tokens each are cut to the budget of 1500
+    assert all(step['tokens'] <= 1500 for step in steps)
+    assert ('delta', {'text': 'Antwort'}) in events
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Exact-match response cache and semantic answer cache, hits and misses."""
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import mongoengine
+
+import core.db_connect  # noqa: F401, connects to MONGODB_URI first, replaced below
+from ai.ai_cache import ResponseCache, cache_key
+from ai.ai_semantic_cache import SemanticAnswerCache, cache_scope
+
+MODEL = {'provider': 'openai', 'model': 'gpt-test', 'response_cache': 'On'}
+MESSAGES = [{'role': 'user', 'content': 'Frage'}]
+SETTINGS = {'prompt_id': 'prompt-1', 'threshold': 0.9, 'system_message': 'System', 'system_hash': 'a1'}
+
+
+@pytest.fixture(autouse=True)
+def database():
+    mongoengine.disconnect()
+    mongoengine.connect('fireworks_test', mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
+
+
+def test_response_cache_hits_only_the_same_request():
+    cache = ResponseCache(max_entries=10, ttl=60, directory='')
+    cache.put(cache_key(MODEL, MESSAGES), {'text': 'Antwort'})
+
+    assert cache.get(cache_key(MODEL, MESSAGES)) == {'text': 'Antwort'}
+    # Audit fields don't change the key, the model and the messages do
+    assert cache.get(cache_key(dict(MODEL, modified_date='2024-01-01'), MESSAGES)) == {'text': 'Antwort'}
+    assert cache.get(cache_key(dict(MODEL, model='gpt-other'), MESSAGES)) is None
+    assert cache.get(cache_key(MODEL, [{'role': 'user', 'content': 'Andere Frage'}])) is None
+    assert cache.counters['memory_hits'] == 2
+    assert cache.counters['misses'] == 2
+
+
+def test_response_cache_expires_and_evicts(tmp_path):
+    expired = ResponseCache(max_entries=10, ttl=-1, directory='')
+    expired.put('key', 'value')
+    assert expired.get('key') is None
+
+    cache = ResponseCache(max_entries=1, ttl=60, directory=str(tmp_path))
+    cache.put('first', 'one')
+    cache.put('second', 'two')
+    assert cache.counters['evictions'] == 1
+    # Evicted from memory, still on disk
+    assert cache.get('first') == 'one'
+    assert cache.counters['disk_hits'] == 1
+
+
+def test_semantic_cache_hits_similar_questions_of_the_same_model():
+    cache = SemanticAnswerCache()
+    scope = cache_scope(SETTINGS, MODEL)
+    cache.store(scope, 'Frage', [1.0, 0.0], 'Antwort')
+
+    assert cache.lookup(scope, [1.0, 0.05], SETTINGS['threshold']) == 'Antwort'
+    assert cache.lookup(scope, [0.0, 1.0], SETTINGS['threshold']) is None
+    assert cache.lookup(cache_scope(SETTINGS, dict(MODEL, model='gpt-other')), [1.0, 0.0], 0.9) is None
+    # An edited system message starts a fresh cache
+    assert cache.lookup(cache_scope(dict(SETTINGS, system_hash='b2'), MODEL), [1.0, 0.0], 0.9) is None
+    assert cache.counters == {'hits': 1, 'misses': 3, 'stores': 1}
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""fit_messages trimming: system message, old turns, tool results and the latest message."""
+from ai.ai_context import fit_messages, message_tokens, TRUNCATION_NOTE
+
+MODEL = {'provider': 'openai', 'model': 'gpt-test', 'context_budget_int': 1000}
+
+
+def tokens(messages):
+    return sum(message_tokens(message) for message in messages)
+
+
+def test_small_requests_are_unchanged():
+    messages = [{'role': 'system', 'content': 'System'}, {'role': 'user', 'content': 'Frage'}]
+
+    assert fit_messages(messages, MODEL) == messages
+
+
+def test_oversized_system_message_is_cut_to_its_share():
+    messages = [{'role': 'system', 'content': 'x' * 8000}, {'role': 'user', 'content': 'Frage'}]
+
+    fitted = fit_messages(messages, MODEL)
+
+    assert fitted[0]['content'].endswith(TRUNCATION_NOTE)
+    assert message_tokens(fitted[0]) <= 600
+    assert fitted[1] == messages[1]
+    # The caller's messages are not changed
+    assert len(messages[0]['content']) == 8000
+
+
+def test_oldest_turns_are_dropped_first():
+    old_turns = []
+    for turn in range(5):
+        old_turns += [{'role': 'user', 'content': f"Frage {turn} " + 'x' * 1000},
+                      {'role': 'assistant', 'content': f"Antwort {turn} " + 'x' * 1000}]
+    messages = [{'role': 'system', 'content': 'System'}] + old_turns + [{'role': 'user', 'content': 'Letzte Frage'}]
+
+    fitted = fit_messages(messages, MODEL)
+
+    assert tokens(fitted) <= 1000
+    assert fitted[0] == messages[0]
+    assert fitted[1]['role'] == 'user'
+    assert fitted[-1] == messages[-1]
+    assert len(fitted) < len(messages)
+
+
+def test_tool_results_of_the_latest_question_are_cut():
+    messages = [
+        {'role': 'system', 'content': 'System'},
+        {'role': 'user', 'content': 'Frage'},
+        {'role': 'assistant', 'content': None, 'tool_calls': [
+            {'id': 'call_1', 'type': 'function', 'function': {'name': 'web_search', 'arguments': '{}'}},
+            {'id': 'call_2', 'type': 'function', 'function': {'name': 'web_search', 'arguments': '{}'}}]},
+        {'role': 'tool', 'tool_call_id': 'call_1', 'content': 'a' * 4000},
+        {'role': 'tool', 'tool_call_id': 'call_2', 'content': 'b' * 4000},
+    ]
+
+    fitted = fit_messages(messages, MODEL)
+
+    assert tokens(fitted) <= 1000
+    # The question and every call with its result are kept, the results are cut evenly
+    assert [message['role'] for message in fitted] == ['system', 'user', 'assistant', 'tool', 'tool']
+    assert all(message['content'].endswith(TRUNCATION_NOTE) for message in fitted[3:])
+    assert abs(len(fitted[3]['content']) - len(fitted[4]['content'])) <= 4
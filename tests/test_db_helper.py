@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Keyset paging: page tokens, forward and backward pages and the last page."""
+import base64
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import mongoengine
+from bson import json_util, ObjectId
+
+import core.db_connect  # noqa: F401, connects to MONGODB_URI first, replaced below
+from core.db_document import Prompt
+from core.db_helper import encodeCursor, decodeCursor, keysetQuery
+
+NAMES = ['Anfrage', 'Brief', 'Chat', 'Dossier', 'Entwurf']
+
+
+@pytest.fixture(autouse=True)
+def database():
+    mongoengine.disconnect()
+    mongoengine.connect('fireworks_test', mongo_client_class=mongomock.MongoClient)
+    Prompt._get_collection().insert_many([{'name': name, 'system_message': '', 'prompt': ''} for name in NAMES])
+    yield
+    mongoengine.disconnect()
+
+
+def page(cursor=None, backwards=False):
+    documents, has_more, total, stats = keysetQuery(Prompt, {}, 'name', 1, 2, cursor, backwards)
+    return [document.name for document in documents], has_more, documents
+
+
+def token(payload):
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def test_cursor_round_trip_and_other_sort():
+    document = Prompt.objects(name='Chat').first()
+    cursor = encodeCursor(document, 'name', 1)
+
+    assert decodeCursor(cursor, 'name', 1) == ('Chat', document.pk)
+    assert decodeCursor(cursor, 'name', -1) is None
+    assert decodeCursor(cursor, 'created_date', 1) is None
+    assert decodeCursor('kein-token', 'name', 1) is None
+
+
+def test_cursor_with_operator_value_is_rejected():
+    assert decodeCursor(token({'s': 'name', 'o': 1, 'v': {'$ne': None}, 'id': ObjectId()}), 'name', 1) is None
+    assert decodeCursor(token({'s': 'name', 'o': 1, 'v': 'Chat', 'id': {'$gt': ''}}), 'name', 1) is None
+    assert decodeCursor(token({'s': 'name', 'o': 1, 'v': 'Chat', 'id': None}), 'name', 1) is None
+
+
+def test_pages_forward_and_back():
+    names, has_more, documents = page()
+    assert (names, has_more) == (['Anfrage', 'Brief'], True)
+
+    names, has_more, documents = page(decodeCursor(encodeCursor(documents[-1], 'name', 1), 'name', 1))
+    assert (names, has_more) == (['Chat', 'Dossier'], True)
+
+    names, has_more, _ = page(decodeCursor(encodeCursor(documents[-1], 'name', 1), 'name', 1))
+    assert (names, has_more) == (['Entwurf'], False)
+
+    names, has_more, _ = page(decodeCursor(encodeCursor(documents[0], 'name', 1), 'name', 1), backwards=True)
+    assert (names, has_more) == (['Anfrage', 'Brief'], False)
+
+
+def test_last_page():
+    documents, has_more, total, stats = keysetQuery(Prompt, {}, 'name', 1, 2, backwards=True)
+
+    assert [document.name for document in documents] == ['Dossier', 'Entwurf']
+    assert has_more
+    assert total == len(NAMES)
+    assert stats['round_trips'] == 2
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Scheduler admission: priorities, concurrency limits and the queue limit."""
+import pytest
+
+import ai.ai_scheduler as scheduler_module
+from ai.ai_scheduler import Scheduler, QueueFull, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+
+MODEL = {'provider': 'openai', 'model': 'gpt-test', 'max_concurrency_int': 1}
+MESSAGES = [{'role': 'user', 'content': 'Frage'}]
+
+
+def test_interactive_requests_start_before_queued_batch_work():
+    scheduler = Scheduler()
+    running = scheduler.enqueue(MODEL, MESSAGES)
+    assert scheduler.try_start(running) == 0
+
+    batch = scheduler.enqueue(MODEL, MESSAGES, PRIORITY_BATCH)
+    interactive = scheduler.enqueue(MODEL, MESSAGES, PRIORITY_INTERACTIVE)
+    # The model allows one call at a time, the interactive request is first in line
+    assert scheduler.try_start(interactive) == 1
+    assert scheduler.try_start(batch) == 2
+
+    scheduler.release(running)
+    assert scheduler.try_start(batch) == 2
+    assert scheduler.try_start(interactive) == 0
+    assert scheduler.stats()['waiting'] == 1
+
+    scheduler.release(interactive)
+    assert scheduler.try_start(batch) == 0
+
+
+def test_full_queue_rejects_requests(monkeypatch):
+    monkeypatch.setattr(scheduler_module, 'max_queue', 2)
+    scheduler = Scheduler()
+    scheduler.enqueue(MODEL, MESSAGES)
+    scheduler.enqueue(MODEL, MESSAGES)
+
+    with pytest.raises(QueueFull):
+        scheduler.enqueue(MODEL, MESSAGES)
+
+
+def test_cancelled_tickets_leave_the_queue():
+    scheduler = Scheduler()
+    running = scheduler.enqueue(MODEL, MESSAGES)
+    scheduler.try_start(running)
+    first = scheduler.enqueue(MODEL, MESSAGES)
+    second = scheduler.enqueue(MODEL, MESSAGES)
+    assert scheduler.try_start(second) == 2
+
+    scheduler.cancel(first)
+    assert scheduler.try_start(second) == 1
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Write-behind history saves: the guarded upsert filter, coalescing and discarding."""
+from datetime import datetime, timedelta
+
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+import mongoengine
+
+import core.db_connect  # noqa: F401, connects to MONGODB_URI first, replaced below
+from core.db_document import History
+from ai.ai_write_behind import WriteBehindBuffer, history_update
+
+MESSAGES = '[{"role": "user", "content": "Frage"}]'
+
+
+@pytest.fixture(autouse=True)
+def database():
+    mongoengine.disconnect()
+    mongoengine.connect('fireworks_test', mongo_client_class=mongomock.MongoClient)
+    yield
+    mongoengine.disconnect()
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    buffer = WriteBehindBuffer()
+    # No flush thread, the tests look at the pending saves
+    monkeypatch.setattr(buffer, '_start', lambda: None)
+    return buffer
+
+
+def save(saved_date):
+    return {'user_id': 'u1', 'chat_started': 1, 'messages': MESSAGES, 'first_message': 'Frage',
+            'file_ids': [], 'saved_date': saved_date}
+
+
+def matches(update):
+    return History._get_collection().count_documents(update._filter)
+
+
+def test_save_only_overwrites_older_histories():
+    stored = datetime.now()
+    History._get_collection().insert_one({'user_id': 'u1', 'chat_started': 1, 'modified_date': stored})
+
+    assert matches(history_update(save(stored + timedelta(seconds=1)))) == 1
+    assert matches(history_update(save(stored))) == 1
+    # A late retry of an older save must not overwrite the newer conversation
+    assert matches(history_update(save(stored - timedelta(seconds=1)))) == 0
+
+
+def test_save_of_a_new_chat_is_an_upsert():
+    update = history_update(save(datetime.now()))
+
+    assert matches(update) == 0
+    assert update._upsert
+
+
+def test_saves_are_coalesced_and_discarded(buffer):
+    buffer.save_history('u1', 1, MESSAGES)
+    buffer.save_history('u1', 1, MESSAGES)
+    buffer.save_history('u1', 2, MESSAGES)
+
+    buffer.discard_history('u1', 1)
+    buffer.discard_history('u1', 3)
+
+    assert list(buffer._histories) == [('u1', 2)]
+    assert buffer.counters['saves'] == 3
+    assert buffer.counters['coalesced'] == 1
+    assert buffer.counters['discarded'] == 1